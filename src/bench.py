@@ -0,0 +1,156 @@
+"""
+    AoUS - DEID, 2018
+
+    This file benchmarks the de-identification against a (synthetic) dataset run with the local engine (see synthetic.py and engine.py) :
+        - plan building i.e the time spent in the policies to compose the queries (Shift.can_do, DropFields.can_do, Group.<category>, compose)
+        - end-to-end execution of the queries (Orchestrator.run)
+    The measures are appended to a history file (JSON-lines) and compared to the previous runs at the same scale,
+    a measure that is slower than the median of the previous runs by more than a threshold is reported as a regression.
+
+    Usage :
+        python synthetic.py --config path-of-config.json --data <folder> --rows 1000000
+        python bench.py --config path-of-config.json --data <folder> [--i_dataset raw] [--history benchmarks.jsonl] [--threshold 1.25] [--window 5] [--tolerance 20] [--skip_run]
+    The program exits with 1 if a regression is found
+"""
+from __future__ import division
+from datetime import datetime
+import tempfile
+import shutil
+import json
+import time
+import sys
+import os
+import deid
+
+class Benchmark :
+    """
+        This class measures the time it takes to plan and run the de-identification of a dataset and tracks the measures over time
+        e.g :
+            handler = Benchmark(path='data',config=config,history='benchmarks.jsonl')
+            r = handler.measure()
+            handler.check(r)        #-- [{"name":"plan.dropfields.can_do","value":..,"baseline":..}]
+            handler.save(r)
+    """
+    def __init__(self,**args):
+        """
+            @param path         folder of the datasets (local engine)
+            @param config       configuration (as found in config.json)
+            @param dataset      name of the input dataset (default raw)
+            @param history      path of the history of the measures (default benchmarks.jsonl)
+            @param threshold    a measure is a regression if it is slower than threshold * median of the previous ones (default 1.25)
+            @param window       number of previous measures (at the same scale) the median is computed on (default 5)
+            @param tolerance    durations within tolerance (ms) of the median are never regressions, it absorbs the noise of short phases (default 20)
+        """
+        from engine import LocalClient
+        self.path       = args['path']
+        self.config     = args['config']
+        self.dataset    = args['dataset'] if 'dataset' in args else 'raw'
+        self.history    = args['history'] if 'history' in args else 'benchmarks.jsonl'
+        self.threshold  = float(args['threshold']) if 'threshold' in args else 1.25
+        self.window     = int(args['window']) if 'window' in args else 5
+        self.tolerance  = float(args['tolerance']) if 'tolerance' in args else 20
+        self.client     = LocalClient(path=self.path)
+    def get_orchestrator(self,folder):
+        """
+            This function returns an orchestrator whose caches (schemas, concepts) are empty i.e the plan is built from scratch
+        """
+        return deid.Orchestrator(client=self.client,i_dataset=self.dataset,o_dataset=self.dataset+"_bench",config=self.config,cache=folder,jobs=folder)
+    def get_rows(self):
+        r = self.client.query("SELECT COUNT(*) AS n FROM :dataset.observation".replace(":dataset",self.dataset)).to_dataframe()
+        return int(r['n'].values[0])
+    def plan(self):
+        """
+            This function composes the query of every table and returns the total time (ms) spent in every phase of the composition
+        """
+        folder = tempfile.mkdtemp()
+        try:
+            deid.Logging.PROFILE.clear()
+            handler = self.get_orchestrator(folder)
+            start = time.time()
+            for table in handler.get_tables() :
+                handler.compose(table)
+            r = dict([(name,value['total']) for name,value in deid.Logging.profile().items()])
+            r['total'] = round((time.time() - start)*1000,3)
+        finally:
+            shutil.rmtree(folder,True)
+        return r
+    def run(self):
+        """
+            This function de-identifies the dataset (the output is written in <dataset>_bench) and returns the total time (ms) spent in every phase of the run
+        """
+        folder = tempfile.mkdtemp()
+        try:
+            deid.Logging.PROFILE.clear()
+            handler = self.get_orchestrator(folder)
+            start = time.time()
+            summary = handler.run()
+            r = dict([(name,value['total']) for name,value in deid.Logging.profile().items()])
+            r['total'] = round((time.time() - start)*1000,3)
+            r['failed'] = len([1 for item in summary if item['state'] == 'FAILED'])
+        finally:
+            shutil.rmtree(folder,True)
+        return r
+    def measure(self,run=True):
+        """
+            This function measures the plan (and the run) of the dataset
+            @param run  run the queries as well (default True)
+        """
+        r = {"date":datetime.now().isoformat(),"dataset":self.dataset,"rows":self.get_rows(),"measures":{}}
+        for name,value in self.plan().items() :
+            r['measures']['plan.'+name] = value
+        if run :
+            for name,value in self.run().items() :
+                r['measures']['run.'+name] = value
+            r['measures']['run.rows_per_second'] = int(r['rows'] / max(r['measures']['run.total'],1) * 1000)
+        return r
+    def load(self):
+        """
+            This function returns the measures of the previous runs
+        """
+        if not os.path.exists(self.history) :
+            return []
+        f = open(self.history)
+        r = [json.loads(line) for line in f if line.strip() != '']
+        f.close()
+        return r
+    def check(self,r):
+        """
+            This function compares the measures to the median of the previous ones (same number of rows) and returns the regressions
+            A regression is a duration greater than threshold * median (and median + tolerance) or a throughput (rows_per_second) lower than median / threshold
+        """
+        previous = [item for item in self.load() if item['rows'] == r['rows'] and item['dataset'] == r['dataset']][-self.window:]
+        regressions = []
+        for name in r['measures'] :
+            values = sorted([item['measures'][name] for item in previous if name in item['measures']])
+            if not values or name.endswith('.failed') :
+                continue
+            baseline = values[len(values) // 2]
+            value = r['measures'][name]
+            slower = value < baseline / self.threshold if name.endswith('rows_per_second') else value > max(baseline * self.threshold,baseline + self.tolerance)
+            if slower :
+                regressions.append({"name":name,"value":value,"baseline":baseline})
+        deid.Logging.log(subject='benchmark',object=self.dataset,action='check',value={"previous":len(previous),"regressions":regressions})
+        return regressions
+    def save(self,r):
+        f = open(self.history,'a')
+        f.write(json.dumps(r)+"\n")
+        f.close()
+
+if __name__ == '__main__' :
+    SYS_ARGS = deid.SYS_ARGS
+    config = deid.configure(SYS_ARGS['config'])
+    args = {"path":SYS_ARGS['data'],"config":config}
+    for key in ['history','threshold','window','tolerance'] :
+        if key in SYS_ARGS :
+            args[key] = SYS_ARGS[key]
+    if 'i_dataset' in SYS_ARGS :
+        args['dataset'] = SYS_ARGS['i_dataset']
+    handler = Benchmark(**args)
+    r = handler.measure(run='skip_run' not in SYS_ARGS)
+    regressions = handler.check(r)
+    handler.save(r)
+    for name in sorted(r['measures']) :
+        print ("%-40s %s" % (name,r['measures'][name]))
+    for item in regressions :
+        print ("regression %s %s (baseline %s)" % (item['name'],item['value'],item['baseline']))
+    sys.exit(1 if regressions else 0)
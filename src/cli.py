@@ -0,0 +1,122 @@
+"""
+    AoUS - DEID, 2018
+
+    This file is the command line interface of the de-identification, the first argument is the sub-command :
+        - plan      compiles the de-identification query of every table (nothing is submitted)
+        - run       de-identifies the tables (as deid.py does)
+        - status    reports the final state of the latest job of every table (see JobTracker) and the watermarks of the increments
+
+    Design:
+        The cloud client (google.cloud.bigquery) and pandas are only imported when they are used (see deid.LazyModule).
+        An offline plan is compiled from the schemas and concepts persisted in the cache (see SchemaRegistry, Concepts) :
+        it needs neither a service account nor the network and can be run in a pre-commit hook or in CI.
+        The cache is populated by any run (or plan) that has access to the dataset.
+
+    Usage :
+        python cli.py plan --i_dataset <input_dataset> --config path-of-config.json [--tables <table_1,table_2>] [--cohort <file|dataset.table>] [--offline] [--output <folder>] [--cache <folder>]
+        python cli.py plan --i_dataset <input_dataset> --o_dataset <output_dataset> --config path-of-config.json --dryrun
+        python cli.py run --i_dataset <input_dataset> --o_dataset <output_dataset> --config path-of-config.json [--engine local --data <folder>] [options of deid.py]
+        python cli.py status [--jobs <folder>] [--i_dataset <input_dataset> --o_dataset <output_dataset>] [--cache <folder>]
+    The program exits with 1 if a query can't be planned, a job failed or the latest job of a table failed
+"""
+import glob
+import json
+import sys
+import os
+import deid
+
+def plan(sys_args):
+    """
+        This function compiles the query of every table, the queries are written in <output>/<table>.sql or printed.
+        With --dryrun the queries are submitted as dry-runs and the bytes they would process are reported (see Orchestrator.plan)
+    """
+    config  = deid.configure(sys_args['config'])
+    client  = None if 'offline' in sys_args else deid.get_client(sys_args,config)
+    handler = deid.Orchestrator(**deid.get_args(sys_args,client,config))
+    if 'dryrun' in sys_args :
+        summary = handler.plan()
+        for item in summary :
+            print item['table'],item['bytes_processed'],item['sql_length'],",".join(item['referenced_tables']),item['errors'] if item['errors'] else ''
+        print 'total',sum([item['bytes_processed'] for item in summary if item['bytes_processed'] is not None])
+        return 0 if len([1 for item in summary if item['errors']]) == 0 else 1
+    folder = sys_args['output'] if 'output' in sys_args else None
+    if folder is not None and not os.path.exists(folder) :
+        os.makedirs(folder)
+    tables = handler.get_tables()
+    if not tables :
+        #
+        # e.g nothing is known of the dataset (offline with an empty cache)
+        #
+        print >> sys.stderr, 'no table to plan in', handler.i_dataset
+        return 1
+    failed = 0
+    for table in tables :
+        try:
+            sql = handler.compose(table)
+        except Exception,e:
+            #
+            # e.g the schema of the table isn't in the cache (offline)
+            #
+            deid.Logging.log(subject='cli',object=table,action='plan.error',value=str(e))
+            print >> sys.stderr, table, 'error', e
+            failed += 1
+            continue
+        if folder is not None :
+            f = open(os.sep.join([folder,table+".sql"]),'w')
+            f.write(sql+"\n")
+            f.close()
+            print table,len(sql)
+        else:
+            print "-- " + table
+            print sql
+    handler.plans.save(handler.i_dataset)
+    deid.Logging.flush()
+    return 0 if failed == 0 else 1
+
+def run(sys_args):
+    """
+        This function de-identifies the tables of the input dataset
+    """
+    config  = deid.configure(sys_args['config'])
+    client  = deid.get_client(sys_args,config)
+    handler = deid.Orchestrator(**deid.get_args(sys_args,client,config))
+    summary = handler.run()
+    for item in summary :
+        print item['table'],item['job_id'],item['state'],item['errors']
+    return 0 if len([1 for item in summary if item['state'] == 'FAILED']) == 0 else 1
+
+def status(sys_args):
+    """
+        This function reports the latest job of every table as recorded by the job tracker (deid-jobs-YYYY-MM-DD.jsonl)
+        and the watermarks of the input/output datasets (if provided)
+    """
+    path    = sys_args['jobs'] if 'jobs' in sys_args else './'
+    records = {}
+    for filename in sorted(glob.glob(os.sep.join([path,'deid-jobs-*.jsonl']))) :
+        f = open(filename)
+        for line in f :
+            if line.strip() == '' :
+                continue
+            record = json.loads(line)
+            if record['name'] not in records or record['date'] >= records[record['name']]['date'] :
+                records[record['name']] = record
+        f.close()
+    for name in sorted(records) :
+        item = records[name]
+        print name,item['date'],item['state'],item['attempts'],item['duration'],item['bytes_processed'],item['job_id'],item['errors'] if item['errors'] else ''
+    if 'i_dataset' in sys_args and 'o_dataset' in sys_args :
+        watermarks = deid.Watermarks(i_dataset=sys_args['i_dataset'],o_dataset=sys_args['o_dataset'],path=sys_args['cache'] if 'cache' in sys_args else deid.CACHE_PATH)
+        for name in sorted(watermarks.cache) :
+            item = watermarks.get(name)
+            print 'watermark',name,item['column'],item['value'],item['updated']
+    return 0 if len([1 for name in records if records[name]['state'] == 'FAILED']) == 0 else 1
+
+COMMANDS = {"plan":plan,"run":run,"status":status}
+if __name__ == '__main__' :
+    if len(sys.argv) < 2 or sys.argv[1] not in COMMANDS :
+        print __doc__
+        sys.exit(2)
+    #
+    # The arguments are parsed after the sub-command i.e python cli.py <command> --key value ...
+    #
+    sys.exit(COMMANDS[sys.argv[1]](deid.get_sys_args(sys.argv[1:])))
@@ -42,9 +42,58 @@
         pip install -r requirements.txt
     python deid.py --i_datase <input_dataset> --table <table_name> --o_dataset <output_dataset>
 
+    To de-identify several tables (or the whole dataset when --tables is omitted) in a single run :
+    python deid.py --i_dataset <input_dataset> --tables <table_1,table_2> --o_dataset <output_dataset> --pool <max concurrent submissions> [--max_jobs 50]
+    The seeding table, the staging tables and the tables are built in the order of their dependencies (see Scheduler),
+    at most max_jobs jobs run at once and a failure only cancels the tables that depend on it.
+
+    To run the queries locally (duckdb) against parquet/csv files, one folder per dataset and one file per table (see engine.py) :
+    python deid.py --engine local --data <folder> --i_dataset <input_dataset> --o_dataset <output_dataset> --config path-of-config.json
+
+    To estimate the bytes processed by every table without running anything (dry-run) :
+    python deid.py --i_dataset <input_dataset> [--tables <table_1,table_2>] --o_dataset <output_dataset> --config path-of-config.json --plan
+
+    To print the queries with a per-field seed lookup and with a hoisted seed join side by side (nothing is submitted) :
+    python deid.py --i_dataset <input_dataset> --table <table_name> --config path-of-config.json --compare
+
+    Every run records its jobs in a manifest (query hash, job id, state, last modification of the destination), an interrupted run can be resumed :
+    the tables already completed with the same query are kept and the jobs still running are reattached to rather than resubmitted
+    python deid.py --i_dataset <input_dataset> --o_dataset <output_dataset> --config path-of-config.json [--manifest <file>]
+    python deid.py --i_dataset <input_dataset> --o_dataset <output_dataset> --config path-of-config.json --resume [<manifest>]
+
+    The output tables are partitioned and clustered as specified in the configuration (see Orchestrator.get_layout) e.g :
+    {"layout":{"observation":{"partition":"observation_date","partition_type":"MONTH","cluster":["person_id","observation_source_concept_id"]}}}
+
+    To de-identify only the rows added since the last run (per-table watermark on <table>_id) and append (or merge) them into the output tables :
+    python deid.py --i_dataset <input_dataset> --o_dataset <output_dataset> --config path-of-config.json --incremental [--mode append|merge]
+
+    To split the query of the tables with a person_id into N jobs (by person), each shard is retried on its own and the shards are combined at the end :
+    python deid.py --i_dataset <input_dataset> --tables observation,measurement --o_dataset <output_dataset> --config path-of-config.json --shards 8
+
+    To de-identify the meta tables (observation) in a single scan rather than a union of scans per category, and to check both give the same rows :
+    python deid.py --i_dataset <input_dataset> --o_dataset <output_dataset> --config path-of-config.json --singlepass
+    python deid.py --i_dataset <input_dataset> --table observation --config path-of-config.json --verify
+
+    To compute the seeds as a keyed hash of person_id (no people_seed table), the secret is read from a file or the DEID_SALT environment variable.
+    The secret is passed to bigquery as a query parameter (@salt), it is never part of the queries (job history, --compare, persisted plans).
+    The seeds of people_seed are frozen first (once) so that the dates already published don't change :
+    python deid.py --i_dataset <input_dataset> --config path-of-config.json --migrate
+    python deid.py --i_dataset <input_dataset> --o_dataset <output_dataset> --config path-of-config.json --salt <file>
+
+    To de-identify a cohort only (a file of person_id, one per line, or a table <dataset>.<table> with a person_id column),
+    the people of the cohort are selected by every scan of the input tables rather than by a filter of the result-set (see Cohort) :
+    python deid.py --i_dataset <input_dataset> --o_dataset <output_dataset> --config path-of-config.json --cohort <file|dataset.table>
+
+    The compiled queries are persisted (see PlanCache), a rerun on an unchanged dataset submits them without planning anything.
+    To rebuild them regardless, and to list the persisted queries that are stale (schema, configuration, concepts or code changed) :
+    python deid.py --i_dataset <input_dataset> --o_dataset <output_dataset> --config path-of-config.json --replan
+    python deid.py --i_dataset <input_dataset> --config path-of-config.json --stale
+
+    The same tasks are available as sub-commands (plan, run, status) in cli.py, a plan can be compiled offline from the local caches (see cli.py)
+
 @TODO: 
     - Improve the logs (make sure they're expressive and usable for mining)
-    - Limitations append an existing table isn't yet supported
+    - Limitations an increment doesn't revisit the rows already published (e.g a person becoming multi-racial or crossing the age limit)
     
     
     
@@ -52,52 +101,307 @@
 from __future__ import division
 import sys
 import json
-import logging
-from google.cloud import bigquery as bq
+import copy
+import re
+import atexit
+import hashlib
+import importlib
+import fnmatch
+import concurrent.futures
+from concurrent.futures import ThreadPoolExecutor
+from threading import Lock
+from collections import namedtuple
+from contextlib import contextmanager
+from query import Table, Select, Union, Except, Join, In, Compiler
 from datetime import datetime
+import time
 import os
 
+class LazyModule :
+    """
+        This class defers the import of a (heavy) module until one of its attributes is used,
+        planning from the local caches doesn't need the cloud client nor pandas and shouldn't pay for importing them
+        e.g :
+            bq = LazyModule('google.cloud.bigquery')
+            bq.QueryJobConfig()     #-- google.cloud.bigquery is imported here
+    """
+    def __init__(self,name):
+        self.__dict__['_name'] = name
+        self.__dict__['_module'] = None
+    def __getattr__(self,name):
+        if self._module is None :
+            self.__dict__['_module'] = importlib.import_module(self._name)
+        return getattr(self._module,name)
+bq = LazyModule('google.cloud.bigquery')
+pd = LazyModule('pandas')
+
+def get_sys_args(argv):
+    """
+        This function parses the arguments of the command line {key:value}, a flag without a value is set to 1
+        e.g : ['deid.py','--i_dataset','raw','--replan']    #-- {"i_dataset":"raw","replan":1}
+        @param argv list of arguments, the first one (program or sub-command) is ignored
+    """
+    r = {}
+    N = len(argv)
+    for i in range(1,N):
+        value = None
+        if argv[i].startswith('--'):
+            key = argv[i].replace('-','')
+            r[key] = 1
+            if i + 1 < N and argv[i+1].startswith('--') is False:
+                value = argv[i + 1] = argv[i+1].strip()
+            if key and value:
+                r[key] = value
+    return r
 #
 # Let's process the arguments passed in via the command-line
 # We expect the program to be run as follows : python deid.py --i_dataset <input_dataset> --table <table_name> --config path-of-config.json --log
 #
-SYS_ARGS = {}
-if len(sys.argv) > 1:
-	
-	N = len(sys.argv)
-	for i in range(1,N):
-		value = None
-		if sys.argv[i].startswith('--'):
-			key = sys.argv[i].replace('-','')
-			SYS_ARGS[key] = 1
-			if i + 1 < N and sys.argv[i+1].startswith('--') is False:
-				value = sys.argv[i + 1] = sys.argv[i+1].strip()
-			if key and value:
-				SYS_ARGS[key] = value
-		
-		i += 2
+SYS_ARGS = get_sys_args(sys.argv)
+#
+# Location of the local caches (concepts, ...)
+#
+CACHE_PATH = os.sep.join([os.path.expanduser('~'),'.deid','cache'])
+
+def set_job_layout(job,partition=None,partition_type='DAY',cluster=None):
+    """
+        This function sets the layout of the table a query job writes (time partitioning and clustering)
+        @param job              configuration of the query job (bq.QueryJobConfig)
+        @param partition        date field the table is partitioned by (optional)
+        @param partition_type   granularity of the partitions DAY|MONTH|... (default DAY)
+        @param cluster          fields the table is clustered by (optional)
+    """
+    if partition is not None :
+        if hasattr(job,'time_partitioning') :
+            job.time_partitioning = bq.TimePartitioning(type_=partition_type,field=partition)
+        elif 'query' in getattr(job,'_properties',{}) :
+            #
+            # @NOTE: google-cloud-bigquery==1.0.0 (see requirements.txt) has no time_partitioning attribute, the resource of the job is set instead
+            #
+            job._properties['query']['timePartitioning'] = {"type":partition_type,"field":partition}
+    if cluster :
+        if hasattr(job,'clustering_fields') :
+            job.clustering_fields = list(cluster)
+        elif 'query' in getattr(job,'_properties',{}) :
+            #
+            # @NOTE: google-cloud-bigquery==1.0.0 (see requirements.txt) has no clustering_fields attribute
+            #
+            job._properties['query']['clustering'] = {"fields":list(cluster)}
 class Logging:
     """
-        This class will perform a basic logging against a file, 
+        This class performs a buffered logging (JSON-lines) against a file,
         if no --log is specified in the SYS_ARGS then the log function will just print
+        The logger is configured once (first call), the rows are written by batches (and when the program exits).
+        Blocks of code can be timed with spans, the durations are aggregated per phase (latency profile of a run)
+        e.g :
+            with span('dropfields.can_do',table='observation') :
+                ...
+            Logging.profile()   #-- {"dropfields.can_do":{"count":..,"total":..,"max":..}}
         @TODO: 
         Logging for other areas endpoint, database, ...
     """
+    BUFFER  = []
+    SIZE    = 256
+    PROFILE = {}
+    LOCK    = Lock()
+    HANDLE  = None
+    READY   = False
     @staticmethod
-    def log(**args):
-        name = datetime.now().strftime('deid-%Y-%m-%d.log')
-        
-        date = json.loads(datetime.now().strftime('{"year":%Y,"month":"%m","day":"%d","hour":"%H","min":"%M"}'))
-        row = json.dumps(dict(date,**args))
-        row = json.dumps(args)
-        if 'log' in SYS_ARGS  :
+    def init():
+        """
+            This function configures the logger (once) : the file the rows are written to if --log is specified
+        """
+        if 'log' in SYS_ARGS :
             path = './' if SYS_ARGS['log'] == 1 else SYS_ARGS['log']
-            filename = os.sep.join([path,name])
-            logging.basicConfig(filename=filename,level=logging.INFO,format='%(message)s')            
-            logging.info(row)
-        else:
-            print (row)
-        
+            Logging.HANDLE = open(os.sep.join([path,datetime.now().strftime('deid-%Y-%m-%d.log')]),'a')
+        atexit.register(Logging.flush)
+        Logging.READY = True
+    @staticmethod
+    def log(**args):
+        row = json.dumps(dict(args,date=datetime.now().isoformat()),default=str)
+        Logging.LOCK.acquire()
+        try:
+            if not Logging.READY :
+                Logging.init()
+            if Logging.HANDLE is None :
+                print (row)
+            else:
+                Logging.BUFFER.append(row)
+                if len(Logging.BUFFER) >= Logging.SIZE :
+                    Logging.write()
+        finally:
+            Logging.LOCK.release()
+    @staticmethod
+    def write():
+        Logging.HANDLE.write("\n".join(Logging.BUFFER)+"\n")
+        Logging.HANDLE.flush()
+        Logging.BUFFER = []
+    @staticmethod
+    def flush():
+        """
+            This function writes the buffered rows to the log file
+        """
+        Logging.LOCK.acquire()
+        try:
+            if Logging.HANDLE is not None and Logging.BUFFER :
+                Logging.write()
+        finally:
+            Logging.LOCK.release()
+    @staticmethod
+    @contextmanager
+    def span(name,**args):
+        """
+            This function times a block of code, the duration is logged and added to the profile of the phase
+            @param name     name of the phase (e.g dropfields.can_do)
+            @param args     attributes of the span (e.g table)
+        """
+        start = time.time()
+        try:
+            yield
+        finally:
+            duration = (time.time() - start) * 1000
+            Logging.LOCK.acquire()
+            try:
+                item = Logging.PROFILE.setdefault(name,{"count":0,"total":0.0,"max":0.0})
+                item['count'] += 1
+                item['total'] += duration
+                item['max'] = max(item['max'],duration)
+            finally:
+                Logging.LOCK.release()
+            Logging.log(subject='span',object=name,action='done',value=dict(args,ms=round(duration,3)))
+    @staticmethod
+    def profile():
+        """
+            This function returns the latency profile of the run (milli-seconds) {phase:{count,total,mean,max}}
+        """
+        Logging.LOCK.acquire()
+        try:
+            return dict([(name,dict(item,total=round(item['total'],3),max=round(item['max'],3),mean=round(item['total']/item['count'],3))) for name,item in Logging.PROFILE.items()])
+        finally:
+            Logging.LOCK.release()
+span = Logging.span
+#
+# Minimal representation of a field of a table (as needed by the policies)
+#
+Field = namedtuple('Field',['name','field_type','mode'])
+class SchemaRegistry :
+    """
+        This class holds the schemas of the tables of a dataset, it is shared by every policy (Shift, DropFields, ...) and the composer.
+        The schemas of an entire dataset are fetched in a single sweep (list_tables + concurrent get_table) and persisted locally.
+        A persisted schema is replaced when the etag (or last modification) of its table changes, every table is checked once per process (see get).
+        e.g :
+            registry = SchemaRegistry(client=client)
+            registry.prefetch('raw')
+            registry.get('raw','observation')['schema']
+    """
+    CACHE = {}
+    VALIDATED = set()
+    LOCK = Lock()
+    def __init__(self,**args):
+        """
+            @param client   initialized big query client, without a client only the persisted schemas are used (offline)
+            @param path     folder where the schemas are persisted (default ~/.deid/cache)
+            @param pool     number of concurrent get_table calls when prefetching (default 16)
+        """
+        self.client = args['client'] if 'client' in args else None
+        self.path   = args['path'] if 'path' in args else CACHE_PATH
+        self.pool   = int(args['pool']) if 'pool' in args else 16
+    def get_filename(self,dataset):
+        return os.sep.join([self.path,"schemas-:dataset.json".replace(":dataset",dataset)])
+    def load(self,dataset):
+        """
+            This function loads the persisted schemas of a dataset in memory (if any)
+        """
+        filename = self.get_filename(dataset)
+        SchemaRegistry.LOCK.acquire()
+        try:
+            if dataset not in SchemaRegistry.CACHE :
+                SchemaRegistry.CACHE[dataset] = {}
+                if os.path.exists(filename) :
+                    f = open(filename)
+                    tables = json.loads(f.read())
+                    f.close()
+                    for name in tables :
+                        tables[name]['schema'] = [Field(*field) for field in tables[name]['schema']]
+                    SchemaRegistry.CACHE[dataset] = tables
+        finally:
+            SchemaRegistry.LOCK.release()
+        return SchemaRegistry.CACHE[dataset]
+    def save(self,dataset):
+        """
+            This function persists the schemas of a dataset
+        """
+        if not os.path.exists(self.path) :
+            os.makedirs(self.path)
+        SchemaRegistry.LOCK.acquire()
+        try:
+            tables = {}
+            for name,info in SchemaRegistry.CACHE[dataset].items() :
+                tables[name] = dict(info,schema=[list(field) for field in info['schema']])
+            f = open(self.get_filename(dataset),'w')
+            f.write(json.dumps(tables))
+            f.close()
+        finally:
+            SchemaRegistry.LOCK.release()
+    def fetch(self,dataset,table):
+        """
+            This function retrieves the metadata of a table from bigquery and updates the registry
+        """
+        info = self.client.get_table(self.client.dataset(dataset).table(table))
+        entry = {
+            "etag":info.etag,
+            "modified":info.modified.isoformat() if info.modified is not None else None,
+            "num_rows":info.num_rows,
+            "schema":[Field(field.name,field.field_type,field.mode) for field in info.schema]
+        }
+        tables = self.load(dataset)
+        if table not in tables or tables[table]['etag'] != entry['etag'] or tables[table]['modified'] != entry['modified'] :
+            Logging.log(subject='registry',object=".".join([dataset,table]),action='refresh',value=entry['etag'])
+        tables[table] = entry
+        SchemaRegistry.VALIDATED.add((dataset,table))
+        return entry
+    def prefetch(self,dataset):
+        """
+            This function performs a metadata sweep of a dataset : one list_tables and concurrent get_table calls
+            The function returns the list of tables of the dataset
+        """
+        tables = [item.table_id for item in self.client.list_tables(self.client.dataset(dataset))]
+        pool = ThreadPoolExecutor(max_workers=max(1,min(self.pool,len(tables))))
+        list(pool.map(lambda table: self.fetch(dataset,table),tables))
+        pool.shutdown(wait=True)
+        #
+        # Tables that no longer exist are removed from the registry
+        #
+        cache = self.load(dataset)
+        for name in list(cache.keys()) :
+            if name not in tables :
+                del cache[name]
+        self.save(dataset)
+        Logging.log(subject='registry',object=dataset,action='prefetch',value=len(tables))
+        return tables
+    def get(self,dataset,table,offline=False):
+        """
+            This function returns the metadata of a table {etag,modified,num_rows,schema}
+            A persisted entry is revalidated against bigquery (get_table) the first time it is used by the process, unless it was prefetched
+            @param dataset  name of the dataset
+            @param table    name of the table
+            @param offline  only use the registry (no call to bigquery)
+        """
+        tables = self.load(dataset)
+        if table not in tables and (offline or self.client is None) :
+            raise KeyError(".".join([dataset,table]) + " isn't in the schema registry")
+        if not offline and self.client is not None and (dataset,table) not in SchemaRegistry.VALIDATED :
+            self.fetch(dataset,table)
+            self.save(dataset)
+        return tables[table]
+    def get_schema(self,dataset,table):
+        return self.get(dataset,table)['schema']
+    def get_tables(self,dataset):
+        """
+            This function returns the tables of a dataset known to the registry
+        """
+        return sorted(self.load(dataset).keys())
+
 class Policy :
     """
         This function will apply Policies given the fields found on a given table
@@ -134,9 +438,10 @@ class Policy :
             self.client = bq.Client.from_service_account_json(args['path'])
         self.vocabulary_id = args['vocabulary_id'] if 'vocabulary_id' in args else 'PPI'
         self.concept_class_id = args['concept_class_id'] if 'concept_class_id' in args else ['Question','PPI Modifier']
+        self.registry = args['registry'] if 'registry' in args else SchemaRegistry(client=self.client)
         if isinstance(self.concept_class_id,str):
             self.concept_class_id = self.concept_class_id.split(",")            
-        Logging.log(subject=self.name(),action='init',object=self.client.project,value=[])
+        Logging.log(subject=self.name(),action='init',object=self.client.project if self.client is not None else None,value=[])
 
     def can_do(self,id,meta):
         return False
@@ -155,11 +460,31 @@ class Shift (Policy):
                 - For physical date fields a JOIN
                 - For meta fields a UNION
                 
-        
+        The seed of a person is joined once per scan of a table (see get_seed_join) and every shifted field reads it from there.
+        The former correlated sub-query per shifted field is still available with hoist=False (for comparison purposes)
+
+        When a salt is provided the seed of a person is a keyed hash of the person_id (see get_hash), it is computed inline :
+        there is no seeding table to build, look up or check for coverage and the queries are the same from one run to the next.
+        The salt is a query parameter (@salt) of the jobs, see Orchestrator.get_parameters
+        The seeds migrated from people_seed (see migrate_seeds) take precedence so the releases already published remain consistent.
+        @NOTE: the seeds of people_seed are the number of days since consent plus [0,SEED_RANGE) days (see initialization) whereas the
+        keyed-hash seeds are in [0,SEED_RANGE) days. With frozen seeds, the people of people_seed_frozen are shifted much further back
+        than the people who joined since (keyed-hash seeds), the shift of a person isn't comparable to that of another.
     """
+    SEED_RANGE  = 700
+    FROZEN      = 'people_seed_frozen'
     def __init__(self,**args):
+        """
+            @param hoist    join the seed once per query rather than looking it up for every shifted field (default True)
+            @param salt     secret of the keyed hash of the seeds, the people_seed table is used if none is provided (optional)
+            @param frozen   the seeds migrated from people_seed are used for the people they cover (default False)
+            @param cohort   only the seeds of the people of the cohort are looked up, see Cohort (optional)
+        """
         Policy.__init__(self,**args)
-        
+        self.hoist = args['hoist'] if 'hoist' in args else True
+        self.salt  = args['salt'] if 'salt' in args else None
+        self.frozen= args['frozen'] if 'frozen' in args else False
+        self.cohort= args['cohort'] if 'cohort' in args else None
         self.concept_sql = """
                 SELECT concept_code from :dataset.concept
                 WHERE vocabulary_id = ':vocabulary_id' AND REGEXP_CONTAINS(concept_code,'(Date|DATE|date)') is TRUE
@@ -178,8 +503,7 @@ class Shift (Policy):
         name = ".".join([dataset,table])
         if name not in self.cache :
             try:
-                ref = self.client.dataset(dataset).table(table)
-                info = self.client.get_table(ref).schema
+                info = self.registry.get_schema(dataset,table)
                 fields = [field for field in info if field.field_type in ('DATE','TIMESTAMP','DATETIME')]
                 p = len(fields) > 0 #-- do we have physical fields as concepts
                 q = table in Policy.META_TABLES
@@ -189,7 +513,7 @@ class Shift (Policy):
                 self.cache[name] = p or q
                 joined_fields = [field.name for field in fields]
                 if self.cache[name] == True :
-                    self.policies[name] = {"join":{"sql":None,"fields":joined_fields,"shifted_values":sql_fields}}
+                    self.policies[name] = {"join":{"sql":None,"fields":joined_fields,"shifted_values":sql_fields,"seed":self.get_seed_join(dataset,table)}}
 
                 if q :
                    
@@ -214,18 +538,17 @@ class Shift (Policy):
                     #     date_sub((SELECT CAST(value_as_string as DATE) FROM :i_dataset.observation ii where ii.person_id = person_id and observation_source_value='ExtraConsent_TodaysDate' limit 1) , INTERVAL 
                     #     date_diff(:name, (SELECT seed from :i_dataset.people_seed ii where ii.person_id = person_id), DAY) DAY) AS STRING) as :name
                     # """.replace(":name","value_as_string")
-                    shifted_date = """CAST( DATE_SUB( CAST(:name AS DATE), INTERVAL (SELECT seed from :i_dataset.people_seed xii WHERE xii.person_id = :table.person_id) DAY) AS STRING) as :name"""
-                    shifted_date = shifted_date.replace(":name","value_as_string").replace(":i_dataset",dataset).replace(":table","x")
+                    shifted_date = """CAST( DATE_SUB( CAST(:name AS DATE), INTERVAL :seed DAY) AS STRING) as :name"""
+                    shifted_date = shifted_date.replace(":seed",self.get_seed(dataset,"x")).replace(":name","value_as_string")
                     sql_fields = self.__get_shifted_fields(fields,dataset,"x")
                     #--AND person_id = 562270
                     sql_filter = "|".join(Policy.TERMS.OBSERVATION_FILTERS.values())
-                    _sql = """
-                    SELECT :shifted_date,person_id, :shifted_fields :fields
-                    FROM :i_dataset.observation x where observation_source_value in (
-                        SELECT concept_code from :i_dataset.concept WHERE REGEXP_CONTAINS(concept_code,'Date|DATE|date') IS TRUE
-                        AND REGEXP_CONTAINS(concept_code,'(:filter)') IS FALSE
-                    )
-                    """.replace(":i_dataset",dataset).replace(":shifted_fields",",".join(sql_fields)).replace(":shifted_date",shifted_date).replace(":filter",sql_filter)
+                    #
+                    # The fields that are neither shifted nor the person are added by the composer
+                    #
+                    concepts = Select(fields=['concept_code'],source=Table(dataset,'concept'),where=["REGEXP_CONTAINS(concept_code,'Date|DATE|date') IS TRUE","REGEXP_CONTAINS(concept_code,'(:filter)') IS FALSE".replace(":filter",sql_filter)])
+                    seed_join = self.get_seed_join(dataset,"x")
+                    _sql = Select(fields=[shifted_date,'person_id']+sql_fields,source=Table(dataset,'observation'),alias='x',joins=[seed_join] if seed_join is not None else [],where=[In(field='observation_source_value',query=concepts)])
                     
                     # _sql = """
                     
@@ -247,7 +570,7 @@ class Shift (Policy):
                          
                     # """.replace(":i_dataset",dataset).replace(":shifted_fields",",".join(sql_fields))
                     
-                    self.policies[name]["union"] = {"sql":_sql,"fields":union_fields,"shifted_values":sql_fields}
+                    self.policies[name]["union"] = {"query":_sql,"fields":union_fields,"shifted_values":sql_fields}
                     
                     # self.policies[name]['meta'] = 'foo'
                 #
@@ -260,6 +583,55 @@ class Shift (Policy):
                 Logging.log(subject=self.name(),object=name,action='error.can_do',value=e.message)
         
         return self.cache[name]
+    @staticmethod
+    def hash_seed(salt,person_id):
+        """
+            This function computes the seed of a person as get_hash does (bigquery), it is meant for the engines that shift dates outside of bigquery (deid2.py)
+            @param salt         secret of the keyed hash
+            @param person_id    identifier of the person
+        """
+        value = hashlib.sha256((salt + str(int(person_id))).encode('utf-8')).hexdigest()
+        return int(value[:15],16) % Shift.SEED_RANGE
+    def get_hash(self,table):
+        """
+            This function returns the expression of the keyed hash of a person i.e the first 60 bits of SHA256(salt || person_id) bounded to [0,SEED_RANGE)
+            The salt is the query parameter @salt, the query must be submitted with it (see Orchestrator.get_parameters)
+            @param table    name (or alias) of the table in the query
+        """
+        sql = "MOD(CAST(CONCAT('0x',SUBSTR(TO_HEX(SHA256(CONCAT(@salt,CAST(:table.person_id AS STRING)))),1,15)) AS INT64),:range)"
+        return sql.replace(":table",table).replace(":range",str(Shift.SEED_RANGE))
+    def get_seed(self,dataset,table):
+        """
+            This function returns the expression of the seed of a person given the alias of the table being shifted
+            @param dataset  name of the dataset
+            @param table    name (or alias) of the table in the query
+        """
+        seeds = Shift.FROZEN if self.salt is not None else 'people_seed'
+        if self.salt is not None and self.frozen == False :
+            return self.get_hash(table)
+        if self.hoist :
+            seed = "xii.seed"
+        else:
+            seed = "(SELECT seed from :i_dataset.:seeds xii WHERE xii.person_id = :table.person_id)".replace(":i_dataset",dataset).replace(":seeds",seeds).replace(":table",table)
+        return "COALESCE(:seed,:hash)".replace(":seed",seed).replace(":hash",self.get_hash(table)) if self.salt is not None else seed
+    def get_seed_join(self,dataset,table):
+        """
+            This function returns the join that brings the seed of a person in a query (None if the seed isn't hoisted or is computed inline)
+            The seed lookup is the same sub-query for every scan, the compiler defines it once (WITH seeds AS ...)
+            The seeding table can hold more than a seed per person (e.g two answers to ExtraConsent_TodaysDate, see initialization),
+            the lookup keeps one seed per person (as migrate_seeds does) so that a join never duplicates the rows of a person
+            @param dataset  name of the dataset
+            @param table    name (or alias) of the table in the query
+        """
+        if self.salt is not None and self.frozen == False :
+            return None
+        if self.hoist :
+            seeds = Select(fields=['person_id AS seed_person_id','MAX(seed) AS seed'],source=Table(dataset,Shift.FROZEN if self.salt is not None else 'people_seed'),group=['person_id'],name='seeds')
+            if self.cohort is not None :
+                seeds.where = self.cohort.get_filters()
+            return Join(source=seeds,alias='xii',on='xii.seed_person_id = :table.person_id'.replace(':table',table))
+        else:
+            return None
     def __get_shifted_fields(self,fields,dataset,table):
         """
             This function should be used for relational fields only !!
@@ -280,8 +652,8 @@ class Shift (Policy):
             # """.replace(':name',field.name).replace(":year",str(year)).replace(":month",str(month)).replace(":day",str(day))
            
             shifted_field = """
-               DATE_SUB( CAST(:name AS DATE), INTERVAL (SELECT seed from :i_dataset.people_seed xii WHERE xii.person_id = :table.person_id) DAY) as :name
-            """.replace(":name",field.name).replace(":table",table).replace(":i_dataset",dataset)
+               DATE_SUB( CAST(:name AS DATE), INTERVAL :seed DAY) as :name
+            """.replace(":seed",self.get_seed(dataset,table)).replace(":name",field.name)
             # shifted_field = shifted_field.replace(":name",field.name).replace(":i_dataset",dataset)
             r.append(shifted_field)
         Logging.log(subject=self.name(),action='shifting.dates',object=[field.name for field in fields],value=[field.name for field in fields])   
@@ -310,8 +682,16 @@ class DropFields(Policy):
             @param vocabulary_id        vocabulary identifier by default PPI
             @param concept_class_id     identifier of the category of the concept by default ['PPI', 'PPI Modifier']
             @param fields   list of fields that need to be dropped/suppressed from the database
+            @param concepts concept resolver used by the generalizations, see Concepts
+            @param staging  materialized per-person sets used by the generalizations, see Staging (optional)
+            @param single_pass  meta tables are processed in a single scan rather than a union of scans per category (default False)
+            @param shift    date shifting policy, needed by the single pass to shift the dates stored as values (see get_single_pass)
         """
         Policy.__init__(self,**args)
+        self.concepts = args['concepts'] if 'concepts' in args else Concepts(client=self.client)
+        self.staging  = args['staging'] if 'staging' in args else None
+        self.single_pass = args['single_pass'] if 'single_pass' in args else False
+        self.shift    = args['shift'] if 'shift' in args else None
         # self.fields = args['fields'] if 'fields' in args else []
         self.remove = args['remove'] if 'remove' in args else []
         
@@ -320,8 +700,7 @@ class DropFields(Policy):
         
         if name not in self.cache :
             try:
-                ref     = self.client.dataset(dataset).table(table)
-                schema  = self.client.get_table(ref).schema
+                schema  = self.registry.get_schema(dataset,table)
                 gsql    = None
                 #
                 # we have here the opportunity to have both columns removed and rows removed
@@ -336,19 +715,20 @@ class DropFields(Policy):
                 q = table in Policy.META_TABLES #-- Are we dealing with a meta table               
 
                 self.cache[name] = p or q                
-                sql = """
-                    SELECT :fields :shifted_date_columns
-                    FROM :i_dataset.:table
-                """
+                #
+                # The scans of the table (branches) are completed by the composer with the shifted dates and the seed join
+                #
+                sql = Select(fields=[],source=Table(dataset,table))
+                branches = [sql]
                 
                 if p :
                     # _fields = [field.name for field in schema if field.name not in self.fields] #--fields that will be part of the projection
                     _fields = [field.name for field in schema if field.name not in remove_cols] 
                     lfields = list(_fields)
-                    _fields = ",".join(_fields)
                 else:
-                    _fields = "*"
+                    _fields = ["*"]
                     lfields = [field.name for field in schema]
+                sql.fields = list(_fields)
                 #
                 # @Log: We are logging here the operaton that is expected to take place
                 # {"action":"drop-fields","input":self.remove,"subject":table,"object":"columns"}
@@ -367,49 +747,38 @@ class DropFields(Policy):
                     # {"action":"drop-fields","input":sql_filter,"subject":table,"object":"rows"}
                     
                     # filter = 'Date|Gender|Race|Ethnicity|Employment|Orientation|Education'
-                    sql = sql + """
-
-                        WHERE observation_source_concept_id in (
-                            SELECT concept_id 
-                            FROM :i_dataset.concept 
-                            WHERE vocabulary_id = ':vocabulary_id' AND concept_class_id in (:code)
-                            
-                            AND REGEXP_CONTAINS(concept_code,'(:filter)') IS FALSE
-                        )
-
-                       
-                    """.replace(":code",codes).replace(":vocabulary_id",self.vocabulary_id).replace(":filter",sql_filter)
+                    concepts = Select(fields=['concept_id'],source=Table(dataset,'concept'),where=[
+                        "vocabulary_id = ':vocabulary_id' AND concept_class_id in (:code)".replace(":code",codes).replace(":vocabulary_id",self.vocabulary_id),
+                        "REGEXP_CONTAINS(concept_code,'(:filter)') IS FALSE".replace(":filter",sql_filter)
+                    ])
+                    sql.where.append(In(field='observation_source_concept_id',query=concepts))
                     #
                     #   We are now having to generalize rows that were filtered out (done in a loop)
                     #   These queries will be unioned in the end.
                     #
-                    xsql = [sql]
-                    args = {"client":self.client,"dataset":dataset,"table":table,"fields":_fields,"sql":"","concept_source_id":[],"vocabulary_id":"","concept_class_id":[]}
+                    args = {"client":self.client,"dataset":dataset,"table":table,"fields":_fields,"sql":"","concept_source_id":[],"vocabulary_id":"","concept_class_id":[],"concepts":self.concepts,"staging":self.staging}
                     handler = Group(**args)
+                    categories = {}
                     for key in Policy.TERMS.OBSERVATION_FILTERS :
                         
                         pointer = getattr(handler,key)
-                        r = pointer()
+                        with span("group."+key,table=table) :
+                            r = pointer()
                         
                         if len(r.keys()) > 0 :
+                            categories[key] = {"fields":r,"join":handler.get_join(key)}
                             ofields = [ r[fname] if fname in r else fname for fname in lfields]
                             
-                            _sql_ = "SELECT :fields  :shifted_date_columns FROM :i_dataset.:table WHERE observation_source_concept_id in (SELECT concept_id FROM :i_dataset.concept WHERE REGEXP_CONTAINS(concept_code,'(?i):key')) "
-                            _sql_ = _sql_.replace(":fields",",".join(ofields)).replace(":table",table).replace(":key",key).replace(":i_dataset",dataset)
-                            
-                            xsql.append( " UNION ALL "+_sql_ )
-                    if len(date_cols) is None :
-                        date_cols = ""
-                    else:
-                        date_cols = ","+",".join(date_cols)    
+                            concepts = Select(fields=['concept_id'],source=Table(dataset,'concept'),where=["REGEXP_CONTAINS(concept_code,'(?i):key')".replace(":key",key)])
+                            join = handler.get_join(key)
+                            branches.append(Select(fields=ofields,source=Table(dataset,table),joins=[join] if join is not None else [],where=[In(field='observation_source_concept_id',query=concepts)]))
                     
-                    sql =  " SELECT :fields "+date_cols+" from (" +" ".join(xsql) +")"
+                    sql = Select(fields=lfields+date_cols,source=Union(items=branches))
+                    if self.single_pass and self.shift is not None :
+                        sql = self.get_single_pass(dataset,table,lfields,categories)
+                        branches = [sql]
                     
-                sql = sql.replace(":fields",_fields).replace(":i_dataset",dataset).replace(":table",table)
-                
-                
-                    
-                self.policies[name] = {"sql":sql,"fields":lfields}
+                self.policies[name] = {"query":sql,"fields":lfields,"branches":branches,"single_pass":q and self.single_pass and self.shift is not None}
                 # if gsql is not None:
                 #     self.policies[name]['generalized'] = gsql
                
@@ -419,11 +788,146 @@ class DropFields(Policy):
                 print e
         
         return self.cache [name]
+    def get_categories(self,dataset,keys):
+        """
+            This function returns the mapping of the concepts to the categories of rows of a meta table {concept_id,category}
+            The categories are those of the branches of the union : base (neither generalized nor shifted), one per generalization and date (value shifted)
+            A concept that belongs to several categories yields as many rows (as it does in the union)
+            @param keys     categories subject to generalization
+        """
+        codes = "'"+"','".join(self.concept_class_id)+"'"
+        values = "|".join(Policy.TERMS.OBSERVATION_FILTERS.values())
+        items = [Select(fields=['concept_id',"'base' AS category"],source=Table(dataset,'concept'),where=[
+            "vocabulary_id = ':vocabulary_id' AND concept_class_id in (:code)".replace(":code",codes).replace(":vocabulary_id",self.vocabulary_id),
+            "REGEXP_CONTAINS(concept_code,'(:filter)') IS FALSE".replace(":filter","Date|"+values)
+        ])]
+        for key in keys :
+            items.append(Select(fields=['concept_id',"':key' AS category".replace(":key",key)],source=Table(dataset,'concept'),where=["REGEXP_CONTAINS(concept_code,'(?i):key')".replace(":key",key)]))
+        items.append(Select(fields=['concept_id',"'date' AS category"],source=Table(dataset,'concept'),where=["REGEXP_CONTAINS(concept_code,'Date|DATE|date') IS TRUE","REGEXP_CONTAINS(concept_code,'(:filter)') IS FALSE".replace(":filter",values)]))
+        return Union(items=items,name='categories',hoist=True)
+    def get_single_pass(self,dataset,table,fields,categories):
+        """
+            This function returns the query of a meta table that classifies every row once (join with the concept categories) and applies
+            the generalization or the shift of its category with CASE expressions, the table is scanned once instead of once per category.
+            The result is the same as the union of the branches, with the exception that the rows whose value is a date are identified by
+            their concept (observation_source_concept_id) rather than by their code (observation_source_value), see Orchestrator.verify
+            @param fields       fields of the projection (dates excluded, they are added by the composer)
+            @param categories   {key:{fields,join}} generalizations of the categories
+        """
+        shifted = "CAST( DATE_SUB( CAST(value_as_string AS DATE), INTERVAL :seed DAY) AS STRING)".replace(":seed",self.shift.get_seed(dataset,table))
+        expressions = []
+        for name in fields :
+            cases = []
+            for key in categories :
+                if name in categories[key]['fields'] :
+                    value = re.sub(r'(?i)\s+as\s+'+name+r'\s*$','',categories[key]['fields'][name].strip())
+                    cases.append("WHEN ':key' THEN :value".replace(":key",key).replace(":value",value))
+            if name == 'value_as_string' :
+                cases.append("WHEN 'date' THEN :value".replace(":value",shifted))
+            if cases :
+                expressions.append("CASE cc.category :cases ELSE :name END AS :name".replace(":cases"," ".join(cases)).replace(":name",name))
+            else:
+                expressions.append(name)
+        joins = [Join(kind='INNER',source=self.get_categories(dataset,categories.keys()),alias='cc',on='cc.concept_id = :table.observation_source_concept_id'.replace(":table",table))]
+        joins += [categories[key]['join'] for key in categories if categories[key]['join'] is not None]
+        return Select(fields=expressions,source=Table(dataset,table),joins=joins)
     def get(self,dataset,table):
         name = dataset+"."+table
         return self.policies[name] if name in self.policies else False
 
 
+class Concepts :
+    """
+        This class resolves the concepts needed by the generalizations (see Group) in a single query against the concept table.
+        The result is cached in memory and on disk, the cache is keyed by the dataset and the last modification of its concept table
+        i.e a new version of the concept table will invalidate the cache.
+        e.g :
+            handler = Concepts(client=client)
+            r = handler.get('raw','race')       #-- data-frame of concept_id,concept_code,concept_name
+            r = handler.get_rows('raw','race')  #-- [{"concept_id":..,"concept_code":..,"concept_name":..}]
+    """
+    FILTERS = {
+        "race":"REGEXP_CONTAINS(vocabulary_id,'(PPI|Race)') AND REGEXP_CONTAINS(concept_name,'(White|Black|Asian|Other Race)') is TRUE AND REGEXP_CONTAINS(concept_name,'(Native|Pacific)') is FALSE",
+        "gender":"(vocabulary_id= 'Gender' AND concept_name not in ('FEMALE','MALE') ) OR REGEXP_CONTAINS(concept_code,'_Man|_Woman')",
+        "orientation":"REGEXP_CONTAINS(concept_code, 'Orientation_Straight|Orientation_None')",
+        "education":"concept_code in ('HighestGrade_AdvancedDegree','HighestGrade_CollegeOnetoThree','HighestGrade_TwelveOrGED','HighestGrade_NeverAttended')",
+        "sex_at_birth":"concept_code in ('SexAtBirth_Female', 'SexAtBirth_Male')",
+        "language":"REGEXP_CONTAINS(concept_code,'Language_English')",
+        "employment":"concept_code in ('EmploymentStatus_OutOfWorkOneOrMore','EmploymentStatus_EmployedForWages','EmploymentStatus_OutOfWorkLessThanOne')"
+    }
+    CACHE = {}
+    LOCK = Lock()
+    def __init__(self,**args):
+        """
+            @param client   initialized big query client, without a client only the cached concepts are used (offline)
+            @param path     folder where the concepts are cached (default ~/.deid/cache)
+            @param registry schema registry used to determine the version of the concept table
+        """
+        self.client = args['client']
+        self.path   = args['path'] if 'path' in args else CACHE_PATH
+        self.registry = args['registry'] if 'registry' in args else SchemaRegistry(client=self.client,path=self.path)
+    def get_version(self,dataset):
+        """
+            This function returns the version of the concept table of a dataset i.e its last modification
+        """
+        modified = self.registry.get(dataset,'concept')['modified']
+        return modified.replace('-','').replace(':','').replace('T','').split('.')[0] if modified is not None else '0'
+    def get_filename(self,dataset,version):
+        return os.sep.join([self.path,"concepts-:dataset-:version.json".replace(":dataset",dataset).replace(":version",version)])
+    def load(self,dataset):
+        """
+            This function resolves all the concepts of a dataset: memory, disk and as a last resort bigquery (single query)
+            @param dataset  name of the dataset
+        """
+        version = self.get_version(dataset)
+        key     = ".".join([dataset,version])
+        Concepts.LOCK.acquire()
+        try:
+            if key not in Concepts.CACHE :
+                filename = self.get_filename(dataset,version)
+                if os.path.exists(filename) :
+                    f = open(filename)
+                    rows = json.loads(f.read())
+                    f.close()
+                    Logging.log(subject='concepts',object=dataset,action='cache.hit',value=version)
+                elif self.client is None :
+                    raise KeyError("the concepts of "+dataset+" (version "+version+") aren't cached")
+                else:
+                    #
+                    # Every category is evaluated as a boolean column of a single scan of the concept table
+                    #
+                    keys    = sorted(Concepts.FILTERS.keys())
+                    flags   = ",".join(["(:filter) AS :key".replace(":filter",Concepts.FILTERS[name]).replace(":key",name) for name in keys])
+                    where   = " OR ".join(["("+Concepts.FILTERS[name]+")" for name in keys])
+                    sql     = "SELECT concept_id,concept_code,concept_name,:flags FROM :dataset.concept WHERE :where"
+                    sql     = sql.replace(":flags",flags).replace(":where",where).replace(":dataset",dataset)
+                    df      = self.client.query(sql).to_dataframe()
+                    rows    = []
+                    for row in df.to_dict(orient='records') :
+                        rows.append({"concept_id":int(row['concept_id']),"concept_code":row['concept_code'],"concept_name":row['concept_name'],"categories":[name for name in keys if row[name] == True]})
+                    if not os.path.exists(self.path) :
+                        os.makedirs(self.path)
+                    f = open(filename,'w')
+                    f.write(json.dumps(rows))
+                    f.close()
+                    Logging.log(subject='concepts',object=dataset,action='cache.miss',value=version)
+                Concepts.CACHE[key] = rows
+        finally:
+            Concepts.LOCK.release()
+        return Concepts.CACHE[key]
+    def get_rows(self,dataset,category):
+        """
+            This function returns the concepts of a given category [{concept_id,concept_code,concept_name}]
+            @param dataset  name of the dataset
+            @param category category of the concepts (race, gender, ...) as found in Concepts.FILTERS
+        """
+        return [row for row in self.load(dataset) if category in row['categories']]
+    def get(self,dataset,category):
+        """
+            This function returns the concepts of a given category as a data-frame (concept_id,concept_code,concept_name)
+        """
+        return pd.DataFrame(self.get_rows(dataset,category),columns=['concept_id','concept_code','concept_name'])
+
 class Group(Policy):
     """
         This class performs generalization against the data-model on a given table
@@ -445,8 +949,13 @@ class Group(Policy):
             @param sql      sql query to execute
             @param dataset  dataset subject
             @param table    table (subject of the operation)
+            @param concepts concept resolver (shared across instances), see Concepts
+            @param staging  materialized per-person sets, see Staging (optional)
         """
         Policy.__init__(self,**args)
+        self.concepts   = args['concepts'] if 'concepts' in args else Concepts(client=self.client)
+        self.staging    = args['staging'] if 'staging' in args else None
+        self.joins      = {}
         self.sql        = args['sql']
         self.dataset    = args['dataset']
         self.table      = args['table']
@@ -455,6 +964,12 @@ class Group(Policy):
         else:
             self.fields     = args['fields']
 
+    def get_join(self,name):
+        """
+            This function returns the join needed by the generalization of a given category (None if none is needed)
+            @pre    the generalization function of the category has been called
+        """
+        return self.joins[name] if name in self.joins else None
     def get_fields(self,p):
         """
             This function returns the field list with generalized expressions of the fields
@@ -499,13 +1014,10 @@ class Group(Policy):
         
         field_name = "concept_name" if self.table == 'person' else 'concept_code'
         fields = self.fields 
-        sql = "SELECT concept_id,concept_code,concept_name from :dataset.concept WHERE REGEXP_CONTAINS(vocabulary_id,'(PPI|Race)') AND REGEXP_CONTAINS(concept_name,'(White|Black|Asian|Other Race)') is TRUE AND REGEXP_CONTAINS(concept_name,'(Native|Pacific)') is FALSE"
-        sql = sql.replace(":dataset",self.dataset)
-        r = self.client.query(sql)
-        r = r.to_dataframe()
-        other_id= r[r['concept_name'] == 'Other Race']['concept_id'].tolist()[0]
-        other_name= r[r['concept_name'] == 'Other Race']['concept_name'].tolist()[0]
-        _ids    = [str(value) for value in r[r['concept_name'] != 'Other Race']['concept_id'].tolist()]
+        r = self.concepts.get_rows(self.dataset,'race')
+        other_id= [row['concept_id'] for row in r if row['concept_name'] == 'Other Race'][0]
+        other_name= [row['concept_name'] for row in r if row['concept_name'] == 'Other Race'][0]
+        _ids    = [str(row['concept_id']) for row in r if row['concept_name'] != 'Other Race']
         #
         # Formatting the fields to perform the generalization of the  of the a person
         #
@@ -524,13 +1036,23 @@ class Group(Policy):
             #
             # Let's generalize race and everything that goes with
             # @TODO: Figure out cases for multiple races
-            mr_sql="SELECT person_id from (SELECT COUNT(*), person_id FROM :dataset.:table WHERE observation_source_value like 'Race_%' GROUP BY person_id HAVING COUNT(*) > 1)".replace(":dataset",self.dataset).replace(":table",self.table)
-            p['value_as_string'] = "IF( person_id in (:mr_sql),'Multi-Racial',IF(value_source_concept_id not in (:_ids),':other_name',value_as_string)) as value_as_string".replace(":_ids",_ids).replace(":other_name",other_name).replace(":mr_sql",mr_sql)
-            p['observation_source_concept_id'] = "IF(person_id in (:mr_sql),2000000,IF(value_source_concept_id not in (:_ids),:other_id,observation_source_concept_id)) as observation_source_concept_id".replace(":_ids",_ids).replace(":other_id",other_id).replace(":mr_sql",mr_sql)
+            #
+            # The multi-racial people are brought in with a single semi-join (see Staging), the expressions only test the join
+            # The staging table is used once built by the run, the set is computed by the query itself otherwise (e.g dry-run, verify)
+            #
+            if self.staging is not None and 'people_multi_racial' in self.staging.built :
+                mr_sql = Table(self.staging.dataset,'people_multi_racial')
+            else:
+                filters = self.staging.get_filters() if self.staging is not None else []
+                mr_sql = Select(fields=['person_id'],source=Table(self.dataset,self.table),where=["observation_source_value like 'Race_%'"]+filters,group=['person_id'],having=['COUNT(*) > 1'])
+            self.joins['race'] = Join(source=Select(fields=['person_id AS mr_person_id'],source=mr_sql),alias='mr',on='mr.mr_person_id = :table.person_id'.replace(":table",self.table))
+            mr_sql = "mr.mr_person_id IS NOT NULL"
+            p['value_as_string'] = "IF( :mr_sql,'Multi-Racial',IF(value_source_concept_id not in (:_ids),':other_name',value_as_string)) as value_as_string".replace(":_ids",_ids).replace(":other_name",other_name).replace(":mr_sql",mr_sql)
+            p['observation_source_concept_id'] = "IF(:mr_sql,2000000,IF(value_source_concept_id not in (:_ids),:other_id,observation_source_concept_id)) as observation_source_concept_id".replace(":_ids",_ids).replace(":other_id",other_id).replace(":mr_sql",mr_sql)
             # p['observation_source_value'] = "IF((SELECT COUNT(*) FROM :dataset.observation z WHERE z.observation_source_value like 'Race_%' AND z.person_id = person_id) > 1,:other_name,IF(value_source_concept_id not in (:_ids), ':other_name',observation_source_value)) as observation_source_value".replace(":_ids",_ids).replace(":other_name",other_name).replace(":dataset",self.dataset)
             # p['value_source_concept_id'] = "IF(value_source_concept_id not in (:_ids), ':other_id',value_source_concept_id) as value_source_concept_id".replace(":_ids",_ids).replace(":other_name",other_name).replace(":dataset",self.dataset)
-            p['value_source_concept_id'] = "IF(person_id in (:mr_sql),2000000,IF(value_source_concept_id not in (:_ids),:other_id,value_source_concept_id)) as value_source_concept_id".replace(":_ids",_ids).replace(":other_id",other_id).replace(":mr_sql",mr_sql)
-            p['value_source_value'] = "IF(person_id in (:mr_sql),'Multi-Racial',IF(value_source_concept_id not in (:_ids), ':other_name',value_source_value)) as value_source_value".replace(":_ids",_ids).replace(":other_name",other_name).replace(":mr_sql",mr_sql)
+            p['value_source_concept_id'] = "IF(:mr_sql,2000000,IF(value_source_concept_id not in (:_ids),:other_id,value_source_concept_id)) as value_source_concept_id".replace(":_ids",_ids).replace(":other_id",other_id).replace(":mr_sql",mr_sql)
+            p['value_source_value'] = "IF(:mr_sql,'Multi-Racial',IF(value_source_concept_id not in (:_ids), ':other_name',value_source_value)) as value_source_value".replace(":_ids",_ids).replace(":other_name",other_name).replace(":mr_sql",mr_sql)
 
            
         return self.get_fields(p)
@@ -548,14 +1070,11 @@ class Group(Policy):
             @param table
             @param fields
         """
-        sql = "SELECT concept_id,concept_name FROM :dataset.concept WHERE (vocabulary_id= 'Gender' AND concept_name not in ('FEMALE','MALE') ) OR REGEXP_CONTAINS(concept_code,'_Man|_Woman')"
-        sql = sql.replace(":dataset",self.dataset)
-        r = self.client.query(sql)
-        r = r.to_dataframe()
+        r = self.concepts.get_rows(self.dataset,'gender')
         
-        other_id = str(r[r['concept_name']=='OTHER']['concept_id'].values[0])                        #--
-        other_name = r[r['concept_name']=='OTHER']['concept_name'].values[0]                      #--
-        _ids =",".join([str(value) for value in r[r['concept_name']!='OTHER']['concept_id'].tolist()])    #-- ids to generalize
+        other_id = str([row['concept_id'] for row in r if row['concept_name']=='OTHER'][0])                        #--
+        other_name = [row['concept_name'] for row in r if row['concept_name']=='OTHER'][0]                      #--
+        _ids =",".join([str(row['concept_id']) for row in r if row['concept_name']!='OTHER'])    #-- ids to generalize
         fields = self.fields #args['fields']
         
         p = {}
@@ -604,16 +1123,13 @@ class Group(Policy):
             This function will generalize sexual orientation on the observation table, this only applies to the observation table (for now)
             @filter    TheBasics_SexualOrientation
         """
-        sql = "SELECT concept_id,concept_code,concept_name from :dataset.concept where REGEXP_CONTAINS(concept_code, 'Orientation_Straight|Orientation_None')"
-        sql = sql.replace(":dataset",self.dataset)
-        r = self.client.query(sql)
-        r = r.to_dataframe()
+        r = self.concepts.get_rows(self.dataset,'orientation')
        
-        other_id = str(r[r['concept_code'] == Policy.TERMS.SEXUAL_ORIENTATION_NOT_STRAIGHT]['concept_id'].tolist()[0])                        #--
+        other_id = str([row['concept_id'] for row in r if row['concept_code'] == Policy.TERMS.SEXUAL_ORIENTATION_NOT_STRAIGHT][0])                        #--
     
-        other_name = r[r['concept_code']==Policy.TERMS.SEXUAL_ORIENTATION_NOT_STRAIGHT]['concept_code'].tolist()[0]  
+        other_name = [row['concept_code'] for row in r if row['concept_code']==Policy.TERMS.SEXUAL_ORIENTATION_NOT_STRAIGHT][0]  
         #                     #--
-        _ids =[str(value) for value in r[r['concept_code'] ==Policy.TERMS.SEXUAL_ORIENTATION_STRAIGHT]['concept_id'].tolist()]    #-- ids to generalize
+        _ids =[str(row['concept_id']) for row in r if row['concept_code'] ==Policy.TERMS.SEXUAL_ORIENTATION_STRAIGHT]    #-- ids to generalize
         
         fields = self.fields
         
@@ -624,13 +1140,10 @@ class Group(Policy):
             @TODO:
             The data curation team should add this in the concept table (put in a request with Mark or Chun Yee)
         """
-        sql = "SELECT concept_id,concept_code,concept_name from :dataset.concept WHERE concept_code in ('HighestGrade_AdvancedDegree','HighestGrade_CollegeOnetoThree','HighestGrade_TwelveOrGED','HighestGrade_NeverAttended')"        
         other_id = '0'
         other_name = 'Unknown'
-        sql = sql.replace(":dataset",self.dataset)
-        r = self.client.query(sql)
-        r = r.to_dataframe()        
-        _ids = [str(value) for value in r['concept_id'].tolist()]
+        r = self.concepts.get_rows(self.dataset,'education')
+        _ids = [str(row['concept_id']) for row in r]
         
         return self.__get_formatted_observations(_ids,other_name,other_id)
     def sex_at_birth(self):
@@ -638,13 +1151,10 @@ class Group(Policy):
             This function will perform sex at birth generalization against the observation table
             @filter value_source_concept_id in (SELECT concept_id from :dataset.concept WHERE concept_code = 'BiologicalSexAtBirth_SexAtBirth')
         """
-        sql = "SELECT concept_id,concept_code,concept_name from :dataset.concept WHERE  concept_code in ('SexAtBirth_Female', 'SexAtBirth_Male')"
         other_id = '0'
         other_name = 'Unknown'
-        sql = sql.replace(":dataset",self.dataset)
-        r = self.client.query(sql)
-        r = r.to_dataframe()        
-        _ids = [str(value) for value in r['concept_id'].tolist()]
+        r = self.concepts.get_rows(self.dataset,'sex_at_birth')
+        _ids = [str(row['concept_id']) for row in r]
         
         return self.__get_formatted_observations(_ids,other_name,other_id)
 
@@ -652,13 +1162,10 @@ class Group(Policy):
         """
             filter by SpokenWrittenLanguage_
         """
-        sql = "SELECT concept_id,concept_code,concept_name from :dataset.concept WHERE REGEXP_CONTAINS(concept_code,'Language_English')"
         other_id = '0'
         other_name = 'Unknown'
-        sql = sql.replace(":dataset",self.dataset)
-        r = self.client.query(sql)
-        r = r.to_dataframe()        
-        _ids = [str(value) for value in r['concept_id'].tolist()]
+        r = self.concepts.get_rows(self.dataset,'language')
+        _ids = [str(row['concept_id']) for row in r]
         
         return self.__get_formatted_observations(_ids,other_name,other_id)
     def employment(self):
@@ -666,35 +1173,735 @@ class Group(Policy):
             This function will generalize employment
             This will have to be filtered by _EmploymentStatus
         """
-        sql = "SELECT concept_id,concept_code,concept_name from :dataset.concept WHERE concept_code in ('EmploymentStatus_OutOfWorkOneOrMore','EmploymentStatus_EmployedForWages','EmploymentStatus_OutOfWorkLessThanOne')"
         other_id = '0'
         other_name = 'Unknown'
-        sql = sql.replace(":dataset",self.dataset)
-        r = self.client.query(sql)
-        r = r.to_dataframe()        
-        _ids = [str(value) for value in r['concept_id'].tolist()]
+        r = self.concepts.get_rows(self.dataset,'employment')
+        _ids = [str(row['concept_id']) for row in r]
         
         return self.__get_formatted_observations(_ids,other_name,other_id)
-def initialization(client,dataset):
+class JobTracker :
+    """
+        This class keeps track of the jobs submitted to bigquery until they complete.
+        Jobs that fail for transient reasons (rate limits, backend errors) are resubmitted and the final state of every job
+        (duration, bytes processed, slot-ms, ...) is recorded in a JSON-lines file
+        e.g :
+            tracker = JobTracker(client=client)
+            tracker.submit('person',sql,config)
+            r = tracker.wait()     #-- {'person':{'state':'DONE','errors':None,...}}
+    """
+    RETRY_REASONS = ['rateLimitExceeded','backendError','internalError']
+    def __init__(self,**args):
+        """
+            @param client   initialized big query client
+            @param path     folder of the JSON-lines file (default ./)
+            @param retries  number of times a job that failed for a transient reason is resubmitted (default 3)
+            @param delay    initial polling delay in seconds, it doubles up to 60 seconds (default 1)
+            @param manifest manifest the jobs are recorded in, the jobs of a resumed run aren't resubmitted, see RunManifest (optional)
+        """
+        self.client     = args['client']
+        self.path       = args['path'] if 'path' in args else './'
+        self.retries    = int(args['retries']) if 'retries' in args else 3
+        self.delay      = float(args['delay']) if 'delay' in args else 1.0
+        self.manifest   = args['manifest'] if 'manifest' in args else None
+        self.filename   = os.sep.join([self.path,datetime.now().strftime('deid-jobs-%Y-%m-%d.jsonl')])
+        self.jobs       = {}
+        self.lock       = Lock()
+    def submit(self,name,sql,config,plan=None):
+        """
+            This function submits a query job and tracks it
+            @param name     name of the job (table name, people_seed, ...)
+            @param sql      query to be submitted
+            @param config   QueryJobConfig of the job
+            @param plan     hash of what the job computes as recorded in the manifest (default the hash of the query)
+        """
+        plan    = plan if plan is not None else PlanCache.get_digest(sql)
+        resumed = self.resume(name,plan,config) if name not in self.get_items() else None
+        job,record = resumed if resumed is not None else (self.client.query(sql,location='US',job_config=config),None)
+        self.lock.acquire()
+        try:
+            attempts = self.jobs[name]['attempts'] + 1 if name in self.jobs else 1
+            self.jobs[name] = {"job":job,"sql":sql,"config":config,"plan":plan,"attempts":attempts,"record":record}
+        finally:
+            self.lock.release()
+        if self.manifest is not None and resumed is None :
+            destination = config.destination if config is not None else None
+            self.manifest.set(name,plan=plan,job_id=job.job_id,state='RUNNING',destination=destination.to_api_repr() if destination is not None else None,modified=None,record=None)
+        Logging.log(subject='tracker',object=name,action='resume.job' if resumed is not None else 'submit.job',value={"job_id":job.job_id,"attempt":attempts})
+        return job
+    def get_modified(self,config):
+        """
+            This function returns the last modification of the destination table of a job (None if the job has no destination)
+        """
+        destination = config.destination if config is not None else None
+        if destination is None :
+            return None
+        modified = self.client.get_table(destination).modified
+        return modified.isoformat() if modified is not None else None
+    def get_completed(self,name,plan,config):
+        """
+            This function returns the entry of the resumed run if the job completed with the same plan and its destination hasn't been modified since (None otherwise)
+        """
+        entry = self.manifest.get(name) if self.manifest is not None and self.manifest.resume else None
+        if entry is None or entry['plan'] != plan or entry['state'] != 'DONE' or entry['record'] is None :
+            return None
+        return entry if self.get_modified(config) == entry['modified'] else None
+    def resume(self,name,plan,config):
+        """
+            This function returns the job of the resumed run that ran the same plan (job,record) or None if the query has to be submitted :
+                - a job that completed is kept as long as its destination hasn't been modified since, its record is that of the previous run
+                - a job that is still running is reattached to (a job that failed is resubmitted)
+        """
+        entry = self.manifest.get(name) if self.manifest is not None and self.manifest.resume else None
+        if entry is None or entry['plan'] != plan :
+            return None
+        try:
+            if self.get_completed(name,plan,config) is not None :
+                return ResumedJob(entry['job_id'],'DONE',None),entry['record']
+            if entry['state'] == 'RUNNING' :
+                job = self.client.get_job(entry['job_id'],location='US')
+                if job.error_result is None :
+                    return job,None
+        except Exception,e:
+            #
+            # e.g the destination or the job no longer exist
+            #
+            Logging.log(subject='tracker',object=name,action='error.resume',value=str(e))
+        return None
+    def is_transient(self,job):
+        reason = job.error_result['reason'] if job.error_result is not None and 'reason' in job.error_result else None
+        return reason in JobTracker.RETRY_REASONS
+    def get_items(self,names=None):
+        """
+            This function returns the tracked jobs {name:{job,sql,config,plan,attempts,record}} (all of them by default).
+            The jobs are submitted by the threads of the scheduler, they are read under the lock
+        """
+        self.lock.acquire()
+        try:
+            names = list(self.jobs.keys()) if names is None else names
+            return dict([(name,self.jobs[name]) for name in names])
+        finally:
+            self.lock.release()
+    def get_records(self,names=None):
+        """
+            This function returns the final state of the given jobs (None for a job that is still running)
+        """
+        self.lock.acquire()
+        try:
+            names = list(self.jobs.keys()) if names is None else names
+            return dict([(name,self.jobs[name]['record']) for name in names])
+        finally:
+            self.lock.release()
+    def get_record(self,name,item):
+        """
+            This function returns the final state of a job as it is recorded
+        """
+        job     = item['job']
+        stats   = job._properties['statistics'] if 'statistics' in job._properties else {}
+        query   = stats['query'] if 'query' in stats else {}
+        duration= (job.ended - job.started).total_seconds() if job.ended is not None and job.started is not None else None
+        return {
+            "name":name,"job_id":job.job_id,"state":'FAILED' if job.error_result is not None else job.state,
+            "errors":job.errors,"attempts":item['attempts'],"duration":duration,
+            "bytes_processed":int(query['totalBytesProcessed']) if 'totalBytesProcessed' in query else None,
+            "slot_ms":int(query['totalSlotMs']) if 'totalSlotMs' in query else None
+        }
+    def save(self,record):
+        f = open(self.filename,'a')
+        f.write(json.dumps(dict(record,date=datetime.now().isoformat()))+"\n")
+        f.close()
+    def poll(self,names):
+        """
+            This function checks the state of the given jobs once (no waiting), the jobs that completed are recorded
+            and the jobs that failed for a transient reason are resubmitted. The function returns the jobs that are still pending
+            @param names    names of the jobs to be checked
+        """
+        items   = self.get_items(names)
+        pending = [name for name in names if items[name]['record'] is None]
+        for name in list(pending) :
+            item = items[name]
+            try:
+                item['job'].reload()
+            except Exception,e:
+                Logging.log(subject='tracker',object=name,action='error.reload',value=str(e))
+                continue
+            if item['job'].state != 'DONE' :
+                continue
+            if item['job'].error_result is not None and self.is_transient(item['job']) and item['attempts'] <= self.retries :
+                Logging.log(subject='tracker',object=name,action='retry.job',value=item['job'].error_result)
+                #
+                # The retry is recorded with the plan of the job it replaces (e.g the plan of a table includes its layout, see Orchestrator.get_plan)
+                #
+                self.submit(name,item['sql'],item['config'],item['plan'])
+                continue
+            record = self.get_record(name,item)
+            self.lock.acquire()
+            try:
+                item['record'] = record
+            finally:
+                self.lock.release()
+            self.save(item['record'])
+            if self.manifest is not None :
+                try:
+                    modified = self.get_modified(item['config']) if item['record']['state'] != 'FAILED' else None
+                except Exception,e:
+                    modified = None
+                self.manifest.set(name,job_id=item['record']['job_id'],state=item['record']['state'],modified=modified,record=item['record'])
+            Logging.log(subject='tracker',object=name,action='done.job',value=item['record']['state'])
+            pending.remove(name)
+        return pending
+    def wait(self,names=None):
+        """
+            This function polls the tracked jobs (all of them by default) with an exponential backoff until they are completed
+            @param names    names of the jobs to wait for
+        """
+        names   = list(self.get_items(names).keys()) if names is None else names
+        pending = self.poll(names)
+        delay   = self.delay
+        while pending :
+            time.sleep(delay)
+            delay = min(delay * 2,60)
+            pending = self.poll(pending)
+        return self.get_records(names)
+class RunManifest :
+    """
+        This class records the jobs of a run (one entry per job : table, shard, staging table, ...) so that an interrupted run can be resumed.
+        Every entry has the hash of the query (plan), the job id, the final state and the last modification of the destination table once the job has completed.
+        When a run is resumed, a job running the same query isn't resubmitted : a job that completed is kept (if its destination hasn't changed since)
+        and a job that is still running is reattached to. The manifest is written every time an entry changes.
+        e.g :
+            manifest = RunManifest(path='deid-manifest-raw-deid.json',i_dataset='raw',o_dataset='deid',resume=True)
+            manifest.get('observation')     #-- {"plan":..,"job_id":..,"state":"DONE","modified":..,"record":{..},"updated":..}
+    """
+    LOCK = Lock()
+    def __init__(self,**args):
+        """
+            @param path         path of the manifest
+            @param i_dataset    input dataset
+            @param o_dataset    output dataset
+            @param resume       the entries of the existing manifest are resumed, a new manifest is started otherwise (default False)
+        """
+        self.path       = args['path']
+        self.resume     = args['resume'] if 'resume' in args else False
+        self.cache      = {"i_dataset":args['i_dataset'],"o_dataset":args['o_dataset'],"started":datetime.now().isoformat(),"jobs":{}}
+        if self.resume and os.path.exists(self.path) :
+            f = open(self.path)
+            cache = json.loads(f.read())
+            f.close()
+            if [cache['i_dataset'],cache['o_dataset']] != [args['i_dataset'],args['o_dataset']] :
+                raise ValueError(self.path+" is the manifest of "+str(cache['i_dataset'])+" -> "+str(cache['o_dataset']))
+            self.cache = cache
+            Logging.log(subject='manifest',object=self.path,action='resume',value={"started":cache['started'],"jobs":len(cache['jobs'])})
+    def get(self,name):
+        return self.cache['jobs'][name] if name in self.cache['jobs'] else None
+    def set(self,name,**values):
+        RunManifest.LOCK.acquire()
+        try:
+            entry = self.cache['jobs'][name] if name in self.cache['jobs'] else {}
+            entry.update(values)
+            entry['updated'] = datetime.now().isoformat()
+            self.cache['jobs'][name] = entry
+            #
+            # The manifest is replaced at once, a run interrupted while it is written leaves the previous version
+            #
+            folder = os.path.dirname(self.path)
+            if folder and not os.path.exists(folder) :
+                os.makedirs(folder)
+            f = open(self.path+".tmp",'w')
+            f.write(json.dumps(self.cache,default=str))
+            f.close()
+            os.rename(self.path+".tmp",self.path)
+        finally:
+            RunManifest.LOCK.release()
+#
+# A job of a previous run that completed, it stands for the job in the tracker when a run is resumed
+#
+ResumedJob = namedtuple('ResumedJob',['job_id','state','errors'])
+class Scheduler :
+    """
+        This class runs units of work (seeding table, staging tables, suppressed values, de-identification of a table, ...) in the order of their dependencies.
+        Every unit declares the tables it reads (inputs) and writes (outputs), a unit is started once the units writing its inputs have completed
+        i.e a query never reads a table that is still being written. The units that are ready are started concurrently,
+        the handlers (composing and submitting the queries) run in a bounded pool of threads and the number of jobs running on bigquery is capped.
+        When a unit fails, the units that depend on it (directly or not) are cancelled, the others are carried on.
+        e.g :
+            scheduler = Scheduler(tracker=tracker,pool=8,jobs=50)
+            scheduler.add('people_seed',handler,outputs=['raw.people_seed'])
+            scheduler.add('observation',handler,inputs=['raw.people_seed'],outputs=['deid.observation'])
+            r = scheduler.run()     #-- {'observation':{'state':'DONE','errors':None,'jobs':['observation']},...}
+    """
+    def __init__(self,**args):
+        """
+            @param tracker  job tracker the jobs are submitted to, see JobTracker
+            @param pool     number of handlers running concurrently (default 8)
+            @param jobs     maximum number of jobs running concurrently on bigquery, a unit isn't started beyond it (default 50)
+        """
+        self.tracker    = args['tracker']
+        self.pool       = int(args['pool']) if 'pool' in args else 8
+        self.jobs       = int(args['jobs']) if 'jobs' in args else 50
+        self.units      = {}
+        self.order      = []
+    def add(self,name,handler,inputs=[],outputs=[],done=None):
+        """
+            This function adds a unit of work
+            @param name     name of the unit
+            @param handler  function submitting the jobs of the unit, it returns the names of the jobs submitted to the tracker (none if there is nothing to wait for)
+            @param inputs   tables read by the unit, an input that isn't the output of a unit is expected to exist
+            @param outputs  tables written by the unit
+            @param done     function called once the jobs of the unit have completed (optional)
+        """
+        self.units[name] = {"handler":handler,"inputs":list(inputs),"outputs":list(outputs),"done":done,"state":"PENDING","errors":None,"jobs":[]}
+        self.order.append(name)
+    def get_dependencies(self):
+        """
+            This function returns the units every unit depends on {name:[names]}, an error is raised if the dependencies have a cycle
+        """
+        producers = {}
+        for name in self.order :
+            for output in self.units[name]['outputs'] :
+                if output in producers :
+                    raise ValueError(output+" is written by "+producers[output]+" and "+name)
+                producers[output] = name
+        r = dict([(name,sorted(set([producers[item] for item in self.units[name]['inputs'] if item in producers and producers[item] != name]))) for name in self.order])
+        #
+        # Topological sort (Kahn), a unit that can't be ordered is part of a cycle
+        #
+        ordered = set()
+        while len(ordered) < len(r) :
+            ready = [name for name in self.order if name not in ordered and set(r[name]) <= ordered]
+            if not ready :
+                raise ValueError("cycle between "+",".join([name for name in self.order if name not in ordered]))
+            ordered |= set(ready)
+        return r
+    def get_running(self):
+        """
+            This function returns the number of jobs running (a unit whose handler hasn't returned counts as one)
+        """
+        running = 0
+        for name in self.order :
+            unit = self.units[name]
+            if unit['state'] == 'SUBMITTING' :
+                running += 1
+            elif unit['state'] == 'RUNNING' :
+                running += len([1 for record in self.tracker.get_records(unit['jobs']).values() if record is None])
+        return running
+    def set_state(self,name,state,errors=None):
+        self.units[name]['state'] = state
+        self.units[name]['errors'] = errors
+        Logging.log(subject='scheduler',object=name,action=state.lower(),value=errors)
+    def run(self):
+        """
+            This function runs every unit and returns their final state {name:{state,errors,jobs}}, the state is DONE, FAILED or CANCELLED
+        """
+        dependencies = self.get_dependencies()
+        pool    = ThreadPoolExecutor(max_workers=max(1,min(self.pool,len(self.order))))
+        futures = {}
+        delay   = self.tracker.delay
+        while [name for name in self.order if self.units[name]['state'] in ['PENDING','SUBMITTING','RUNNING']] :
+            changed = False
+            for name in self.order :
+                unit = self.units[name]
+                if unit['state'] != 'PENDING' :
+                    continue
+                failed = [item for item in dependencies[name] if self.units[item]['state'] in ['FAILED','CANCELLED']]
+                if failed :
+                    #
+                    # The unit that failed is reported (rather than the cancelled unit in between)
+                    #
+                    root = failed[0] if self.units[failed[0]]['state'] == 'FAILED' else self.units[failed[0]]['errors']['cancelled']
+                    self.set_state(name,'CANCELLED',{"cancelled":root})
+                    changed = True
+                elif len([1 for item in dependencies[name] if self.units[item]['state'] != 'DONE']) == 0 and self.get_running() < self.jobs :
+                    unit['state'] = 'SUBMITTING'
+                    futures[name] = pool.submit(unit['handler'])
+                    changed = True
+            for name in [name for name in futures if futures[name].done()] :
+                future = futures.pop(name)
+                try:
+                    self.units[name]['jobs'] = list(future.result() or [])
+                    self.units[name]['state'] = 'RUNNING'
+                except Exception,e:
+                    self.set_state(name,'FAILED',str(e))
+                changed = True
+            running = [name for name in self.order if self.units[name]['state'] == 'RUNNING']
+            pending = set(self.tracker.poll([job for name in running for job in self.units[name]['jobs']]))
+            for name in running :
+                unit = self.units[name]
+                if set(unit['jobs']) & pending :
+                    continue
+                records = self.tracker.get_records(unit['jobs'])
+                failed = dict([(job,records[job]['errors']) for job in unit['jobs'] if records[job]['state'] == 'FAILED'])
+                if failed :
+                    self.set_state(name,'FAILED',failed)
+                else:
+                    try:
+                        if unit['done'] is not None :
+                            unit['done']()
+                        self.set_state(name,'DONE')
+                    except Exception,e:
+                        self.set_state(name,'FAILED',str(e))
+                changed = True
+            if changed :
+                delay = self.tracker.delay
+            elif futures :
+                concurrent.futures.wait(list(futures.values()),timeout=delay,return_when=concurrent.futures.FIRST_COMPLETED)
+                delay = min(delay * 2,60)
+            else:
+                time.sleep(delay)
+                delay = min(delay * 2,60)
+        pool.shutdown(wait=True)
+        return dict([(name,{"state":self.units[name]['state'],"errors":self.units[name]['errors'],"jobs":self.units[name]['jobs']}) for name in self.order])
+class Staging :
+    """
+        This class materializes, once per run, the per-person sets derived from the input dataset (e.g multi-racial people).
+        The sets are written in small tables of the input dataset (people_<name>) so that the generalizations use a single semi-join against them
+        rather than aggregating the source table for every expression that needs them.
+        The people excluded given their age (exclude-age) depend on the current date, the set is named after the age and is reused
+        by the runs of the same day (as long as the observation table hasn't changed since it was written).
+        e.g :
+            handler = Staging(client=client,dataset='raw',age=89)
+            handler.build()
+            handler.get_table('multi_racial')  #-- raw.people_multi_racial
+            handler.get_excluded()              #-- Select person_id FROM raw.people_excluded_age_89
+    """
+    SETS = {
+        "multi_racial":Select(fields=['person_id'],source=Table(':i_dataset','observation'),where=["observation_source_value like 'Race_%'"],group=['person_id'],having=['COUNT(*) > 1'])
+    }
+    EXCLUDED = "observation_source_value = 'PIIBirthInformation_BirthDate' and DATE_DIFF(CURRENT_DATE, CAST(value_as_string AS DATE),YEAR) > :age"
+    def __init__(self,**args):
+        """
+            @param client   initialized big query client
+            @param dataset  input dataset
+            @param age      people older than age are excluded from every table (optional)
+            @param cohort   the sets only hold the people of the cohort, see Cohort (optional)
+        """
+        self.client     = args['client']
+        self.dataset    = args['dataset']
+        self.age        = args['age'] if 'age' in args else None
+        self.cohort     = args['cohort'] if 'cohort' in args else None
+        self.sets       = {}
+        for name in Staging.SETS :
+            query = copy.copy(Staging.SETS[name])
+            query.where = query.where + self.get_filters()
+            self.sets[name] = Compiler().render(query)
+        if self.age is not None :
+            self.sets[self.get_excluded_name()] = Compiler().render(Select(fields=['DISTINCT person_id'],source=Table(':i_dataset','observation'),where=[Staging.EXCLUDED.replace(":age",str(self.age))]+self.get_filters()))
+        self.built      = set()
+    @staticmethod
+    def get_names():
+        return ["people_"+name for name in Staging.SETS]
+    @staticmethod
+    def is_staging(table):
+        """
+            This function determines if a table of the input dataset is a staging table (including the excluded people of any age)
+        """
+        return table in Staging.get_names() or table.startswith("people_excluded_age_")
+    def get_filters(self):
+        return self.cohort.get_filters() if self.cohort is not None else []
+    def get_excluded_name(self):
+        """
+            The set of a cohort is named after the cohort so that it is never reused by the runs of another cohort (or of everyone)
+        """
+        name = "excluded_age_"+str(self.age)
+        return name if self.cohort is None else name+"_cohort_"+self.cohort.get_digest()[:8]
+    def get_table(self,name):
+        """
+            This function returns the fully qualified name of a staging table
+        """
+        return ".".join([self.dataset,"people_"+name])
+    def get_sql(self,name):
+        return self.sets[name].replace(":i_dataset",self.dataset)
+    def get_excluded(self):
+        """
+            This function returns the query of the people excluded given their age (None if no age is set).
+            The staging table is used once built, the set is computed by the query itself otherwise (e.g dry-run)
+        """
+        if self.age is None :
+            return None
+        name = self.get_excluded_name()
+        if "people_"+name in self.built :
+            return Select(fields=['person_id'],source=Table(self.dataset,"people_"+name))
+        return Select(fields=['person_id'],source=Table(self.dataset,'observation'),where=[Staging.EXCLUDED.replace(":age",str(self.age))]+self.get_filters())
+    def is_reusable(self,name,tables):
+        """
+            This function determines if the set of excluded people was written today, after the last change of the observation table
+            @param name     name of the set
+            @param tables   names of the tables of the input dataset
+        """
+        if name != self.get_excluded_name() or "people_"+name not in tables :
+            return False
+        s_table = self.client.get_table(self.client.dataset(self.dataset).table("people_"+name))
+        i_table = self.client.get_table(self.client.dataset(self.dataset).table('observation'))
+        if s_table.modified is None or i_table.modified is None :
+            return False
+        return s_table.modified.date() == datetime.now(s_table.modified.tzinfo).date() and s_table.modified >= i_table.modified
+    def get_existing(self):
+        """
+            This function returns the tables of the input dataset a staging table can be reused from (none if no age is set)
+        """
+        return [table.table_id for table in self.client.list_tables(self.client.dataset(self.dataset))] if self.age is not None else []
+    def submit(self,name,tracker,tables):
+        """
+            This function submits the job of a set, the function returns the names of the submitted jobs (none if the set is reused)
+            @param name     name of the set
+            @param tracker  job tracker, see JobTracker
+            @param tables   tables of the input dataset, see get_existing
+        """
+        if self.is_reusable(name,tables) :
+            Logging.log(subject='staging',object="people_"+name,action='reuse',value=self.dataset)
+            self.built.add("people_"+name)
+            return []
+        job = bq.QueryJobConfig()
+        job.destination = self.client.dataset(self.dataset).table("people_"+name)
+        job.write_disposition = 'WRITE_TRUNCATE'
+        job.use_query_cache = True
+        if name == self.get_excluded_name() :
+            #
+            # The set is clustered by person_id so the anti-join of every table reads it efficiently
+            #
+            set_job_layout(job,cluster=['person_id'])
+        tracker.submit("people_"+name,self.get_sql(name),job)
+        return ["people_"+name]
+    def build(self,tracker=None):
+        """
+            This function submits the staging jobs (one per set) and waits for them to complete
+            @param tracker  job tracker, see JobTracker (optional)
+        """
+        tracker = tracker if tracker is not None else JobTracker(client=self.client)
+        tables  = self.get_existing()
+        names = []
+        for name in self.sets :
+            names += self.submit(name,tracker,tables)
+        r = tracker.wait(names)
+        self.built |= set([name for name in names if r[name]['state'] != 'FAILED'])
+        Logging.log(subject='staging',object=self.dataset,action='done',value=dict([(name,r[name]['state']) for name in r]))
+        return r
+class Rules :
+    """
+        This class compiles the row suppression rules of the configuration {"<table>":{"rows":{"<field>":[patterns]}}}.
+        The patterns are resolved once per run against the distinct values of the field (rather than evaluated on every row),
+        the suppressed values are materialized in a small table of the input dataset (suppressed_<table>_<field>).
+        The rules are applied as an anti-join in every scan of the table, i.e the rows are dropped before they are shifted or generalized.
+        A materialized table is reused by the next runs as long as its table hasn't changed since and the patterns are the same (see is_reusable)
+        e.g :
+            handler = Rules(client=client,dataset='raw',suppression=config['suppression'])
+            handler.build()
+            handler.get_filters('observation')     #-- [In(observation_source_value NOT IN suppressed values),...]
+    """
+    PREFIX = "suppressed_"
+    LOCK = Lock()
+    def __init__(self,**args):
+        """
+            @param client       initialized big query client
+            @param dataset      input dataset
+            @param suppression  suppression specifications of the tables (as found in config.json)
+            @param cohort       only the values of the people of the cohort are resolved, see Cohort (optional)
+            @param registry     schema registry, the cohort is pushed in the tables that have a person_id (required with a cohort)
+            @param path         folder where the queries of the materialized tables are recorded (default ~/.deid/cache)
+        """
+        self.client     = args['client']
+        self.dataset    = args['dataset']
+        self.suppression= args['suppression'] if 'suppression' in args else {}
+        self.cohort     = args['cohort'] if 'cohort' in args else None
+        self.registry   = args['registry'] if 'registry' in args else None
+        self.path       = args['path'] if 'path' in args else CACHE_PATH
+        self.built      = set()
+    def get_rules(self,table):
+        return self.suppression[table]['rows'] if table in self.suppression and 'rows' in self.suppression[table] else {}
+    def get_name(self,table,field):
+        return Rules.PREFIX + table + "_" + field
+    def get_query(self,table,field):
+        """
+            This function returns the query resolving the suppressed values of a field, the patterns are evaluated once per distinct value
+        """
+        values = Select(fields=['DISTINCT :field AS value'.replace(":field",field)],source=Table(self.dataset,table))
+        if self.cohort is not None and 'person_id' in [item.name for item in self.registry.get_schema(self.dataset,table)] :
+            values.where = self.cohort.get_filters()
+        pattern= "|".join(self.get_rules(table)[field])
+        return Select(fields=['value'],source=values,where=["REGEXP_CONTAINS(value,':pattern')".replace(":pattern",pattern)])
+    def get_filters(self,table):
+        """
+            This function returns the conditions to be pushed in every scan of a table (anti-join with the suppressed values).
+            The suppressed values are read from the table materialized for the run or resolved by the query itself (e.g dry-run)
+            @NOTE: rows whose field is NULL are suppressed as well (as REGEXP_CONTAINS(NULL,...) IS FALSE did)
+        """
+        r = []
+        for field in self.get_rules(table) :
+            name = self.get_name(table,field)
+            if name in self.built :
+                values = Select(fields=['value'],source=Table(self.dataset,name))
+            else:
+                values = self.get_query(table,field)
+            values.name = name
+            r += [":field IS NOT NULL".replace(":field",field),In(field=field,query=values,negate=True)]
+        return r
+    def get_filename(self):
+        return os.sep.join([self.path,"rules-:dataset.json".replace(":dataset",self.dataset)])
+    def load(self):
+        """
+            This function returns the records of the materialized tables {name:{plan,etag}}
+        """
+        filename = self.get_filename()
+        if not os.path.exists(filename) :
+            return {}
+        f = open(filename)
+        r = json.loads(f.read())
+        f.close()
+        return r
+    def set_built(self,table,field):
+        """
+            This function records a materialized table with the query it was written with (so it can be reused, see is_reusable)
+        """
+        name = self.get_name(table,field)
+        self.built.add(name)
+        info = self.client.get_table(self.client.dataset(self.dataset).table(name))
+        Rules.LOCK.acquire()
+        try:
+            records = self.load()
+            records[name] = {"plan":PlanCache.get_digest(Compiler().render(self.get_query(table,field))),"etag":info.etag}
+            if not os.path.exists(self.path) :
+                os.makedirs(self.path)
+            f = open(self.get_filename(),'w')
+            f.write(json.dumps(records))
+            f.close()
+        finally:
+            Rules.LOCK.release()
+    def is_reusable(self,table,field):
+        """
+            This function determines if the materialized table of a field was written by the same query, after the last change of the table.
+            The suppressed values are resolved against the distinct values of the field rather than the concept table :
+            the values of a field aren't all concept codes (unmapped or free-text answers) and they must be suppressed as well
+        """
+        name = self.get_name(table,field)
+        records = self.load()
+        if name not in records or records[name]['plan'] != PlanCache.get_digest(Compiler().render(self.get_query(table,field))) :
+            return False
+        try:
+            s_table = self.client.get_table(self.client.dataset(self.dataset).table(name))
+            i_table = self.client.get_table(self.client.dataset(self.dataset).table(table))
+        except Exception,e:
+            return False
+        if s_table.etag != records[name]['etag'] or s_table.modified is None or i_table.modified is None :
+            return False
+        return s_table.modified >= i_table.modified
+    def submit(self,table,field,tracker):
+        """
+            This function submits the job materializing the suppressed values of a field, the function returns the names of the submitted jobs (none if the table is reused)
+        """
+        if self.is_reusable(table,field) :
+            Logging.log(subject='rules',object=self.get_name(table,field),action='reuse',value=self.dataset)
+            self.built.add(self.get_name(table,field))
+            return []
+        job = bq.QueryJobConfig()
+        job.destination = self.client.dataset(self.dataset).table(self.get_name(table,field))
+        job.write_disposition = 'WRITE_TRUNCATE'
+        job.use_query_cache = True
+        tracker.submit(self.get_name(table,field),Compiler().render(self.get_query(table,field)),job)
+        return [self.get_name(table,field)]
+    def build(self,tables,tracker=None):
+        """
+            This function materializes the suppressed values of the tables (one job per field) and waits for them to complete
+            @param tables   tables of the run
+            @param tracker  job tracker, see JobTracker (optional)
+        """
+        tracker = tracker if tracker is not None else JobTracker(client=self.client)
+        names = []
+        for table in tables :
+            for field in self.get_rules(table) :
+                names += self.submit(table,field,tracker)
+        r = tracker.wait(names)
+        for table in tables :
+            for field in self.get_rules(table) :
+                if self.get_name(table,field) in r and r[self.get_name(table,field)]['state'] != 'FAILED' :
+                    self.set_built(table,field)
+        Logging.log(subject='rules',object=self.dataset,action='done',value=dict([(name,r[name]['state']) for name in r]))
+        return r
+class Cohort :
+    """
+        This class restricts the de-identification to a cohort i.e a list of people (person_id) read from a file or from a table.
+        The cohort is pushed in every scan of the input tables (branches of the unions, shifted dates, seeds, staging sets and suppressed values)
+        rather than filtering the result-set as --filter does, the rows of the other people are dropped as they are read.
+        The person_id of a file are inlined in the queries, a table is used as a semi-join (the compiler defines it once : WITH cohort AS ...)
+        e.g :
+            handler = Cohort(source='cohort.txt')
+            handler.get_filters()       #-- ["person_id IN (1,2,3)"]
+            handler = Cohort(source='raw.cohort')
+            handler.get_filters()       #-- [In(person_id IN (SELECT person_id FROM raw.cohort))]
+        @NOTE: bigquery bills the bytes of the columns read, they decrease with the size of the cohort when the input tables are clustered by person_id
+    """
+    def __init__(self,**args):
+        """
+            @param source   path of a file of person_id (one per line, the first line can be a header) or name of a table <dataset>.<table> with a person_id column
+        """
+        source      = args['source']
+        self.ids    = None
+        self.table  = None
+        if os.path.exists(source) :
+            f = open(source)
+            lines = [line.strip().split(',')[0].strip() for line in f if line.strip() != '']
+            f.close()
+            if lines and not lines[0].isdigit() :
+                lines = lines[1:]
+            self.ids = sorted(set([int(value) for value in lines]))
+            if not self.ids :
+                raise ValueError("The cohort :path has no person_id".replace(":path",source))
+        elif len(source.split('.')) == 2 :
+            self.table = source.split('.')
+        else:
+            raise ValueError("The cohort :source is neither a file nor a table <dataset>.<table>".replace(":source",source))
+    def get_query(self):
+        return Select(fields=['person_id'],source=Table(self.table[0],self.table[1]),name='cohort')
+    def get_filters(self):
+        """
+            This function returns the conditions to be pushed in every scan of a table that has a person_id
+        """
+        if self.ids is not None :
+            return ["person_id IN (:ids)".replace(":ids",",".join([str(value) for value in self.ids]))]
+        return [In(field='person_id',query=self.get_query())]
+    def get_digest(self):
+        """
+            This function identifies the cohort in the plans (see PlanCache), a cohort table is identified by its name
+        """
+        return PlanCache.get_digest(self.ids if self.ids is not None else ".".join(self.table))
+def initialization(client,dataset,tracker=None,incremental=False):
     """
         This function will determine if the person_seed table needs to be destroyed and re-initialized
         I decided to make this function dummy proof to make it more user friendly
+        The function returns the job creating the seeding table (None if the table is consistent)
 
         :client     initialized big query client
         :dataset    dataset name
+        :tracker    job tracker the creation of the seeding table is submitted to, see JobTracker (optional)
+        :incremental the seeds of existing people are never changed, people without a seed are appended (the table is never destroyed)
     """
     
     ref = client.dataset(dataset)
     has_table = len([1 for table in client.list_tables(ref) if table.table_id == 'people_seed']) > 0
     Logging.log(subject='composer',object='big.query',action='has.seed',value=(1*has_table))
     
-    if has_table == True :
+    if has_table == True and incremental == True :
         #
-        # The seeding table was found, we need to make sure the table has an acceptable level of consistency
+        # The dates already published were shifted with the existing seeds, destroying them would make the increments inconsistent
+        # Only the people that joined since the last run are given a seed
         #
-        # r_o = client.get_table(client.dataset(dataset).table("observation"))
-        r_i = client.get_table(client.dataset(dataset).table("people_seed"))        
-        sql="SELECT COUNT(DISTINCT person_id) as count FROM :i_dataset.observation ".replace(":i_dataset",dataset)
+        sql = "SELECT person_id, DATE_DIFF(CURRENT_DATE,CAST(value_as_string as DATE) , DAY)+ CAST (700*rand() AS INT64) as seed FROM :i_dataset.observation WHERE observation_source_value = 'ExtraConsent_TodaysDate' AND person_id NOT IN (SELECT person_id FROM :i_dataset.people_seed) GROUP BY person_id,value_as_string ORDER BY 1".replace(":i_dataset",dataset)
+        job = bq.QueryJobConfig()
+        job.destination = client.dataset(dataset).table("people_seed")
+        job.write_disposition = 'WRITE_APPEND'
+        job.use_query_cache = True
+        job.allow_large_results = True
+        if tracker is not None :
+            r = tracker.submit('people_seed',sql,job)
+        else:
+            r = client.query(sql,location='US',job_config=job)
+        Logging.log(subject='composer',object='big.query',action='append.seed',value=r.job_id)
+        return r
+    if has_table == True :
+        #
+        # The seeding table was found, we need to make sure the table has an acceptable level of consistency
+        #
+        # r_o = client.get_table(client.dataset(dataset).table("observation"))
+        r_i = client.get_table(client.dataset(dataset).table("people_seed"))        
+        sql="SELECT COUNT(DISTINCT person_id) as count FROM :i_dataset.observation ".replace(":i_dataset",dataset)
         
         r = client.query(sql).to_dataframe()
         Logging.log(subject="composer", object="make.seed",action="evaluate", value= r_i.num_rows/r['count'].values[0])
@@ -706,8 +1913,8 @@ def initialization(client,dataset):
             
             ref = client.dataset(dataset).table("people_seed")            
             client.delete_table(ref)
-            Logging.log(subject='composer',object='big.query',action='drop.table',value=ref.to_api_repr)
-            has_table = True
+            Logging.log(subject='composer',object='big.query',action='drop.table',value=ref.to_api_repr())
+            has_table = False
     #
     # We create the table here if there was an error found
     
@@ -722,211 +1929,1044 @@ def initialization(client,dataset):
         job.use_query_cache = True
         job.allow_large_results = True
         # job.dry_run = True    
-        r = client.query(sql,location='US',job_config=job)        
+        if tracker is not None :
+            r = tracker.submit('people_seed',sql,job)
+        else:
+            r = client.query(sql,location='US',job_config=job)        
         Logging.log(subject='composer',object='big.query',action='create.table',value=r.job_id)
+        return r
+    return None
 
-#
-# The code below will implement the orchestration and parameter handling from the command line 
-#             
-if __name__ == '__main__' :
-    #
-    # Overriding config path with the actual configuration file and making sure it is available for use
-    #
-    path = SYS_ARGS['config']
-    f = open(path)
-    SYS_ARGS['config'] = json.loads(f.read())
-    f.close()
-    #
-    # Once the configuration is available we can begin to create objects to do the work.
-    #   - google cloud client
-    #   - Initialize class level parameters
-    #
-    CONSTANTS = SYS_ARGS['config']['constants']
-    account_path = CONSTANTS['service-account-path']    
-    Policy.TERMS.SEXUAL_ORIENTATION_NOT_STRAIGHT= CONSTANTS['sexual-orientation']['not-straight']
-    Policy.TERMS.SEXUAL_ORIENTATION_STRAIGHT    = CONSTANTS['sexual-orientation']['straight']
-    Policy.TERMS.OBSERVATION_FILTERS            = CONSTANTS['observation-filter']
-    Policy.TERMS.BEGIN_OF_TIME = '1980-07-21' if 'begin-of-time' not in CONSTANTS['begin-of-time'] else CONSTANTS['begin-of-time']
-    client = bq.Client.from_service_account_json(account_path)
+def migrate_seeds(client,dataset,tracker=None):
+    """
+        This function freezes the seeds of the people_seed table (people_seed_frozen) before switching to keyed-hash seeds (see Shift)
+        The people it covers keep the seeds their published dates were shifted with, the others are given a keyed-hash seed.
+        The frozen seeds include the days since consent, they are larger than the keyed-hash seeds (see the note of Shift)
+        The frozen table is never overwritten (WRITE_EMPTY), the function returns the job creating it
 
-    #
-    # Let's get the information about the dataset available
-    i_dataset   = SYS_ARGS['i_dataset']
-    table       = SYS_ARGS['table']    
-    o_dataset   = SYS_ARGS['o_dataset']
-    remove      = SYS_ARGS['config']['suppression'][table] if table in SYS_ARGS['config']['suppression'] else []
-    
-    initialization(client,i_dataset)
+        :client     initialized big query client
+        :dataset    dataset name
+        :tracker    job tracker the job is submitted to, see JobTracker (optional)
+    """
+    sql = "SELECT person_id, MAX(seed) AS seed FROM :i_dataset.people_seed GROUP BY person_id".replace(":i_dataset",dataset)
+    job = bq.QueryJobConfig()
+    job.destination = client.dataset(dataset).table(Shift.FROZEN)
+    job.write_disposition = 'WRITE_EMPTY'
+    job.use_query_cache = True
+    if tracker is not None :
+        r = tracker.submit(Shift.FROZEN,sql,job)
+    else:
+        r = client.query(sql,location='US',job_config=job)
+    Logging.log(subject='composer',object='big.query',action='migrate.seed',value=r.job_id)
+    return r
 
-    #
-    # The operation will be performed via the implementation of a form of iterator-design pattern
-    # design information here https://en.wikipedia.org/wiki/Iterator_pattern
-    #
-    #
-    # @TODO: perhaps vocabulary_id and constant_class_id can be removed
-    #
-    args = {"client":client,"vocabulary_id":'PPI',"concept_class_id":['Question','PPI Modifier'],"dataset":i_dataset,table:table,"remove":remove}
-    container = [Shift(**args),DropFields(**args)]
-    #
-    # Let's see what we can do with the designated table, given our container of operations
-    # Each item in the container is fully autonomous and will return a query that will have to be built by the calling code
-    # The reason for this is because the operations are already convoluted as is: separation of concerns (https://en.wikipedia.org/wiki/Separation_of_concerns)
-    #
-    r       = {}
-    for item in container :
-        name    = item.name()
+class PlanCache :
+    """
+        This class persists the compiled queries (sql) of the tables of a dataset so that a rerun on an unchanged dataset doesn't plan anything.
+        A plan is keyed by what it is built from :
+            - schema    fingerprint of the schema of the table
+            - config    the suppression rules of the table and the terms of the generalizations
+            - concepts  version of the concept table
+            - code      version of the code building the queries (deid.py, query.py)
+            - options   options of the orchestrator (hoist, single pass, shard, staged sets, ...)
+        A plan whose key differs from the current one is stale, it is rebuilt (and replaced) when it is needed.
+        @NOTE: The salt of the keyed-hash seeds is never persisted, it is a query parameter (@salt) rather than part of the sql
+        e.g :
+            plans = PlanCache(path='~/.deid/cache')
+            plans.get('raw','observation',parts)        #-- sql or None
+            plans.set('raw','observation',parts,sql)
+    """
+    CACHE   = {}
+    LOCK    = Lock()
+    VERSION = None
+    def __init__(self,**args):
+        """
+            @param path     folder where the plans are persisted (default ~/.deid/cache)
+        """
+        self.path   = args['path'] if 'path' in args else CACHE_PATH
+    @staticmethod
+    def get_digest(value):
+        return hashlib.sha1(json.dumps(value,sort_keys=True,default=str).encode('utf-8')).hexdigest()
+    @staticmethod
+    def get_code_version():
+        """
+            This function returns the version of the code building the queries i.e the digest of the source files
+        """
+        if PlanCache.VERSION is None :
+            folder = os.path.dirname(os.path.abspath(__file__))
+            r = hashlib.sha1()
+            for name in ['deid.py','query.py'] :
+                f = open(os.sep.join([folder,name]),'rb')
+                r.update(f.read())
+                f.close()
+            PlanCache.VERSION = r.hexdigest()
+        return PlanCache.VERSION
+    def get_filename(self,dataset):
+        return os.sep.join([self.path,"plans-:dataset.json".replace(":dataset",dataset)])
+    def get_id(self,table,parts):
+        return table + ":" + PlanCache.get_digest(parts['options'])[:12]
+    def load(self,dataset):
+        filename = self.get_filename(dataset)
+        PlanCache.LOCK.acquire()
+        try:
+            if dataset not in PlanCache.CACHE :
+                PlanCache.CACHE[dataset] = {}
+                if os.path.exists(filename) :
+                    f = open(filename)
+                    PlanCache.CACHE[dataset] = json.loads(f.read())
+                    f.close()
+        finally:
+            PlanCache.LOCK.release()
+        return PlanCache.CACHE[dataset]
+    def save(self,dataset):
+        if dataset not in PlanCache.CACHE :
+            return
+        if not os.path.exists(self.path) :
+            os.makedirs(self.path)
+        PlanCache.LOCK.acquire()
+        try:
+            f = open(self.get_filename(dataset),'w')
+            f.write(json.dumps(PlanCache.CACHE[dataset]))
+            f.close()
+        finally:
+            PlanCache.LOCK.release()
+    def get(self,dataset,table,parts):
+        """
+            This function returns the persisted sql of a table if it was built from the same parts (None otherwise)
+            @param parts    {schema,config,concepts,code,options}, see Orchestrator.get_parts
+        """
+        plans = self.load(dataset)
+        _id = self.get_id(table,parts)
+        if _id not in plans or plans[_id]['key'] != PlanCache.get_digest(parts) :
+            Logging.log(subject='plans',object=".".join([dataset,table]),action='miss',value=_id)
+            return None
+        Logging.log(subject='plans',object=".".join([dataset,table]),action='hit',value=_id)
+        return plans[_id]['sql']
+    def set(self,dataset,table,parts,sql):
+        plans = self.load(dataset)
+        PlanCache.LOCK.acquire()
+        try:
+            plans[self.get_id(table,parts)] = {"table":table,"key":PlanCache.get_digest(parts),"parts":parts,"sql":sql,"date":datetime.now().isoformat()}
+        finally:
+            PlanCache.LOCK.release()
+    def get_stale(self,dataset,get_parts,tables):
+        """
+            This function returns the persisted plans that would be rebuilt and the parts that changed
+            @param get_parts    function returning the current parts of a table given the options of a plan
+            @param tables       tables of the dataset
+        """
+        r = []
+        plans = self.load(dataset)
+        for _id in sorted(plans) :
+            item = plans[_id]
+            if item['table'] not in tables :
+                r.append({"id":_id,"table":item['table'],"date":item['date'],"changed":["table"]})
+                continue
+            parts = get_parts(item['table'],item['parts']['options'])
+            changed = [name for name in ['schema','config','concepts','code'] if parts[name] != item['parts'][name]]
+            if changed :
+                r.append({"id":_id,"table":item['table'],"date":item['date'],"changed":changed})
+        return r
+
+class Watermarks :
+    """
+        This class keeps, for every table, the highest value of its key (e.g observation_id) that has been de-identified in the output dataset.
+        The watermarks are persisted locally (one file per input/output datasets) and are only moved once the job writing the rows has completed.
+        e.g :
+            handler = Watermarks(i_dataset='raw',o_dataset='deid')
+            handler.get('observation')          #-- {"column":"observation_id","value":1234,"updated":...}
+            handler.set('observation','observation_id',2345)
+    """
+    LOCK = Lock()
+    def __init__(self,**args):
+        """
+            @param i_dataset    input dataset
+            @param o_dataset    output dataset
+            @param path         folder where the watermarks are persisted (default ~/.deid/cache)
+        """
+        self.path       = args['path'] if 'path' in args else CACHE_PATH
+        self.filename   = os.sep.join([self.path,"watermarks-:i_dataset-:o_dataset.json".replace(":i_dataset",args['i_dataset']).replace(":o_dataset",str(args['o_dataset']))])
+        self.cache      = {}
+        if os.path.exists(self.filename) :
+            f = open(self.filename)
+            self.cache = json.loads(f.read())
+            f.close()
+    def get(self,table):
+        return self.cache[table] if table in self.cache else None
+    def set(self,table,column,value):
+        Watermarks.LOCK.acquire()
+        try:
+            self.cache[table] = {"column":column,"value":value,"updated":datetime.now().isoformat()}
+        finally:
+            Watermarks.LOCK.release()
+    def save(self):
+        if not os.path.exists(self.path) :
+            os.makedirs(self.path)
+        Watermarks.LOCK.acquire()
+        try:
+            f = open(self.filename,'w')
+            f.write(json.dumps(self.cache))
+            f.close()
+        finally:
+            Watermarks.LOCK.release()
+
+class Orchestrator :
+    """
+        This class will de-identify every table of a dataset (or a list of tables) in a single run.
+        The client, the seeding table and the policies are shared across tables and the jobs are submitted concurrently through a bounded pool of threads
+        e.g :
+            handler = Orchestrator(client=client,i_dataset='raw',o_dataset='deid',config=config)
+            summary = handler.run()
+    """
+    def __init__(self,**args):
+        """
+            @param client       initialized big query client, without a client the queries are planned from the local caches only (nothing can be run)
+            @param i_dataset    input dataset
+            @param o_dataset    output dataset
+            @param config       configuration (as found in config.json)
+            @param tables       list of tables to de-identify, by default every table in the input dataset
+            @param filter       optional filter applied to the final result-set of every table
+            @param cohort       only the people of the cohort are de-identified : file of person_id or <dataset>.<table>, see Cohort (optional)
+            @param pool         maximum number of concurrent submissions (default 8)
+            @param hoist        join the seed once per query instead of a sub-query per shifted field (default True)
+            @param cache        folder of the local caches (default ~/.deid/cache)
+            @param jobs         folder of the JSON-lines file the final state of the jobs is recorded in (default ./)
+            @param retries      number of times a job that failed for a transient reason is resubmitted (default 3)
+            @param incremental  only the rows added since the last run are de-identified and written to the existing output tables (default False)
+            @param mode         how the increments are written in the output tables : append|merge (default append)
+            @param shards       number of jobs the query of a table is split into (by person), the configuration can set it per table {"shards":{"<table>":N}} (default 1)
+            @param single_pass  meta tables (observation) are de-identified in a single scan, see DropFields.get_single_pass (default False)
+            @param salt         secret of the keyed-hash seeds, the people_seed table is neither built nor used if provided (optional)
+            @param replan       the queries are rebuilt even if a persisted plan is current, see PlanCache (default False)
+            @param max_jobs     maximum number of jobs running concurrently on bigquery, see Scheduler (default 50)
+            @param manifest     path of the manifest of the run, see RunManifest (default <jobs>/deid-manifest-<i_dataset>-<o_dataset>.json)
+            @param resume       the jobs of the manifest that ran the same queries aren't resubmitted (default False)
+        """
+        self.client     = args['client']
+        self.i_dataset  = args['i_dataset']
+        self.o_dataset  = args['o_dataset']
+        self.config     = args['config']
+        self.constants  = self.config['constants'] if 'constants' in self.config else {}
+        self.filter     = args['filter'] if 'filter' in args else None
+        self.cohort     = Cohort(source=args['cohort']) if 'cohort' in args and args['cohort'] is not None else None
+        self.pool       = int(args['pool']) if 'pool' in args else 8
+        self.max_jobs   = int(args['max_jobs']) if 'max_jobs' in args else 50
+        tables          = args['tables'] if 'tables' in args else None
+        if isinstance(tables,basestring) :
+            tables = tables.split(',')
+        self.tables     = tables
+        self.hoist      = args['hoist'] if 'hoist' in args else True
+        self.cache      = args['cache'] if 'cache' in args else CACHE_PATH
+        self.incremental= args['incremental'] in [True,1,'1','true','yes'] if 'incremental' in args else False
+        self.mode       = args['mode'] if 'mode' in args else 'append'
+        self.watermarks = Watermarks(i_dataset=self.i_dataset,o_dataset=self.o_dataset,path=self.cache)
+        self.windows    = {}
+        self.shard_plans= {}
+        self.existing   = set()
+        self.shards     = int(args['shards']) if 'shards' in args else 1
+        self.single_pass= args['single_pass'] if 'single_pass' in args else False
+        self.salt       = args['salt'] if 'salt' in args else None
         #
-        # @Log: We are logging here the operaton that is expected to take place
-        # {"action":"building-sql","input":fields,"subject":table,"object":""}        
-        
-        p       =  item.can_do(i_dataset,table)   
-        Logging.log(subject="composer",object=name,action="can.do",value= (i_dataset+"."+table) )             
-        if p :
-            r[name] = item.get(i_dataset,table)
+        # The schemas and concepts are shared across tables and policies
+        #
+        self.registry   = SchemaRegistry(client=self.client,path=self.cache)
+        self.frozen     = self.salt is not None and Shift.FROZEN in self.list_tables()
+        self.plans      = PlanCache(path=self.cache)
+        self.replan     = args['replan'] if 'replan' in args else False
+        self.concepts   = Concepts(client=self.client,path=self.cache,registry=self.registry)
+        self.staging    = Staging(client=self.client,dataset=self.i_dataset,age=self.constants['exclude-age'] if 'exclude-age' in self.constants else None,cohort=self.cohort)
+        self.rules      = Rules(client=self.client,dataset=self.i_dataset,suppression=self.config['suppression'] if 'suppression' in self.config else {},cohort=self.cohort,registry=self.registry,path=self.cache)
+        path            = args['jobs'] if 'jobs' in args else './'
+        manifest        = args['manifest'] if 'manifest' in args else os.sep.join([path,"deid-manifest-:i_dataset-:o_dataset.json".replace(":i_dataset",self.i_dataset).replace(":o_dataset",str(self.o_dataset))])
+        self.manifest   = RunManifest(path=manifest,i_dataset=self.i_dataset,o_dataset=self.o_dataset,resume=args['resume'] if 'resume' in args else False)
+        self.tracker    = JobTracker(client=self.client,path=path,retries=args['retries'] if 'retries' in args else 3,manifest=self.manifest)
+        #
+        # The shift policy doesn't depend on the table being processed, it can be shared across tables (so is its cache)
+        #
+        self.shift      = Shift(client=self.client,vocabulary_id='PPI',concept_class_id=['Question','PPI Modifier'],hoist=self.hoist,registry=self.registry,salt=self.salt,frozen=self.frozen,cohort=self.cohort)
+
+    def list_tables(self):
+        """
+            This function returns the tables of the input dataset, as known to the schema registry when there is no client (offline)
+        """
+        if self.client is None :
+            return self.registry.get_tables(self.i_dataset)
+        return [table.table_id for table in self.client.list_tables(self.client.dataset(self.i_dataset))]
+    def get_tables(self):
+        """
+            This function returns the list of tables to be processed, if none were specified every table of the dataset will be processed
+        """
+        if self.tables is None :
+            tables = self.registry.prefetch(self.i_dataset) if self.client is not None else self.registry.get_tables(self.i_dataset)
+            self.tables = [table for table in tables if table not in ['people_seed',Shift.FROZEN] and not Staging.is_staging(table) and '_shard_' not in table and not table.startswith(Rules.PREFIX)]
+        return self.tables
+    def get_remove(self,table):
+        """
+            This function returns the suppression specifications of a given table {columns:[],rows:{}}
+        """
+        suppression = self.config['suppression'] if 'suppression' in self.config else {}
+        return suppression[table] if table in suppression else {}
+    def get_key(self,table):
+        """
+            This function returns the column the watermark of a table is kept on (None if the table can't be processed incrementally).
+            The column is specified in the configuration {"incremental":{"<table>":"<column>"}} and defaults to <table>_id.
+            The column must be found unchanged in the output i.e it can neither be suppressed nor shifted
+        """
+        keys    = self.config['incremental'] if 'incremental' in self.config else {}
+        column  = keys[table] if table in keys else table+"_id"
+        fields  = dict([(field.name,field.field_type) for field in self.registry.get_schema(self.i_dataset,table)])
+        removed = self.get_remove(table).get('columns',[])
+        if column not in fields or column in removed or fields[column] in ['DATE','DATETIME','TIMESTAMP'] :
+            return None
+        return column
+    def get_window(self,table):
+        """
+            This function returns the range of keys of the rows that have been added to a table since the last run {column,low,high}
+            The upper bound is read before the query is submitted so that rows added during a run are left for the next one.
+            The function returns None when the table has to be rebuilt (first run, no key, output table missing)
+        """
+        column = self.get_key(table)
+        if column is None or table not in self.existing :
+            return None
+        watermark = self.watermarks.get(table)
+        if watermark is not None and watermark['column'] == column :
+            low = watermark['value']
         else:
-            continue
-    #
-    # At this point we should start building the query i.e performing joins and unions
-    #   - dropping fields performs a projection of a table given fields suppressed (should probably be renamed). Date/TimeStamp fields will be automatically dropped if not specified
-    #   - Dates are shifted and will/should be joined against the fields of the previous step
-    #   - In the advent of observation table (meta and relational) an additional union is added to the construction process
-    #
+            #
+            # There is no (usable) watermark, the output table tells us what has already been de-identified
+            #
+            sql = "SELECT MAX(:column) AS value FROM :o_dataset.:table".replace(":column",column).replace(":o_dataset",self.o_dataset).replace(":table",table)
+            low = self.client.query(sql).to_dataframe()['value'].values[0]
+        sql = "SELECT MAX(:column) AS value FROM :i_dataset.:table".replace(":column",column).replace(":i_dataset",self.i_dataset).replace(":table",table)
+        high = self.client.query(sql).to_dataframe()['value'].values[0]
+        low,high = [value.item() if hasattr(value,'item') else value for value in [low,high]]
+        if pd.isnull(low) :
+            return None
+        return {"column":column,"low":low,"high":high}
+    def get_shards(self,table):
+        """
+            This function returns the number of shards the query of a table is split into (1 if the table isn't sharded).
+            A table can only be sharded if its person_id is found unchanged in the output
+        """
+        shards  = self.config['shards'] if 'shards' in self.config else {}
+        n       = int(shards[table]) if table in shards else self.shards
+        fields  = [field.name for field in self.registry.get_schema(self.i_dataset,table)]
+        if n < 2 or 'person_id' not in fields or 'person_id' in self.get_remove(table).get('columns',[]) :
+            return 1
+        return n
+    @staticmethod
+    def get_shard_table(table,index,n):
+        return ":table_shard_:index_of_:n".replace(":table",table).replace(":index",str(index)).replace(":n",str(n))
+    @staticmethod
+    def get_shard_filter(index,n):
+        """
+            This function returns the condition selecting the people of a shard, a person always falls in the same shard
+        """
+        return "MOD(ABS(FARM_FINGERPRINT(CAST(person_id AS STRING))), :n) = :index".replace(":n",str(n)).replace(":index",str(index))
+    @staticmethod
+    def get_window_filter(window):
+        """
+            This function returns the condition selecting the rows of a window i.e low < column <= high
+        """
+        low,high = [str(value) if isinstance(value,(int,long,float)) else "'"+str(value)+"'" for value in [window['low'],window['high']]]
+        return ":column > :low AND :column <= :high".replace(":column",window['column']).replace(":low",low).replace(":high",high)
+    def get_parts(self,table,options=None):
+        """
+            This function returns what the plan of a table is built from (see PlanCache)
+            @param table    name of the table
+            @param options  options of the plan (default the current options of the orchestrator)
+        """
+        try:
+            version = self.concepts.get_version(self.i_dataset)
+        except Exception,e:
+            version = None
+        config = {"suppression":self.get_remove(table),"filter":self.filter,"exclude-age":self.constants['exclude-age'] if 'exclude-age' in self.constants else None,
+            "terms":dict([(name,getattr(Policy.TERMS,name)) for name in dir(Policy.TERMS) if name.isupper()])}
+        if self.cohort is not None :
+            config['cohort'] = self.cohort.get_digest()
+        schema = [list(field) for field in self.registry.get_schema(self.i_dataset,table)]
+        return {"schema":PlanCache.get_digest(schema),"config":PlanCache.get_digest(config),"concepts":version,"code":PlanCache.get_code_version(),"options":options}
+    def get_options(self,table,shard=None):
+        return {"hoist":self.hoist,"single_pass":self.single_pass,"salt":self.salt is not None,"frozen":self.frozen,"shard":list(shard) if shard is not None else None,
+            "staged":sorted(self.staging.built),"rules":sorted([name for name in self.rules.built if name.startswith(Rules.PREFIX+table+"_")])}
+    def compose(self,table,shift=None,window=None,shard=None):
+        """
+            This function returns the sql of the de-identification query of a given table (see build for the parameters)
+            The persisted plan of the table is used if it is current (not for increments, their window changes every run)
+        """
+        if shift is not None or window is not None :
+            return Compiler().render(self.build(table,shift,window,shard))
+        parts = self.get_parts(table,self.get_options(table,shard))
+        sql = self.plans.get(self.i_dataset,table,parts) if not self.replan else None
+        if sql is None :
+            sql = Compiler().render(self.build(table,shift,window,shard))
+            self.plans.set(self.i_dataset,table,parts,sql)
+        return sql
+    def stale(self):
+        """
+            This function returns the persisted plans of the input dataset that are stale (they would be rebuilt by the next run)
+        """
+        tables = self.registry.prefetch(self.i_dataset)
+        return self.plans.get_stale(self.i_dataset,self.get_parts,tables)
+    def build(self,table,shift=None,window=None,shard=None,single_pass=None):
+        """
+            This function will build the de-identification query (plan) of a given table, the plan is rendered in sql by the compiler (see query.py).
+            The operation will be performed via the implementation of a form of iterator-design pattern
+            design information here https://en.wikipedia.org/wiki/Iterator_pattern
+            @param table    name of the table
+            @param shift    date shifting policy to use instead of the orchestrator's
+            @param window   range of keys of the rows to de-identify {column,low,high}, see get_window (optional)
+            @param shard    (index,n) only the people of the index-th of n shards are de-identified (optional)
+            @param single_pass  use the single scan query for meta tables (default the orchestrator's)
+        """
+        i_dataset   = self.i_dataset
+        remove      = self.get_remove(table)
+        #
+        # @TODO: perhaps vocabulary_id and constant_class_id can be removed
+        #
+        shift = shift if shift is not None else self.shift
+        args = {"client":self.client,"vocabulary_id":'PPI',"concept_class_id":['Question','PPI Modifier'],"dataset":i_dataset,"table":table,"remove":remove,"concepts":self.concepts,"registry":self.registry,"staging":self.staging}
+        args['single_pass'] = self.single_pass if single_pass is None else single_pass
+        args['shift'] = shift
+        container = [shift,DropFields(**args)]
+        #
+        # Let's see what we can do with the designated table, given our container of operations
+        # Each item in the container is fully autonomous and will return a query that will have to be built by the calling code
+        # The reason for this is because the operations are already convoluted as is: separation of concerns (https://en.wikipedia.org/wiki/Separation_of_concerns)
+        #
+        r       = {}
+        for item in container :
+            name    = item.name()
+            with span(name+".can_do",table=table) :
+                p   =  item.can_do(i_dataset,table)
+            if p :
+                r[name] = item.get(i_dataset,table)
+            else:
+                continue
+        #
+        # At this point we should start building the query i.e performing joins and unions
+        #   - dropping fields performs a projection of a table given fields suppressed (should probably be renamed). Date/TimeStamp fields will be automatically dropped if not specified
+        #   - Dates are shifted and will/should be joined against the fields of the previous step
+        #   - In the advent of observation table (meta and relational) an additional union is added to the construction process
+        #
 
-    #
-    # Let's get basic project of fields and provide a prefix to the query
-    #
-    fields  =  r['dropfields']['fields']
-    # sql     = "SELECT :parent_fields FROM ("+r['dropfields']['sql']+") a"
-    sql = r['dropfields']['sql']
-    
-    #
-    # @Log: We are logging here the operaton that is expected to take place
-    # {"action":"building-sql","input":fields,"subject":table,"object":""}
-    
+        #
+        # Let's get basic project of fields and provide a prefix to the query
+        #
+        if 'dropfields' not in r :
+            #
+            # There is nothing to suppress nor shift in this table (e.g vocabulary tables), it is copied as is
+            #
+            copy_sql = Select(fields=['*'],source=Table(i_dataset,table))
+            r['dropfields'] = {"query":copy_sql,"fields":[],"branches":[copy_sql]}
+        fields  =  r['dropfields']['fields']
+        sql = r['dropfields']['query']
 
-    if 'shift' in r :
-        
-        if 'join' in r['shift'] :
+        if 'shift' in r :
+
+            if 'join' in r['shift'] :
+                #
+                # @Log: We are logging here the operaton that is expected to take place
+                # {"action":"building-sql","input":fields,"subject":table,"object":"join"}
+                # Every scan of the table gets the shifted dates and the seed (the seed lookup is defined once by the compiler)
+                #
+                join_fields = r['shift']['join']['fields']
+                for branch in r['dropfields']['branches'] :
+                    branch.fields += r['shift']['join']['shifted_values']
+                    if r['shift']['join']['seed'] is not None :
+                        branch.joins.insert(0,r['shift']['join']['seed'])
+            else:
+                join_fields = []
+
+            if 'union' in r['shift'] and not r['dropfields'].get('single_pass',False) :
+                #
+                # @Log: We are logging here the operaton that is expected to take place
+                # {"action":"building-sql","input":fields,"subject":table,"object":"union"}
+                # The query of the shift policy is shared across tables, it is copied before the remaining fields are added
+                #
+                union_sql = copy.copy(r['shift']['union']['query'])
+                union_sql.fields = union_sql.fields + [name for name in fields if name not in r['shift']['union']['fields']]
+                union_sql.where = union_sql.where + self.rules.get_filters(table) + (self.cohort.get_filters() if self.cohort is not None else [])
+                union_sql.where+= [Orchestrator.get_shard_filter(*shard)] if shard is not None else []
+                sql = Union(items=[sql,Select(fields=fields+join_fields,source=union_sql)])
+        #
+        # At this point we should submit the sql query with information about the target
+        #
+        FILTER = [ ]
+
+        if 'rows' in remove :
             #
-            # @Log: We are logging here the operaton that is expected to take place
-            # {"action":"building-sql","input":fields,"subject":table,"object":"join"}
-            prefixed_fields = ['a.'+name for name in fields if name not in r['shift']['join']['fields']]            
-            prefixed_fields +=['a.'+name for name in r['shift']['join']['fields'] ]
-            
-            prefixed_fields = ",".join(prefixed_fields)
-            
-            # join_sql = r['shift']['join']['sql']
-            join_fields = ",".join(['']+r['shift']['join']['fields']) #-- should start with comma
-            # sql = sql + " INNER JOIN (:sql) p ON p.person_id = a.person_id ".replace(":sql",join_sql)
-            shifted_values = ","+ ",".join(r['shift']['join']['shifted_values'])
-            
-        else:
-            prefixed_fields = ['a.'+name for name in fields if name not in fields ]
-            join_fields = ""
-            shifted_values = ""
-        
-        sql = sql.replace(":parent_fields",prefixed_fields).replace(":shifted_date_columns",shifted_values)
-        
-        if 'union' in r['shift'] :
+            # The user has specified rows to be removed, they are removed by every scan of the table (before any shifting or generalization)
+            # The suppressed values are resolved once per run, see Rules
             #
-            # @Log: We are logging here the operaton that is expected to take place
-            # {"action":"building-sql","input":fields,"subject":table,"object":"union"}
-            union_sql = r['shift']['union']['sql']
-            non_union_fields = list(set(fields) - set(r['shift']['union']['fields']))
-            non_union_fields = ",".join([' ']+non_union_fields)
-            union_sql = union_sql.replace(":fields",non_union_fields)
-            sql = sql + " UNION ALL SELECT :fields :joined_fields FROM ( :sql ) ".replace(":sql",union_sql)    
-            
-            sql = sql.replace(":fields",",".join(fields)).replace(":joined_fields",join_fields)            
-            
-        else:
-            pass
-    sql = sql.replace(":shifted_date_columns",shifted_values)
-    #
-    # At this point we should submit the sql query with information about the target
-    #
-    FILTER = [ ]
-    fields = ",".join(fields) + join_fields 
+            for branch in r['dropfields']['branches'] :
+                branch.where += self.rules.get_filters(table)
+        has_person = 'person_id' in [field.name for field in self.registry.get_schema(i_dataset,table)]
+        if self.cohort is not None and has_person :
+            #
+            # Only the people of the cohort are de-identified, they are selected by every scan of the table (see Cohort)
+            #
+            for branch in r['dropfields']['branches'] :
+                branch.where += self.cohort.get_filters()
 
-    if 'rows' in remove :
+        if self.filter is not None :
+            #
+            # @Log: We are logging here the operaton that is expected to take place
+            # {"action":"building-sql","input":fields,"subject":table,"object":"filter"}
+            FILTER.append(self.filter)
+        if window is not None :
+            #
+            # Incremental run : only the rows added since the last run are de-identified
+            #
+            FILTER.append(Orchestrator.get_window_filter(window))
+        if shard is not None :
+            #
+            # The people of the shard are selected by every scan of the table (as the union of the shift policy above)
+            #
+            for branch in r['dropfields']['branches'] :
+                branch.where += [Orchestrator.get_shard_filter(*shard)]
+            FILTER.append(Orchestrator.get_shard_filter(*shard))
         #
-        # The user has specified rows to be removed from the final results
-        # In other words the fields that are not to be included
-        FILTER = ["WHERE"]
+        # This is not ideal but we have to remove a portion of the population given their age
+        # For now we hard code this instruction and set the age as a parameter
+        # @TODO: ... urgh!!
         #
-        # @Log: We are logging here the operaton that is expected to take place
-        # {"action":"submit-sql","input":remove['rows'].keys(),"subject":table,"object":"bq"}        
-        for field in remove['rows'] :
+
+        if 'exclude-age' in self.constants and has_person :
             #
-            # @NOTE:
-            # This particular filter is to express rows to be removed from the resultset
+            # The people to be excluded are staged once per run (and day), see Staging
             #
-            values = "|".join(remove['rows'][field])
-            filter = "".join(["REGEXP_CONTAINS(",field,",'",values,"') IS FALSE"])
-            if len(FILTER) > 1 :
-                filter = (" AND " + filter)
-            FILTER.append(filter)
-    
-    if 'filter' in SYS_ARGS :
+            FILTER.append(In(field='person_id',query=self.staging.get_excluded(),negate=True))
+
         #
-        # @Log: We are logging here the operaton that is expected to take place
-        # {"action":"building-sql","input":fields,"subject":table,"object":"filter"}
-        if 'WHERE' not in FILTER :
-            FILTER += ["WHERE"]            
+        # Bug-fix:
+        #   Insuring the tables maintain their structural integrity
+        columns = remove['columns'] if 'columns' in remove else []
+        dropped_fields = Policy.get_dropped_fields(columns)
+        Logging.log(subject='composer',object=table,action='formatted.removed.columns',value=columns)
+        return Select(fields=['*']+dropped_fields,source=sql,where=FILTER)
+    def verify(self,table):
+        """
+            This function checks that the single scan query of a meta table returns the same rows as the union of scans (on the actual data).
+            The function returns the number of rows of both queries and the number of distinct rows found by only one of them
+            {table,union,single_pass,union_only,single_pass_only,equivalent}
+            @param table    name of the table
+        """
+        union   = self.build(table,single_pass=False)
+        single  = self.build(table,single_pass=True)
+        items   = [("union",union),("single_pass",single),("union_only",Except(left=union,right=single)),("single_pass_only",Except(left=single,right=union))]
+        sql     = Compiler().render(Union(items=[Select(fields=["':name' AS compiler".replace(":name",name),"COUNT(*) AS n"],source=node) for name,node in items]))
+        job     = bq.QueryJobConfig()
+        job.query_parameters = self.get_parameters()
+        r       = self.client.query(sql,job_config=job).to_dataframe()
+        r       = dict(zip(r['compiler'].tolist(),[int(value) for value in r['n'].tolist()]))
+        r['equivalent'] = r['union'] == r['single_pass'] and r['union_only'] == 0 and r['single_pass_only'] == 0
+        r['table'] = table
+        Logging.log(subject="composer",object=table,action="verify",value=r)
+        return r
+    def compare(self,table):
+        """
+            This function composes the query of a table with a per-field seed lookup (correlated) and with a hoisted seed join.
+            This is meant to compare both queries (bytes processed, slot-ms) before/after the change
+            @param table    name of the table
+        """
+        legacy = Shift(client=self.client,vocabulary_id='PPI',concept_class_id=['Question','PPI Modifier'],hoist=False,registry=self.registry,salt=self.salt,frozen=self.frozen)
+        hoisted= Shift(client=self.client,vocabulary_id='PPI',concept_class_id=['Question','PPI Modifier'],hoist=True,registry=self.registry,salt=self.salt,frozen=self.frozen)
+        return {"correlated":self.compose(table,legacy),"hoisted":self.compose(table,hoisted)}
+    @staticmethod
+    def side_by_side(left,right,width=90):
+        """
+            This function formats two sql queries in two columns (one line per clause) so they can be compared visually
+        """
+        def split(sql):
+            sql = " ".join(sql.split())
+            for keyword in [' FROM ',' WHERE ',' LEFT JOIN ',' UNION ALL ',' AND ']:
+                sql = sql.replace(keyword,'\n'+keyword.strip()+' ')
+            lines = []
+            for line in sql.split('\n'):
+                lines += [line[i:i+width] for i in range(0,max(len(line),1),width)]
+            return lines
+        left,right = split(left),split(right)
+        rows = []
+        for i in range(max(len(left),len(right))) :
+            _left = left[i] if i < len(left) else ''
+            _right= right[i] if i < len(right) else ''
+            rows.append(_left.ljust(width)+' | '+_right)
+        return "\n".join(rows)
+    def get_layout(self,table):
+        """
+            This function returns the layout of the output table of a table {partition,partition_type,cluster} as specified in the configuration
+            {"layout":{"<table>":{"partition":"<date column>","partition_type":"DAY|MONTH|YEAR","cluster":["<column>",...]}}}, the layout of "*" applies
+            to the tables that aren't specified. The columns can be patterns (e.g *_date, *_concept_id), the first date column matching the partition
+            and the first 4 columns matching the clustering are used. Suppressed and missing columns are ignored.
+            @NOTE: a table can't have more than 4000 partitions, dates that span decades should be partitioned by MONTH
+        """
+        layouts = self.config['layout'] if 'layout' in self.config else {}
+        layout  = layouts[table] if table in layouts else (layouts['*'] if '*' in layouts else {})
+        removed = self.get_remove(table).get('columns',[])
+        fields  = [field for field in self.registry.get_schema(self.i_dataset,table) if field.name not in removed]
+        dates   = [field.name for field in fields if field.field_type in ['DATE','DATETIME','TIMESTAMP'] and 'partition' in layout and fnmatch.fnmatch(field.name,layout['partition'])]
+        cluster = []
+        for pattern in layout['cluster'] if 'cluster' in layout else [] :
+            cluster += [field.name for field in fields if fnmatch.fnmatch(field.name,pattern) and field.name not in cluster and field.field_type not in ['FLOAT','RECORD']]
+        r = {"partition":dates[0] if dates else None,"partition_type":layout['partition_type'] if 'partition_type' in layout else 'DAY',"cluster":cluster[:4]}
+        return r if r['partition'] is not None or r['cluster'] else None
+    def set_layout(self,table,layout):
+        """
+            This function makes sure an existing output table has the layout it is about to be written with :
+            bigquery doesn't change the partitioning (nor the clustering) of a table it overwrites, a table with another layout is removed first
+        """
+        try:
+            info = self.client.get_table(self.client.dataset(self.o_dataset).table(table))
+        except Exception,e:
+            #
+            # The output table doesn't exist yet
+            #
+            return
+        properties = getattr(info,'_properties',None)
+        if properties is None :
+            #
+            # The local engine has no notion of layout
+            #
+            return
+        partition = properties['timePartitioning'] if 'timePartitioning' in properties else {}
+        cluster   = properties['clustering']['fields'] if 'clustering' in properties else []
+        current   = [partition['field'] if 'field' in partition else None,partition['type'] if 'type' in partition else 'DAY',cluster]
+        if layout is None :
+            expected = [None,'DAY',[]]
         else:
-            FILTER += ["AND"]
-        FILTER += [SYS_ARGS['filter']]
-    #
-    # This is not ideal but we have to remove a portion of the population given their age
-    # For now we hard code this instruction and set the age as a parameter
-    # @TODO: ... urgh!!
-    #
-
-    if 'exclude-age' in CONSTANTS :
-        EXCLUDE_AGE_SQL = "person_id not in (SELECT person_id FROM :i_dataset.observation where observation_source_value = 'PIIBirthInformation_BirthDate' and DATE_DIFF(CURRENT_DATE, CAST(value_as_string AS DATE),YEAR) > :age)"
-        EXCLUDE_AGE_SQL = EXCLUDE_AGE_SQL.replace(":age",str(CONSTANTS['exclude-age'])).replace(":i_dataset",i_dataset)
-        if 'rows' in remove or 'filter' in SYS_ARGS :
-            EXCLUDE_AGE_SQL = ['AND', EXCLUDE_AGE_SQL]
+            expected = [layout['partition'],layout['partition_type'],layout['cluster']]
+        if current != expected :
+            Logging.log(subject="composer",object=table,action="layout.change",value={"from":current,"to":expected})
+            self.client.delete_table(info.reference)
+    def get_plan(self,table,plan):
+        """
+            This function returns the hash of the job rebuilding a table as recorded in the manifest (see RunManifest) : the hash of its query and of its layout,
+            a table written with another layout isn't resumed
+        """
+        layout = self.get_layout(table)
+        return PlanCache.get_digest([plan,layout]) if layout is not None else plan
+    def get_parameters(self):
+        """
+            This function returns the query parameters of the de-identification queries i.e the salt of the keyed-hash seeds (see Shift.get_hash)
+        """
+        return [bq.ScalarQueryParameter('salt','STRING',self.salt)] if self.salt is not None else []
+    def get_config(self,table,disposition='WRITE_TRUNCATE'):
+        """
+            This function returns the configuration of the job that writes the de-identified table in the output dataset
+            The layout (partitioning, clustering) of the output table is set when the table is rebuilt, an increment is written in the existing layout
+            @param disposition  WRITE_TRUNCATE (the table is rebuilt) or WRITE_APPEND (increment)
+        """
+        job = bq.QueryJobConfig()
+        if self.o_dataset is not None :
+            job.destination = self.client.dataset(self.o_dataset).table(table)
+            job.write_disposition = disposition
+            layout = self.get_layout(table) if disposition == 'WRITE_TRUNCATE' else None
+            if layout is not None :
+                set_job_layout(job,layout['partition'],layout['partition_type'],layout['cluster'])
+        job.use_query_cache = True
+        job.allow_large_results = True
+        job.priority = 'BATCH'
+        job.query_parameters = self.get_parameters()
+        return job
+    def estimate(self,table):
+        """
+            This function composes the query of a table and submits it as a dry-run i.e nothing is executed nor billed.
+            The function returns the estimate of bigquery {bytes_processed, referenced_tables, sql_length}
+            @param table    name of the table
+        """
+        try:
+            with span("compose",table=table) :
+                sql = self.compose(table)
+            job = self.get_config(table)
+            job.dry_run = True
+            job.use_query_cache = False
+            with span("dry_run",table=table) :
+                r   = self.client.query(sql,location='US',job_config=job)
+            if r.error_result is not None :
+                #
+                # A dry-run can fail without raising, the job is returned with its error
+                #
+                raise Exception(r.error_result['message'] if 'message' in r.error_result else str(r.error_result))
+            referenced = [".".join([ref.dataset_id,ref.table_id]) for ref in r.referenced_tables]
+            return {"table":table,"bytes_processed":r.total_bytes_processed,"referenced_tables":referenced,"sql_length":len(sql),"errors":None}
+        except Exception,e:
+            Logging.log(subject="composer",object=table,action="error.estimate",value=str(e))
+            return {"table":table,"bytes_processed":None,"referenced_tables":[],"sql_length":None,"errors":str(e)}
+    def plan(self):
+        """
+            This function estimates the cost of a run without running it i.e every query is composed as for a run and submitted as a dry-run
+            The function returns the estimates of every table
+        """
+        with span("registry.prefetch",dataset=self.i_dataset) :
+            if self.tables is not None :
+                self.registry.prefetch(self.i_dataset)
+            tables  = self.get_tables()
+        pool    = ThreadPoolExecutor(max_workers=max(1,min(self.pool,len(tables))))
+        summary = list(pool.map(self.estimate,tables))
+        pool.shutdown(wait=True)
+        self.plans.save(self.i_dataset)
+        total   = sum([item['bytes_processed'] for item in summary if item['bytes_processed'] is not None])
+        Logging.log(subject="composer",object=self.i_dataset,action="plan",value={"tables":len(tables),"bytes_processed":total})
+        Logging.log(subject="composer",object=self.i_dataset,action="profile",value=Logging.profile())
+        Logging.flush()
+        return summary
+    def get_merge(self,table,sql,window):
+        """
+            This function returns the MERGE statement that upserts the rows of an increment into the output table (on the key of the window)
+        """
+        fields = [field.name for field in self.registry.get_schema(self.o_dataset,table) if field.name != window['column']]
+        MERGE = "MERGE :o_dataset.:table T USING (:sql) S ON T.:column = S.:column WHEN MATCHED THEN UPDATE SET :fields WHEN NOT MATCHED THEN INSERT ROW"
+        MERGE = MERGE.replace(":fields",",".join([name+" = S."+name for name in fields])).replace(":column",window['column'])
+        return MERGE.replace(":o_dataset",self.o_dataset).replace(":table",table).replace(":sql",sql)
+    def submit(self,table,sql,window=None,plan=None):
+        """
+            This function submits the de-identification query of a table to bigquery, the result is written in the output dataset
+            @TODO: Make sure the o_dataset exists if it doesn't just create it (it's simpler)
+            @param window   range of keys of an increment (None when the table is rebuilt)
+            @param plan     hash of the query recorded in the manifest, see JobTracker.submit (optional)
+        """
+        if window is None :
+            job = self.get_config(table)
+            self.set_layout(table,self.get_layout(table))
+            plan = self.get_plan(table,plan if plan is not None else PlanCache.get_digest(sql))
+        elif self.mode == 'merge' :
+            #
+            # DML statements can't have a destination, the MERGE statement writes in the output table
+            #
+            job = bq.QueryJobConfig()
+            job.use_query_cache = True
+            job.query_parameters = self.get_parameters()
+            sql = self.get_merge(table,sql,window)
         else:
-            EXCLUDE_AGE_SQL = ['WHERE', EXCLUDE_AGE_SQL]
+            job = self.get_config(table,'WRITE_APPEND')
+        r = self.tracker.submit(table,sql,job,plan)
+        Logging.log(subject="composer",object=r.job_id,action="submit.job",value={"from":self.i_dataset+"."+table,"to":self.o_dataset})
+        return r
+    def is_fresh(self,table,name,plan,config):
+        """
+            This function determines if a shard (staging table of the output dataset) can be reused : the manifest of the resumed run records
+            that it was written by the same plan (query of the shard) and it was written after the last change of its input table
+            @param plan     hash of the query of the shard
+            @param config   QueryJobConfig of the shard
+        """
+        if name not in self.existing or self.tracker.get_completed(name,plan,config) is None :
+            return False
+        i_table = self.client.get_table(self.client.dataset(self.i_dataset).table(table))
+        o_table = self.client.get_table(self.client.dataset(self.o_dataset).table(name))
+        return i_table.modified is not None and o_table.modified is not None and o_table.modified >= i_table.modified
+    def do_shards(self,table,window,n):
+        """
+            This function submits the query of every shard of a table, each shard is written in its own staging table of the output dataset.
+            Shards left by a previous (failed) run are reused if they were written by the same query and are more recent than the input table (see is_fresh),
+            so a failed shard is retried without redoing the others
+            @param table    name of the table
+            @param window   range of keys of an increment (None when the table is rebuilt)
+            @param n        number of shards
+        """
+        sqls = []
+        for index in range(n) :
+            with span("compose",table=table,shard=index) :
+                sqls.append(self.compose(table,window=window,shard=(index,n)))
+        #
+        # The combination of the shards is recorded with the plans of the shards (see combine),
+        # the shards of a table whose combination completed in the resumed run aren't recomputed
+        #
+        self.shard_plans[table] = PlanCache.get_digest([PlanCache.get_digest(sql) for sql in sqls])
+        plan = self.get_plan(table,self.shard_plans[table]) if window is None else self.shard_plans[table]
+        if self.tracker.get_completed(table,plan,self.get_config(table)) is not None :
+            Logging.log(subject="composer",object=table,action="shards.resume",value=n)
+            return []
+        names = []
+        for index in range(n) :
+            name = Orchestrator.get_shard_table(table,index,n)
+            sql = sqls[index]
+            job = bq.QueryJobConfig()
+            job.destination = self.client.dataset(self.o_dataset).table(name)
+            job.write_disposition = 'WRITE_TRUNCATE'
+            job.use_query_cache = True
+            job.allow_large_results = True
+            job.priority = 'BATCH'
+            job.query_parameters = self.get_parameters()
+            if self.is_fresh(table,name,PlanCache.get_digest(sql),job) :
+                Logging.log(subject="composer",object=name,action="shard.reuse",value=table)
+                continue
+            self.tracker.submit(name,sql,job)
+            names.append(name)
+        return names
+    def combine(self,table,n):
+        """
+            This function submits the query combining the shards of a table into the output table (once every shard has completed)
+            The function returns the names of the submitted jobs
+            @param table    name of the table
+            @param n        number of shards
+        """
+        names   = [Orchestrator.get_shard_table(table,index,n) for index in range(n)]
+        sql     = " UNION ALL ".join(["SELECT * FROM :o_dataset.:name".replace(":o_dataset",self.o_dataset).replace(":name",name) for name in names])
+        window  = self.windows[table] if table in self.windows and self.windows[table]['low'] is not None else None
+        self.submit(table,sql,window,self.shard_plans[table] if table in self.shard_plans else None)
+        return [table]
+    def drop_shards(self,table,n):
+        """
+            This function removes the shards of a table once they have been combined in the output table
+            The shards may have been removed already (the combination was kept from a resumed run)
+        """
+        tables = set([item.table_id for item in self.client.list_tables(self.client.dataset(self.o_dataset))])
+        for index in [index for index in range(n) if Orchestrator.get_shard_table(table,index,n) in tables] :
+            self.client.delete_table(self.client.dataset(self.o_dataset).table(Orchestrator.get_shard_table(table,index,n)))
+    def do(self,table):
+        """
+            This function will compose and submit the de-identification query of a single table, the function returns the names of the submitted jobs
+            The query of a sharded table is split in several jobs, their results are combined once they have all completed (see combine)
+            @param table    name of the table
+        """
+        try:
+            window = None
+            if self.incremental :
+                window = self.get_window(table)
+                if window is not None and (window['high'] is None or window['high'] <= window['low']) :
+                    Logging.log(subject="composer",object=table,action="incremental.skip",value=window)
+                    return []
+                if window is None :
+                    #
+                    # The table is rebuilt, the watermark will be the highest key found when the query was submitted
+                    #
+                    column = self.get_key(table)
+                    if column is not None :
+                        sql = "SELECT MAX(:column) AS value FROM :i_dataset.:table".replace(":column",column).replace(":i_dataset",self.i_dataset).replace(":table",table)
+                        high = self.client.query(sql).to_dataframe()['value'].values[0]
+                        self.windows[table] = {"column":column,"low":None,"high":high.item() if hasattr(high,'item') else high}
+                else:
+                    self.windows[table] = window
+                Logging.log(subject="composer",object=table,action="incremental.window",value=self.windows[table] if table in self.windows else None)
+            n   = self.get_shards(table)
+            if n > 1 :
+                return self.do_shards(table,window,n)
+            with span("compose",table=table) :
+                sql = self.compose(table,window=window)
+            self.submit(table,sql,window)
+            return [table]
+        except Exception,e:
+            Logging.log(subject="composer",object=table,action="error.do",value=str(e))
+            raise
+    def get_inputs(self,table):
+        """
+            This function returns the tables written during the run that the query of a table reads :
+            the suppressed values of its fields and, if the table has a person_id, the seeding table and the staging tables
+        """
+        r = [".".join([self.i_dataset,self.rules.get_name(table,field)]) for field in self.rules.get_rules(table)]
+        if 'person_id' in [field.name for field in self.registry.get_schema(self.i_dataset,table)] :
+            r += [".".join([self.i_dataset,'people_seed'])] if self.salt is None else []
+            r += [self.staging.get_table(name) for name in self.staging.sets]
+        return r
+    def get_scheduler(self,tables):
+        """
+            This function returns the units of work of a run and their dependencies (see Scheduler) :
+                - the seeding table (unless the seeds are keyed-hashes), the staging tables and the suppressed values of every field
+                - the de-identification query of every table, a sharded table has a unit for its shards and a unit combining them
+        """
+        scheduler = Scheduler(tracker=self.tracker,pool=self.pool,jobs=self.max_jobs)
+        if self.salt is None :
+            seed = lambda: ['people_seed'] if initialization(self.client,self.i_dataset,self.tracker,self.incremental) is not None else []
+            scheduler.add('people_seed',seed,inputs=[self.i_dataset+'.observation'],outputs=[self.i_dataset+'.people_seed'])
+        existing = self.staging.get_existing()
+        for name in self.staging.sets :
+            scheduler.add("people_"+name,lambda name=name: self.staging.submit(name,self.tracker,existing),inputs=[self.i_dataset+'.observation'],
+                outputs=[self.staging.get_table(name)],done=lambda name=name: self.staging.built.add("people_"+name))
+        for table in tables :
+            for field in self.rules.get_rules(table) :
+                name = self.rules.get_name(table,field)
+                scheduler.add(name,lambda table=table,field=field: self.rules.submit(table,field,self.tracker),inputs=[self.i_dataset+'.'+table],
+                    outputs=[self.i_dataset+'.'+name],done=lambda table=table,field=field: self.rules.set_built(table,field))
+        for table in tables :
+            inputs  = [self.i_dataset+'.'+table] + self.get_inputs(table)
+            n       = self.get_shards(table)
+            if n > 1 :
+                shards = [self.o_dataset+'.'+Orchestrator.get_shard_table(table,index,n) for index in range(n)]
+                scheduler.add(table+':shards',lambda table=table: self.do(table),inputs=inputs,outputs=shards)
+                scheduler.add(table,lambda table=table,n=n: self.combine(table,n),inputs=shards,outputs=[self.o_dataset+'.'+table],done=lambda table=table,n=n: self.drop_shards(table,n))
+            else:
+                scheduler.add(table,lambda table=table: self.do(table),inputs=inputs,outputs=[self.o_dataset+'.'+table])
+        return scheduler
+    def run(self):
+        """
+            This function de-identifies all the tables, the seeding table, the staging tables and the suppressed values are built once for the run.
+            The units of work are run in the order of their dependencies (see get_scheduler), the function returns the final state of every table
+        """
+        if self.incremental or self.shards > 1 or 'shards' in self.config :
+            self.existing = set([item.table_id for item in self.client.list_tables(self.client.dataset(self.o_dataset))])
+        with span("registry.prefetch",dataset=self.i_dataset) :
+            if self.tables is not None :
+                #
+                # A single metadata sweep of the dataset is cheaper than two calls per table and per policy
+                #
+                self.registry.prefetch(self.i_dataset)
+            tables  = self.get_tables()
+        scheduler = self.get_scheduler(tables)
+        with span("scheduler.run",dataset=self.i_dataset) :
+            units = scheduler.run()
+        self.plans.save(self.i_dataset)
+        records = self.tracker.get_records()
+        summary = []
+        for table in tables :
+            unit = units[table]
+            item = {"table":table,"job_id":None,"state":'DONE' if unit['state'] == 'DONE' else 'FAILED',"errors":unit['errors']}
+            if unit['state'] == 'CANCELLED' :
+                #
+                # The table wasn't run because a unit it depends on failed
+                #
+                item['errors'] = dict(unit['errors'],errors=units[unit['errors']['cancelled']]['errors'])
+            elif table in unit['jobs'] and records[table] is not None :
+                item.update(records[table])
+            if item['table'] in self.windows and item['state'] != 'FAILED' and self.windows[item['table']]['high'] is not None :
+                window = self.windows[item['table']]
+                self.watermarks.set(item['table'],window['column'],window['high'])
+            summary.append(item)
+        if self.incremental :
+            self.watermarks.save()
+        Logging.log(subject="composer",object=self.i_dataset,action="run",value={"tables":len(tables),"failed":len([1 for item in summary if item['state'] == 'FAILED'])})
+        Logging.log(subject="composer",object=self.i_dataset,action="profile",value=Logging.profile())
+        Logging.flush()
+        return summary
 
-        FILTER += EXCLUDE_AGE_SQL
-    FILTER = " ".join(FILTER)
-    
-    sql = "SELECT * :dropped_fields FROM ("+sql+") "+FILTER
-    
-    #
-    # Bug-fix:
-    #   Insuring the tables maintain their structural integrity
-    dropped_fields = Policy.get_dropped_fields(remove['columns']) if 'columns' in remove else []
-    if len(dropped_fields) > 0 :
-        dropped_fields = ","+",".join(dropped_fields)
-    else:
-        dropped_fields = ""
-    # print sql
-    Logging.log(subject='composer',object=table,action='formatted.removed.columns',value=remove['columns'])
-    sql = sql.replace(":dropped_fields",dropped_fields)
-    # print sql  
+def configure(path):
+    """
+        This function loads the configuration file and initializes the class level parameters of the policies (Policy.TERMS)
+        @param path     path of the configuration file (config.json)
+    """
+    f = open(path)
+    config = json.loads(f.read())
+    f.close()
+    CONSTANTS = config['constants']
+    Policy.TERMS.SEXUAL_ORIENTATION_NOT_STRAIGHT= CONSTANTS['sexual-orientation']['not-straight']
+    Policy.TERMS.SEXUAL_ORIENTATION_STRAIGHT    = CONSTANTS['sexual-orientation']['straight']
+    Policy.TERMS.OBSERVATION_FILTERS            = CONSTANTS['observation-filter']
+    Policy.TERMS.BEGIN_OF_TIME = '1980-07-21' if 'begin-of-time' not in CONSTANTS else CONSTANTS['begin-of-time']
+    return config
+def get_client(sys_args,config):
+    """
+        This function returns the client the queries are submitted through : bigquery (service account of the configuration) or local (--engine local)
+    """
+    if 'engine' in sys_args and sys_args['engine'] == 'local' :
+        #
+        # The queries are run locally (duckdb) against parquet/csv files, see engine.py
+        #
+        from engine import LocalClient
+        return LocalClient(path=sys_args['data'])
+    account_path = config['constants']['service-account-path']
+    return bq.Client.from_service_account_json(account_path)
+def get_args(sys_args,client,config):
+    """
+        This function maps the arguments of the command line to the parameters of the orchestrator (see Orchestrator)
+    """
+    args = {"client":client,"i_dataset":sys_args['i_dataset'],"o_dataset":sys_args['o_dataset'] if 'o_dataset' in sys_args else None,"config":config}
+    if 'table' in sys_args :
+        args['tables'] = [sys_args['table']]
+    elif 'tables' in sys_args :
+        args['tables'] = sys_args['tables']
+    if 'filter' in sys_args :
+        args['filter'] = sys_args['filter']
+    if 'cohort' in sys_args :
+        args['cohort'] = sys_args['cohort']
+    if 'pool' in sys_args :
+        args['pool'] = sys_args['pool']
+    if 'cache' in sys_args :
+        args['cache'] = sys_args['cache']
+    if 'jobs' in sys_args :
+        args['jobs'] = sys_args['jobs']
+    if 'retries' in sys_args :
+        args['retries'] = sys_args['retries']
+    if 'max_jobs' in sys_args :
+        args['max_jobs'] = sys_args['max_jobs']
+    if 'shards' in sys_args :
+        args['shards'] = sys_args['shards']
+    if 'singlepass' in sys_args :
+        args['single_pass'] = True
+    if 'incremental' in sys_args :
+        args['incremental'] = True
+        args['mode'] = sys_args['mode'] if 'mode' in sys_args else 'append'
+    if 'salt' in sys_args :
+        f = open(sys_args['salt'])
+        args['salt'] = f.read().strip()
+        f.close()
+    elif 'DEID_SALT' in os.environ :
+        args['salt'] = os.environ['DEID_SALT']
+    if 'replan' in sys_args :
+        args['replan'] = True
+    if 'manifest' in sys_args :
+        args['manifest'] = sys_args['manifest']
+    if 'resume' in sys_args :
+        #
+        # --resume <manifest> or --resume (the manifest of the datasets in the jobs folder)
+        #
+        args['resume'] = True
+        if sys_args['resume'] != 1 :
+            args['manifest'] = sys_args['resume']
+    return args
+
+#
+# The code below will implement the orchestration and parameter handling from the command line
+# We expect the program to be run as follows :
+#   python deid.py --i_dataset <input_dataset> --table <table_name> --o_dataset <output_dataset> --config path-of-config.json --log
+#   python deid.py --i_dataset <input_dataset> [--tables <table_1,table_2,...>] --o_dataset <output_dataset> --config path-of-config.json [--pool 8]
+# When no table is specified every table of the input dataset will be de-identified
+#
+if __name__ == '__main__' :
     #
-    # @Log: We are logging here the operaton that is expected to take place
-    # {"action":"submit-sql","input":fields,"subject":table,"object":"bq"}      
-    
+    # Overriding config path with the actual configuration file and making sure it is available for use
+    # Once the configuration is available we can begin to create objects to do the work.
+    #   - google cloud client
+    #   - Initialize class level parameters
     #
-    # @TODO: Make sure the o_dataset exists if it doesn't just create it (it's simpler)  
+    SYS_ARGS['config'] = configure(SYS_ARGS['config'])
+    client = get_client(SYS_ARGS,SYS_ARGS['config'])
     #
-    job = bq.QueryJobConfig()
-    job.destination = client.dataset(o_dataset).table(table)
-    job.use_query_cache = True
-    job.allow_large_results = True
-    job.priority = 'BATCH'
-    # job.dry_run = True    
-    r = client.query(sql,location='US',job_config=job)
+    # Let's get the information about the dataset available
+    args = get_args(SYS_ARGS,client,SYS_ARGS['config'])
+    if 'migrate' in SYS_ARGS :
+        #
+        # The seeds of people_seed are frozen for the keyed-hash seeds (nothing else is done)
+        #
+        r = migrate_seeds(client,SYS_ARGS['i_dataset'])
+        r.result()
+        print r.job_id,r.state,r.errors
+        sys.exit(0 if r.errors is None else 1)
 
-    #
-    # @Log: We are logging here the operaton that is expected to take place
-    # {"action":"submit-sql","input":job.job_id,"subject":table,"object":{"status":job.state,"running""job.running}}     
-    print r.job_id,r.state,r.running() ,r.errors
-    Logging.log(subject="composer",object=r.job_id,action="submit.job",value={"from":i_dataset+"."+table,"to":o_dataset})
-    # print dir(r)
-    #@TODO: monitor jobs once submitted
-    pass
+    handler = Orchestrator(**args)
+    if 'stale' in SYS_ARGS :
+        #
+        # The persisted queries that would be rebuilt by the next run (nothing is submitted)
+        #
+        for item in handler.stale() :
+            print item['id'],item['date'],",".join(item['changed'])
+        sys.exit(0)
+    if 'compare' in SYS_ARGS :
+        #
+        # The queries with a per-field seed lookup and with a hoisted seed join are printed side by side (nothing is submitted)
+        #
+        for table in handler.get_tables() :
+            r = handler.compare(table)
+            print Orchestrator.side_by_side(r['correlated'],r['hoisted'])
+            print len(r['correlated']),len(r['hoisted'])
+        sys.exit(0)
+    if 'verify' in SYS_ARGS :
+        #
+        # The single scan query of the meta tables is checked against the union of scans (the queries are run, nothing is written)
+        #
+        summary = [handler.verify(table) for table in handler.get_tables() if table in Policy.META_TABLES]
+        for item in summary :
+            print item['table'],item['union'],item['single_pass'],item['union_only'],item['single_pass_only'],item['equivalent']
+        sys.exit(0 if len([1 for item in summary if not item['equivalent']]) == 0 else 1)
+    if 'plan' in SYS_ARGS :
+        #
+        # Dry-run of every table : nothing is executed nor billed, we report the bytes that would be processed
+        #
+        summary = handler.plan()
+        for item in summary :
+            print item['table'],item['bytes_processed'],item['sql_length'],",".join(item['referenced_tables']),item['errors'] if item['errors'] else ''
+        print 'total',sum([item['bytes_processed'] for item in summary if item['bytes_processed'] is not None])
+        sys.exit(0 if len([1 for item in summary if item['errors']]) == 0 else 1)
+    summary = handler.run()
+    for item in summary :
+        print item['table'],item['job_id'],item['state'],item['errors']
+    sys.exit(0 if len([1 for item in summary if item['state'] == 'FAILED']) == 0 else 1)
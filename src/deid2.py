@@ -5,74 +5,628 @@
         We have identified two types of tables :
         - relational tables : The semantics are defined in the structure of the table
         - meta tables       : The semantics are defined in the content and sometimes the structure
-    
-    The obvious limitation of this is that it will load all the data into memory 
+
+    The data is streamed i.e the rows of a table are read in bounded chunks (pages of bigquery or chunks of a file).
+    Every chunk is de-identified (generalization, date shifting, suppression) and written to the output before the next chunk is read.
+    The memory used is bounded by the size of a chunk and the per-person lookups (seeds, multi-racial people, excluded people)
+    no matter how big the table is.
+
+    The rules are those of deid.py (the rows of a meta table are classified and processed as the branches of the query deid.py builds)
+
+    Usage :
+        python deid2.py --config path-of-config.json --i_dataset <input_dataset> --table <table_name> [--o_dataset <output_dataset>|--output <file.csv>] [--chunk 100000]
+        python deid2.py --benchmark [--rows 50000000]
+        python deid2.py --config path-of-config.json --engine local --data <folder> --i_dataset <input_dataset> --table <table_name> --output <file.csv>
+        python deid2.py --config path-of-config.json --i_dataset <input_dataset> --table <table_name> --output <file.csv> --salt <file>
 """
 from __future__ import division
-from google.cloud import bigquery as bq
+from datetime import datetime
 import pandas as pd
+import numpy as np
 import json
-class Policy():
+import sys
+import re
+import os
+import io
+import deid
+#
+# The cloud client is only imported when it is used (see deid.LazyModule)
+#
+from deid import bq
+
+DATE_TYPES = ['DATE','DATETIME','TIMESTAMP']
+
+class BigQueryReader :
+    """
+        This class reads the rows of a bigquery table one page at a time
+    """
     def __init__(self,**args):
-        # if 'client' in args :
-        #     self.client = args['client']
-        # elif 'path' in args:
-        #     self.client = bq.Client.from_service_account_json(args['path'])
-        self.path = args['path']
-        self.client = bq.Client.from_service_account_json(args['path'])
-        self.project_id = args['project_id'] if 'project_id' in args else None
-    def init(self,**args):
-        if 'dataset' in args and 'table' in args :
-            self.sql = "SELECT * FROM :dataset.:table".replace(":dataset",args['dataset']).replace(":table",args['table'])
+        """
+            @param client   initialized big query client
+            @param dataset  name of the dataset
+            @param table    name of the table
+            @param size     number of rows per chunk
+        """
+        self.client = args['client']
+        self.table  = self.client.get_table(self.client.dataset(args['dataset']).table(args['table']))
+        self.size   = int(args['size'])
+    def get_fields(self):
+        return [(field.name,field.field_type) for field in self.table.schema]
+    def read(self):
+        names = [field.name for field in self.table.schema]
+        rows = self.client.list_rows(self.table,page_size=self.size)
+        for page in rows.pages :
+            yield pd.DataFrame([list(row.values()) for row in page],columns=names)
+
+class FileReader :
+    """
+        This class reads the rows of a (csv, parquet) file one chunk at a time
+        The types of the fields of a csv file written by the local engine are those of its schema file (see engine.LocalClient),
+        the types of the fields of any other csv file are inferred from their names (e.g visit_start_date)
+        @NOTE: parquet files are read with pyarrow, it must be loaded before duckdb (0.2.0) or the engine crashes when it returns rows
+    """
+    def __init__(self,**args):
+        """
+            @param path     path of the file
+            @param size     number of rows per chunk
+        """
+        self.path   = args['path']
+        self.size   = int(args['size'])
+        self.schema = None
+        if not self.path.endswith('.parquet') :
+            from engine import LocalClient
+            if os.path.exists(LocalClient.get_schema_file(self.path)) :
+                f = open(LocalClient.get_schema_file(self.path))
+                self.schema = json.loads(f.read())
+                f.close()
+    def get_fields(self):
+        if self.path.endswith('.parquet') :
+            import pyarrow.parquet as pq
+            schema = pq.ParquetFile(self.path).schema_arrow if hasattr(pq.ParquetFile,'schema_arrow') else pq.read_schema(self.path)
+            types = [(field.name,str(field.type)) for field in schema]
+            return [(name,'DATE' if _type.startswith('date') else ('TIMESTAMP' if _type.startswith('timestamp') else _type.upper())) for name,_type in types]
+        elif self.schema is not None :
+            from engine import Table
+            return [(field['name'],Table.TYPES.get(field['type'].split('(')[0],'STRING')) for field in self.schema]
         else:
-            self.sql = args['sql']
-        #
-        # Loading the table at this point into a data frame 
-        if self.project_id is None :
-            f = open(path)
-            p = json.loads(f.read())
-            self.project_id = p['project_id']
-            f.close()
-        self.df = None
-        try:
-            self.df = pd.read_gbq(sql,project_id=self.project_id,private_key=self.path)            
+            names = pd.read_csv(self.path,nrows=0).columns.tolist()
+            ref = set(['date','datetime','timestamp'])
+            return [(name,'DATE' if set(name.split('_')) & ref else 'STRING') for name in names]
+    def read(self):
+        if self.path.endswith('.parquet') :
+            import pyarrow.parquet as pq
+            f = pq.ParquetFile(self.path)
+            if hasattr(f,'iter_batches') :
+                for batch in f.iter_batches(batch_size=self.size) :
+                    yield batch.to_pandas()
+            else:
+                for i in range(f.num_row_groups) :
+                    yield f.read_row_group(i).to_pandas()
+        elif self.schema is not None :
             #
-            # at this point we have the list of fields to remove and we need to add date fields
-            # Datefields will be processed differently i.e they will require shifting ...
+            # The files written by the local engine have no header
             #
-            ltypes = self.df.ftype
-            ref = set(['date','datetime','timestamp'])
-            [ for id in  self.columns if ( set(ltypes[id].replace(':dense','').replace('64','').split('[ns]')) & set() ) or (set(id.split('_')) & ref)]
-        except Exception,e:
-            print (e)
+            for df in pd.read_csv(self.path,chunksize=self.size,header=None,names=[field['name'] for field in self.schema]) :
+                yield df
+        else:
+            for df in pd.read_csv(self.path,chunksize=self.size) :
+                yield df
+
+class FileWriter :
+    """
+        This class appends the de-identified chunks to a csv file
+    """
+    def __init__(self,**args):
+        self.path   = args['path']
+        self.header = True
+    def write(self,df):
+        df.to_csv(self.path,mode='w' if self.header else 'a',header=self.header,index=False,date_format='%Y-%m-%d')
+        self.header = False
+    def close(self):
+        pass
+
+class BigQueryWriter :
+    """
+        This class loads the de-identified chunks into a bigquery table, the first chunk replaces the table and the others are appended
+    """
+    def __init__(self,**args):
+        """
+            @param client   initialized big query client
+            @param dataset  name of the output dataset
+            @param table    name of the output table
+            @param schema   list of (name,type) of the output table
+        """
+        self.client = args['client']
+        self.ref    = self.client.dataset(args['dataset']).table(args['table'])
+        self.schema = [bq.SchemaField(name,field_type) for name,field_type in args['schema']]
+        self.disposition = 'WRITE_TRUNCATE'
+    def write(self,df):
+        stream = io.BytesIO(df.to_csv(index=False,header=False,date_format='%Y-%m-%d').encode('utf-8'))
+        job = bq.LoadJobConfig()
+        job.source_format = 'CSV'
+        job.schema = self.schema
+        job.write_disposition = self.disposition
+        self.client.load_table_from_file(stream,self.ref,job_config=job).result()
+        self.disposition = 'WRITE_APPEND'
+    def close(self):
+        pass
+
+class ShiftKernel :
+    """
+        This class implements date shifting as vectorized numpy operations, it has the semantics of deid.Shift i.e
+            DATE_SUB(CAST(x AS DATE), INTERVAL seed DAY)
+        The seeds are held in arrays sorted by person_id, the person_id of a chunk are factorized once and their seeds found with a binary search (searchsorted).
+        Every column is then shifted with a single datetime64 subtraction, people without a seed get NaT (as the LEFT JOIN does in sql)
+        e.g :
+            kernel = ShiftKernel(ids=[1,2],seeds=[10,20])
+            kernel.shift(df,['visit_start_date'])
+    """
+    def __init__(self,**args):
+        """
+            @param ids      person_id of the people_seed table
+            @param seeds    seeds (in days) of the people_seed table
+        """
+        ids     = np.asarray(args['ids'],dtype=np.int64)
+        seeds   = np.asarray(args['seeds'],dtype=np.int64)
+        index   = np.argsort(ids,kind='mergesort')
+        self.ids    = ids[index]
+        self.seeds  = seeds[index]
+    def __len__(self):
+        return self.ids.size
+    def get_seeds(self,person_ids):
+        """
+            This function returns the seeds (timedelta64[D]) of every row, NaT when a person has no seed
+            @param person_ids   person_id of the rows of a chunk
+        """
+        codes,uniques = pd.factorize(person_ids)
+        uniques = np.asarray(uniques,dtype=np.int64)
+        #
+        # The last position is NaT so that missing person_id (code -1) and people without a seed resolve to NaT
+        #
+        values  = np.empty(uniques.size + 1,dtype='timedelta64[D]')
+        values[:] = np.timedelta64('NaT','D')
+        if self.ids.size > 0 and uniques.size > 0 :
+            pos     = np.minimum(np.searchsorted(self.ids,uniques),self.ids.size - 1)
+            found   = self.ids[pos] == uniques
+            values[:-1][found] = self.seeds[pos[found]].astype('timedelta64[D]')
+        codes = np.where(codes < 0,uniques.size,codes)
+        return values[codes]
+    def shift(self,df,names,rows=None):
+        """
+            This function shifts the date columns of a chunk (in place) and the dates held in value_as_string for the flagged rows
+            @param df       chunk (data-frame) with a person_id column
+            @param names    names of the date/datetime/timestamp columns
+            @param rows     boolean mask of the rows whose value_as_string is a date (optional)
+        """
+        seeds = self.get_seeds(df['person_id'].values)
+        for name in names :
             #
-            #@TODO: Log the error and terminate gracefully
+            # CAST(x AS DATE) i.e truncate to the day, then subtract the seed
+            #
+            values = pd.to_datetime(df[name],errors='coerce').values.astype('datetime64[D]')
+            df[name] = (values - seeds).astype('datetime64[ns]')
+        if rows is not None and rows.any() :
+            rows = np.asarray(rows,dtype=bool)
+            values = pd.to_datetime(df['value_as_string'].values[rows],errors='coerce').values.astype('datetime64[D]') - seeds[rows]
+            values = pd.Series(values.astype('datetime64[ns]')).dt.strftime('%Y-%m-%d')
+            df.loc[rows,'value_as_string'] = values.values
+        return df
+
+class HashKernel(ShiftKernel):
+    """
+        This class shifts the dates with the keyed-hash seeds (see deid.Shift), the frozen seeds (if any) take precedence.
+        The seed of a person is computed once and remembered for the chunks that follow
+        e.g :
+            kernel = HashKernel(salt='...',ids=[],seeds=[])
+            kernel.shift(df,['visit_start_date'])
+    """
+    def __init__(self,**args):
+        """
+            @param salt     secret of the keyed hash
+            @param ids      person_id of the frozen seeds
+            @param seeds    frozen seeds (in days)
+        """
+        ShiftKernel.__init__(self,**args)
+        self.salt   = args['salt']
+        self.hashes = {}
+    def get_seeds(self,person_ids):
+        codes,uniques = pd.factorize(person_ids)
+        uniques = np.asarray(uniques,dtype=np.int64)
+        values  = np.empty(uniques.size + 1,dtype='timedelta64[D]')
+        values[:] = np.timedelta64('NaT','D')
+        values[:-1] = ShiftKernel.get_seeds(self,uniques)
+        for i in np.where(np.isnat(values[:-1]))[0] :
+            person_id = uniques[i]
+            if person_id not in self.hashes :
+                self.hashes[person_id] = deid.Shift.hash_seed(self.salt,person_id)
+            values[i] = np.timedelta64(self.hashes[person_id],'D')
+        codes = np.where(codes < 0,uniques.size,codes)
+        return values[codes]
+
+def benchmark(rows=50000000,people=1000000):
+    """
+        This function measures the throughput (rows/second) of the date shifting kernel on a synthetic observation chunk
+        The chunk has 2 date columns and 1% of the rows hold a date in value_as_string
+        @param rows     number of rows of the synthetic chunk
+        @param people   number of distinct people
+    """
+    import time
+    np.random.seed(0)
+    kernel  = ShiftKernel(ids=np.arange(people),seeds=np.random.randint(1,365,people))
+    days    = np.random.randint(0,365*20,rows).astype('timedelta64[D]') + np.datetime64('2000-01-01')
+    df      = pd.DataFrame({"person_id":np.random.randint(0,people,rows),"observation_date":days.astype('datetime64[ns]')})
+    df['observation_datetime'] = df['observation_date']
+    df['value_as_string'] = None
+    flags   = np.zeros(rows,dtype=bool)
+    flags[::100] = True
+    df.loc[flags,'value_as_string'] = '2015-06-01'
+    start   = time.time()
+    kernel.shift(df,['observation_date','observation_datetime'],flags)
+    duration = time.time() - start
+    return {"rows":rows,"seconds":round(duration,3),"rows_per_second":int(rows / duration)}
+
+class Lookup :
+    """
+        This class holds the per-person and per-concept information needed to de-identify a chunk, it is loaded once per run.
+        Its size depends on the number of people (and concepts) not on the size of the table being de-identified
+    """
+    def __init__(self,**args):
+        """
+            @param client   initialized big query client (or engine.LocalClient)
+            @param dataset  name of the input dataset
+            @param age      people older than age are excluded (optional)
+            @param salt     secret of the keyed-hash seeds, the seeds of people_seed are used if none is provided (optional)
+        """
+        self.client     = args['client']
+        self.dataset    = args['dataset']
+        self.concepts   = deid.Concepts(client=self.client)
+        salt            = args['salt'] if 'salt' in args else None
+        if salt is None :
+            r = self.client.query("SELECT person_id, MAX(seed) AS seed FROM :i_dataset.people_seed GROUP BY person_id".replace(":i_dataset",self.dataset)).to_dataframe()
+            self.seeds  = ShiftKernel(ids=r['person_id'].values,seeds=r['seed'].values)
+        else:
+            tables = [table.table_id for table in self.client.list_tables(self.client.dataset(self.dataset))]
+            sql = "SELECT person_id, seed FROM :i_dataset.:table".replace(":i_dataset",self.dataset).replace(":table",deid.Shift.FROZEN)
+            r = self.client.query(sql).to_dataframe() if deid.Shift.FROZEN in tables else pd.DataFrame({"person_id":[],"seed":[]})
+            self.seeds  = HashKernel(salt=salt,ids=r['person_id'].values,seeds=r['seed'].values)
+        r = self.client.query(deid.Staging(client=self.client,dataset=self.dataset).get_sql('multi_racial')).to_dataframe()
+        self.multi_racial = set(r['person_id'].tolist())
+        self.excluded   = set()
+        if 'age' in args and args['age'] is not None :
+            sql = "SELECT person_id FROM :i_dataset.observation where observation_source_value = 'PIIBirthInformation_BirthDate' and DATE_DIFF(CURRENT_DATE, CAST(value_as_string AS DATE),YEAR) > :age"
+            r = self.client.query(sql.replace(":age",str(args['age'])).replace(":i_dataset",self.dataset)).to_dataframe()
+            self.excluded = set(r['person_id'].tolist())
         #
-        # @TODO: Log the status of the operation here (success|failure) i.e test self.df
+        # The concepts of the questions (and PPI modifiers) and the codes of the dates are needed to classify the rows of a meta table
         #
-    def can_do(self,**args) :
+        sql = "SELECT concept_id,concept_code,vocabulary_id,concept_class_id FROM :i_dataset.concept WHERE vocabulary_id = 'PPI' OR REGEXP_CONTAINS(concept_code,'(?i)(:keys)') OR REGEXP_CONTAINS(concept_code,'Date|DATE|date')"
+        sql = sql.replace(":keys","|".join(deid.Policy.TERMS.OBSERVATION_FILTERS.keys())).replace(":i_dataset",self.dataset)
+        self.catalog    = self.client.query(sql).to_dataframe()
+        deid.Logging.log(subject='lookup',object=self.dataset,action='init',value={"seeds":len(self.seeds),"multi_racial":len(self.multi_racial),"excluded":len(self.excluded)})
+
+class Policy():
+    """
+        A policy transforms a chunk of a table (data-frame) into its de-identified form
+    """
+    def __init__(self,**args):
+        """
+            @param lookup   per-person and per-concept information, see Lookup
+            @param table    name of the table
+            @param fields   list of (name,type) of the table
+        """
+        self.lookup = args['lookup']
+        self.table  = args['table']
+        self.fields = args['fields']
+    def get_date_fields(self):
+        return [name for name,field_type in self.fields if field_type in DATE_TYPES]
+    def can_do(self) :
         return False
-    def get_tuples(self) :
-        return []
-    def do(self):
-        pass
+    def do(self,df):
+        return df
+    def name(self):
+        return self.__class__.__name__.lower()
+
+class Group(Policy):
+    """
+        This class implements the generalizations of deid.Group on a chunk of a meta table.
+        The rows are classified as the branches of the query built by deid.py :
+            - base rows (questions that are neither dates nor subject to generalization)
+            - rows of every category subject to generalization (race, gender, ...), they are generalized
+            - rows holding dates (value_as_string), they will be shifted
+        Rows that belong to none of the above are removed (as they are by deid.py)
+        The rows holding dates are those whose observation_source_value is the code of a date concept (concept table), as in the query of deid.py
+    """
+    def __init__(self,**args):
+        Policy.__init__(self,**args)
+        self.filters = deid.Policy.TERMS.OBSERVATION_FILTERS
+        catalog = self.lookup.catalog
+        codes = catalog['concept_code'].fillna('')
+        #
+        # base rows : PPI questions & modifiers that aren't dates nor subject to generalization
+        #
+        base = (catalog['vocabulary_id'] == 'PPI') & catalog['concept_class_id'].isin(['Question','PPI Modifier'])
+        base = base & (codes.str.contains("Date|"+"|".join(self.filters.values())) == False)
+        self.base_ids = set(catalog[base]['concept_id'].tolist())
+        self.category_ids = {}
+        for key in self.filters :
+            self.category_ids[key] = set(catalog[codes.str.contains(key,case=False)]['concept_id'].tolist())
+        #
+        # date rows : the codes of the concepts that are dates and aren't subject to generalization
+        #
+        dates = codes.str.contains('Date|DATE|date') & (codes.str.contains("|".join(self.filters.values())) == False)
+        self.date_codes = set(catalog[dates]['concept_code'].tolist())
+        self.rules = dict([(key,self.get_rule(key)) for key in self.filters])
+    def can_do(self):
+        return self.table in deid.Policy.META_TABLES
+    def get_rule(self,key):
+        """
+            This function returns the concepts that are kept as is and the concept/name that replaces the others for a category (see deid.Group)
+        """
+        r = self.lookup.concepts.get(self.lookup.dataset,key)
+        if key == 'race' :
+            other = r[r['concept_name'] == 'Other Race']
+            ids = r[r['concept_name'] != 'Other Race']['concept_id'].tolist()
+            return {"ids":ids,"other_id":int(other['concept_id'].tolist()[0]),"other_name":other['concept_name'].tolist()[0]}
+        elif key == 'gender' :
+            other = r[r['concept_name'] == 'OTHER']
+            ids = r[r['concept_name'] != 'OTHER']['concept_id'].tolist()
+            return {"ids":ids,"other_id":int(other['concept_id'].tolist()[0]),"other_name":other['concept_name'].tolist()[0]}
+        elif key == 'orientation' :
+            other = r[r['concept_code'] == deid.Policy.TERMS.SEXUAL_ORIENTATION_NOT_STRAIGHT]
+            ids = r[r['concept_code'] == deid.Policy.TERMS.SEXUAL_ORIENTATION_STRAIGHT]['concept_id'].tolist()
+            return {"ids":ids,"other_id":int(other['concept_id'].tolist()[0]),"other_name":other['concept_code'].tolist()[0]}
+        else:
+            return {"ids":r['concept_id'].tolist(),"other_id":0,"other_name":'Unknown'}
+    def generalize(self,df,key):
+        """
+            This function generalizes the rows of a category (copy of the rows)
+        """
+        rule = self.rules[key]
+        if len(rule['ids']) == 0 :
+            return df
+        df = df.copy()
+        #
+        # value_source_concept_id not in (...) is unknown (false) in sql when value_source_concept_id is null
+        #
+        other = df['value_source_concept_id'].notnull() & (df['value_source_concept_id'].isin(rule['ids']) == False)
+        df.loc[other,'value_as_string'] = rule['other_name']
+        df.loc[other,'observation_source_concept_id'] = rule['other_id']
+        df.loc[other,'value_source_value'] = rule['other_name']
+        if key == 'race' :
+            df.loc[other,'value_source_concept_id'] = rule['other_id']
+            multi = df['person_id'].isin(self.lookup.multi_racial)
+            df.loc[multi,'value_as_string'] = 'Multi-Racial'
+            df.loc[multi,'observation_source_concept_id'] = 2000000
+            df.loc[multi,'value_source_concept_id'] = 2000000
+            df.loc[multi,'value_source_value'] = 'Multi-Racial'
+        else:
+            df.loc[other,'observation_source_value'] = rule['other_name']
+        return df
+    def do(self,df):
+        branches = [df[df['observation_source_concept_id'].isin(self.base_ids)]]
+        for key in self.filters :
+            rows = df[df['observation_source_concept_id'].isin(self.category_ids[key])]
+            if rows.shape[0] > 0 :
+                branches.append(self.generalize(rows,key))
+        rows = df[df['observation_source_value'].isin(self.date_codes)].copy()
+        rows['__shift_value__'] = True
+        branches.append(rows)
+        r = pd.concat(branches,ignore_index=True,sort=False)
+        r['__shift_value__'] = r['__shift_value__'].fillna(False).astype(bool)
+        return r
+
+class Shift(Policy):
+    """
+        This class shifts the dates of a chunk by the seed of every person i.e DATE_SUB(CAST(x AS DATE), INTERVAL seed DAY)
+        The dates held in value_as_string (rows flagged by Group) are shifted as well
+    """
+    def can_do(self):
+        return len(self.get_date_fields()) > 0 or self.table in deid.Policy.META_TABLES
+    def do(self,df):
+        rows = None
+        if '__shift_value__' in df.columns :
+            rows = df['__shift_value__'].values
+            del df['__shift_value__']
+        return self.lookup.seeds.shift(df,self.get_date_fields(),rows)
+
+class Matcher :
+    """
+        This class matches a value against several patterns at once (Aho-Corasick automaton)
+        The literal patterns are matched in a single scan of the value no matter how many there are,
+        the patterns that are regular expressions (if any) are evaluated with the re module.
+        e.g :
+            matcher = Matcher(patterns=['Text','_City','WordAddress'])
+            matcher.search('PIIAddress_City')   #-- True
+    """
+    SPECIAL = set('.^$*+?{}[]\\|()')
+    def __init__(self,**args):
+        """
+            @param patterns list of patterns (as found in the configuration file)
+        """
+        patterns    = args['patterns']
+        literals    = [item for item in patterns if not Matcher.SPECIAL & set(item) and item != '']
+        others      = [item for item in patterns if item not in literals]
+        self.regex  = re.compile("|".join(others)) if others else None
+        #
+        # goto[state] : transitions of a state, fail[state] : longest proper suffix that is a state, found[state] : a pattern ends at this state
+        #
+        self.goto   = [{}]
+        self.fail   = [0]
+        self.found  = [False]
+        for pattern in literals :
+            state = 0
+            for char in pattern :
+                if char not in self.goto[state] :
+                    self.goto.append({})
+                    self.fail.append(0)
+                    self.found.append(False)
+                    self.goto[state][char] = len(self.goto) - 1
+                state = self.goto[state][char]
+            self.found[state] = True
+        queue = list(self.goto[0].values())
+        while queue :
+            state = queue.pop(0)
+            for char in self.goto[state] :
+                _state = self.goto[state][char]
+                queue.append(_state)
+                fail = self.fail[state]
+                while fail and char not in self.goto[fail] :
+                    fail = self.fail[fail]
+                self.fail[_state] = self.goto[fail][char] if char in self.goto[fail] and self.goto[fail][char] != _state else 0
+                self.found[_state] = self.found[_state] or self.found[self.fail[_state]]
+    def search(self,value):
+        """
+            This function returns True if any of the patterns is found in the value
+        """
+        state = 0
+        for char in value :
+            while state and char not in self.goto[state] :
+                state = self.fail[state]
+            state = self.goto[state][char] if char in self.goto[state] else 0
+            if self.found[state] :
+                return True
+        return self.regex is not None and self.regex.search(value) is not None
+
+class Filter(Policy):
+    """
+        This class removes the rows to be suppressed before any other policy is applied (as deid.py does in every scan of a table) :
+            - rows whose field matches the patterns of the configuration (or is NULL)
+            - rows of excluded people
+        The patterns are evaluated once per distinct value, the outcome is remembered for the chunks that follow
+    """
+    def __init__(self,**args):
+        """
+            @params remove     {columns:[],rows:{field:[patterns]}}
+        """
+        Policy.__init__(self,**args)
+        remove = args['remove'] if 'remove' in args else {}
+        self.rows = dict([(field,Matcher(patterns=remove['rows'][field])) for field in remove['rows']]) if 'rows' in remove else {}
+        self.suppressed = dict([(field,{}) for field in self.rows])
+    def can_do(self):
+        return len(self.rows) > 0 or len(self.lookup.excluded) > 0
+    def get_suppressed(self,field,values):
+        """
+            This function returns the values of a chunk that are suppressed, only the values never seen before are matched
+        """
+        known = self.suppressed[field]
+        for value in pd.unique(values.dropna()) :
+            if value not in known :
+                known[value] = self.rows[field].search(str(value))
+        return [value for value in known if known[value]]
+    def do(self,df):
+        keep = np.ones(df.shape[0],dtype=bool)
+        for field in self.rows :
+            values = df[field]
+            keep &= values.notnull().values & (values.isin(self.get_suppressed(field,values)).values == False)
+        if 'person_id' in df.columns and len(self.lookup.excluded) > 0 :
+            keep &= df['person_id'].isin(self.lookup.excluded).values == False
+        return df[keep] if not keep.all() else df
+
 class Suppress(Policy):
     """
         This class will implement suppression for both relational tables and meta-tables.
         The class will additionally handle the case of meta tables that have relational attributes that need suppression
-
+        The rows are removed beforehand, see Filter
     """
     def __init__(self,**args):
         """
             Initiate suppression of attributes in a table
-            @params remove     list of fields to be removed in addition Date/TimeStamps will be removed (no need to specify them)
+            @params remove     {columns:[],rows:{field:[patterns]}} columns to be emptied
         """
-        self.remove_fields = args['remove'] if 'remove' in args else []
-        
-    def basic(self):
+        Policy.__init__(self,**args)
+        self.remove = args['remove'] if 'remove' in args else {}
+        self.columns = self.remove['columns'] if 'columns' in self.remove else []
+    def can_do(self):
+        return len(self.columns) > 0
+    def do(self,df):
+        for name in self.columns :
+            if name in df.columns :
+                df[name] = ''
+        return df
+
+class Pipeline :
+    """
+        This class streams a table through the policies : read a chunk, de-identify it, write it and move on to the next chunk
+        e.g :
+            handler = Pipeline(reader=reader,writer=writer,lookup=lookup,table='observation',remove=remove)
+            handler.run()
+    """
+    def __init__(self,**args):
         """
-            This will remove basic fields from the 
+            @param reader   BigQueryReader|FileReader
+            @param writer   BigQueryWriter|FileWriter
+            @param lookup   per-person and per-concept information, see Lookup
+            @param table    name of the table
+            @param remove   suppression specifications of the table {columns:[],rows:{}}
         """
-        pass
-    def meta(self):
-        pass
\ No newline at end of file
+        self.reader = args['reader']
+        self.writer = args['writer']
+        self.table  = args['table']
+        _args = {"lookup":args['lookup'],"table":self.table,"fields":self.reader.get_fields(),"remove":args['remove'] if 'remove' in args else {}}
+        self.policies = [policy for policy in [Filter(**_args),Group(**_args),Shift(**_args),Suppress(**_args)] if policy.can_do()]
+    def run(self):
+        r = {"chunks":0,"rows_in":0,"rows_out":0}
+        reader = self.reader.read()
+        while True :
+            with deid.span("read",table=self.table) :
+                df = next(reader,None)
+            if df is None :
+                break
+            r['chunks'] += 1
+            r['rows_in'] += df.shape[0]
+            for policy in self.policies :
+                with deid.span(policy.name()+".do",table=self.table,rows=df.shape[0]) :
+                    df = policy.do(df)
+            r['rows_out'] += df.shape[0]
+            with deid.span("write",table=self.table) :
+                self.writer.write(df)
+            deid.Logging.log(subject='pipeline',object=self.table,action='chunk',value={"chunk":r['chunks'],"rows":df.shape[0]})
+        self.writer.close()
+        deid.Logging.log(subject='pipeline',object=self.table,action='profile',value=deid.Logging.profile())
+        deid.Logging.flush()
+        return r
+
+if __name__ == '__main__' :
+    SYS_ARGS = deid.SYS_ARGS
+    if 'benchmark' in SYS_ARGS :
+        print (benchmark(rows=int(SYS_ARGS['rows']) if 'rows' in SYS_ARGS else 50000000))
+        sys.exit()
+    config = deid.configure(SYS_ARGS['config'])
+    CONSTANTS = config['constants']
+    if 'engine' in SYS_ARGS and SYS_ARGS['engine'] == 'local' :
+        #
+        # pyarrow (parquet files) must be loaded before duckdb, see FileReader
+        #
+        try:
+            import pyarrow.parquet
+        except ImportError:
+            pass
+        from engine import LocalClient
+        client = LocalClient(path=SYS_ARGS['data'])
+    else:
+        client = bq.Client.from_service_account_json(CONSTANTS['service-account-path'])
+    i_dataset   = SYS_ARGS['i_dataset']
+    table       = SYS_ARGS['table']
+    size        = int(SYS_ARGS['chunk']) if 'chunk' in SYS_ARGS else 100000
+    remove      = config['suppression'][table] if table in config['suppression'] else {}
+    if 'input' in SYS_ARGS :
+        reader = FileReader(path=SYS_ARGS['input'],size=size)
+    elif 'engine' in SYS_ARGS and SYS_ARGS['engine'] == 'local' :
+        reader = FileReader(path=client.get_file(i_dataset,table),size=size)
+    else:
+        reader = BigQueryReader(client=client,dataset=i_dataset,table=table,size=size)
+    if 'output' in SYS_ARGS :
+        writer = FileWriter(path=SYS_ARGS['output'])
+    else:
+        schema = [(name,'DATE' if field_type in DATE_TYPES else ('STRING' if name in remove.get('columns',[]) else field_type)) for name,field_type in reader.get_fields()]
+        writer = BigQueryWriter(client=client,dataset=SYS_ARGS['o_dataset'],table=table,schema=schema)
+    salt    = None
+    if 'salt' in SYS_ARGS :
+        f = open(SYS_ARGS['salt'])
+        salt = f.read().strip()
+        f.close()
+    elif 'DEID_SALT' in os.environ :
+        salt = os.environ['DEID_SALT']
+    lookup  = Lookup(client=client,dataset=i_dataset,age=CONSTANTS['exclude-age'] if 'exclude-age' in CONSTANTS else None,salt=salt)
+    handler = Pipeline(reader=reader,writer=writer,lookup=lookup,table=table,remove=remove)
+    print (handler.run())
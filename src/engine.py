@@ -0,0 +1,552 @@
+"""
+    AoUS - DEID, 2018
+
+    This file implements a local execution backend for the de-identification queries.
+    The queries built by deid.py are written in bigquery's (standard) sql dialect and submitted through a bigquery client.
+    The local backend exposes the subset of the bigquery client used by deid.py (dataset, list_tables, get_table, delete_table, query, get_job)
+    and runs the very same queries with an embedded analytical engine (duckdb) against csv/parquet files.
+    The engine is written against duckdb 0.2.0, the last release that installs on python 2.7 (the interpreter deid.py targets).
+
+    Design:
+        - Every sub-folder of the data folder is a dataset and every file (csv, parquet) in it is a table e.g data/raw/observation.csv
+        - Tables are exposed to the engine as views i.e the files are scanned by the engine, they are never loaded in memory
+        - Query results with a destination are written as csv files (without header) in the folder of the destination dataset,
+          the types of the columns are written beside them (<table>.schema.json) so the tables are read back with their types
+        - The sql dialect of bigquery is translated to the engine's (see Dialect) before execution
+
+    Usage :
+        python deid.py --engine local --data <folder> --i_dataset <input_dataset> --o_dataset <output_dataset> --config path-of-config.json
+
+    Requirements:
+        pip install duckdb==0.2.0 pandas==0.24.2 (see requirements.txt)
+    @NOTE:
+        - FARM_FINGERPRINT is translated to a polynomial hash of the characters, the values differ from bigquery's but are just as deterministic
+        - SHA256/TO_HEX (keyed-hash seeds, --salt), MERGE (--mode merge) and intervals other than DAY aren't available in duckdb 0.2.0
+        - duckdb 0.2.0 reads the DATE/TIMESTAMP columns of parquet files as integers, the tables with dates should be csv files
+        - empty strings are read back as NULL from the csv files
+"""
+import os
+import re
+import json
+import glob
+import shutil
+import itertools
+from threading import Lock
+from datetime import datetime
+
+
+class Dialect :
+    """
+        This class translates the bigquery functions used by the de-identification queries to their duckdb equivalents.
+        Functions are rewritten with their arguments (balanced parenthesis) so nested calls are translated as well.
+        e.g :
+            Dialect.translate("SELECT DATE_SUB(CAST(x AS DATE), INTERVAL seed DAY)")
+    """
+    TYPES = {"INT64":"BIGINT","FLOAT64":"DOUBLE","NUMERIC":"DECIMAL(38,9)"}
+    HASHED = 20
+
+    @staticmethod
+    def regexp_contains(args):
+        return "regexp_matches(:value,:pattern)".replace(":value",args[0]).replace(":pattern",args[1])
+    @staticmethod
+    def interval(value):
+        """
+            This function parses an expression like INTERVAL <expression> DAY and returns the expression and the part
+        """
+        r = re.match(r'^\s*INTERVAL\s+(.+)\s+(DAY|MONTH|YEAR)\s*$',value,re.I|re.S)
+        return r.group(1).strip(),r.group(2).upper()
+    @staticmethod
+    def date_add(args,sign='+'):
+        value,part = Dialect.interval(args[1])
+        if part != 'DAY' :
+            raise NotImplementedError("INTERVAL :part isn't supported by the local engine (duckdb 0.2.0 has no intervals)".replace(":part",part))
+        return "(CAST(:date AS DATE) :sign CAST(:value AS INTEGER))".replace(":date",args[0]).replace(":value",value).replace(":sign",sign)
+    @staticmethod
+    def date_sub(args):
+        return Dialect.date_add(args,'-')
+    @staticmethod
+    def date_diff(args):
+        """
+            DATE_DIFF(a,b,part) counts the boundaries of the part between b and a
+        """
+        part = args[2].strip().upper()
+        left = "CAST(:date AS DATE)".replace(":date",args[0])
+        right= "CAST(:date AS DATE)".replace(":date",args[1])
+        years= "(date_part('year',:left) - date_part('year',:right))".replace(":left",left).replace(":right",right)
+        if part == 'DAY' :
+            return "(:left - :right)".replace(":left",left).replace(":right",right)
+        elif part == 'YEAR' :
+            return years
+        else:
+            return "(12 * :years + date_part('month',:left) - date_part('month',:right))".replace(":years",years).replace(":left",left).replace(":right",right)
+    @staticmethod
+    def like(pattern):
+        """
+            LIKE fails on the columns in duckdb 0.2.0 (regex_error), the pattern is translated to SIMILAR TO (the regular expression matches the whole value)
+        """
+        r = []
+        for c in pattern :
+            if c == '%' :
+                r.append('.*')
+            elif c == '_' :
+                r.append('.')
+            elif c in '.^$*+?()[]{}|\\' :
+                r.append('\\'+c)
+            else:
+                r.append(c)
+        return "SIMILAR TO '"+"".join(r)+"'"
+    @staticmethod
+    def farm_fingerprint(args):
+        """
+            duckdb 0.2.0 has no hash function, the first HASHED characters are hashed (Horner's method, a missing character counts as -1)
+        """
+        r = "CAST(0 AS BIGINT)"
+        for i in range(1,Dialect.HASHED+1) :
+            r = "((" + r + " * 31 + unicode(substr(" + args[0] + "," + str(i) + ",1))) % 2147483647)"
+        return r
+    @staticmethod
+    def rand(args):
+        return "random()"
+    @staticmethod
+    def sha256(args):
+        raise NotImplementedError("SHA256 isn't supported by the local engine (duckdb 0.2.0), the keyed-hash seeds (--salt) can only be computed by bigquery")
+    @staticmethod
+    def to_hex(args):
+        raise NotImplementedError("TO_HEX isn't supported by the local engine (duckdb 0.2.0)")
+
+    #
+    # A sub-query in a FROM clause must have an alias in duckdb 0.2.0, the words that can follow a sub-query that has none
+    #
+    KEYWORDS = ["WHERE","GROUP","HAVING","ORDER","LIMIT","UNION","EXCEPT","INTERSECT","LEFT","RIGHT","INNER","FULL","CROSS","JOIN","ON"]
+    ALIASES = itertools.count()
+    FUNCTIONS = {
+        "REGEXP_CONTAINS":"regexp_contains","DATE_SUB":"date_sub","DATE_ADD":"date_add","DATE_DIFF":"date_diff",
+        "FARM_FINGERPRINT":"farm_fingerprint","RAND":"rand","SHA256":"sha256","TO_HEX":"to_hex"
+    }
+    @staticmethod
+    def split(sql,start):
+        """
+            This function returns the arguments of the function call whose opening parenthesis is at position start and the position after the closing one
+        """
+        args,depth,quote,i,begin = [],0,None,start,start+1
+        while i < len(sql) :
+            c = sql[i]
+            if quote is not None :
+                if c == '\\' :
+                    i += 1
+                elif c == quote :
+                    quote = None
+            elif c in ("'",'"') :
+                quote = c
+            elif c == '(' :
+                depth += 1
+            elif c == ')' :
+                depth -= 1
+                if depth == 0 :
+                    args.append(sql[begin:i])
+                    return [arg for arg in args if arg.strip() != ''],i+1
+            elif c == ',' and depth == 1 :
+                args.append(sql[begin:i])
+                begin = i+1
+            i += 1
+        raise ValueError("Unbalanced parenthesis in sql")
+    @staticmethod
+    def ctes(sql):
+        """
+            This function splits the top-level WITH clause of a (translated) query, it returns [(name,sql)] and the statement that follows
+        """
+        r = []
+        m = re.match(r'^\s*WITH\s+',sql,re.I)
+        if m is None :
+            return r,sql
+        i = m.end()
+        while True :
+            m = re.compile(r'([A-Za-z_][A-Za-z0-9_]*)\s+AS\s*\(',re.I).match(sql,i)
+            end = Dialect.split(sql,m.end()-1)[1]
+            r.append((m.group(1),sql[m.end():end-1]))
+            m = re.compile(r'\s*,\s*').match(sql,end)
+            if m is None :
+                return r,sql[end:].strip()
+            i = m.end()
+    @staticmethod
+    def translate(sql):
+        """
+            This function translates a bigquery sql query to duckdb's dialect
+            @param sql  sql query (bigquery standard sql)
+        """
+        r,i = [],0
+        while i < len(sql) :
+            c = sql[i]
+            if c == "'" :
+                #
+                # String literals are copied as is, bigquery's escaped quotes (\') become ('')
+                #
+                j = i+1
+                value = []
+                while j < len(sql) and sql[j] != "'" :
+                    if sql[j] == '\\' and j+1 < len(sql) and sql[j+1] == "'" :
+                        value.append("''")
+                        j += 2
+                        continue
+                    value.append(sql[j])
+                    j += 1
+                r.append("'"+"".join(value)+"'")
+                i = j+1
+            elif c == '`' :
+                #
+                # Quoted identifiers (project.dataset.table) are unquoted
+                #
+                j = sql.index('`',i+1)
+                r.append(sql[i+1:j])
+                i = j+1
+            elif c.isalpha() or c == '_' :
+                j = i
+                while j < len(sql) and (sql[j].isalnum() or sql[j] == '_') :
+                    j += 1
+                word = sql[i:j]
+                k = j
+                while k < len(sql) and sql[k].isspace() :
+                    k += 1
+                if word.upper() == 'LIKE' and k < len(sql) and sql[k] == "'" :
+                    j = sql.index("'",k+1)
+                    r.append(Dialect.like(sql[k+1:j]))
+                    j += 1
+                elif word.upper() in ('FROM','JOIN') and k < len(sql) and sql[k] == '(' :
+                    #
+                    # The sub-query is translated as a whole and given an alias if it has none
+                    #
+                    end = Dialect.split(sql,k)[1]
+                    r.append(word+" ("+Dialect.translate(sql[k+1:end-1])+")")
+                    after = re.match(r'\s*([A-Za-z_][A-Za-z0-9_]*)?',sql[end:]).group(1)
+                    if after is None or after.upper() in Dialect.KEYWORDS :
+                        r.append(" _q"+str(next(Dialect.ALIASES)))
+                    j = end
+                elif word.upper() in Dialect.FUNCTIONS and k < len(sql) and sql[k] == '(' :
+                    args,j = Dialect.split(sql,k)
+                    args = [Dialect.translate(arg) for arg in args]
+                    value = getattr(Dialect,Dialect.FUNCTIONS[word.upper()])(args)
+                    test = re.match(r'\s+IS\s+(NOT\s+)?(TRUE|FALSE)\b',sql[j:],re.I)
+                    if test is not None :
+                        #
+                        # duckdb 0.2.0 has no IS [NOT] TRUE|FALSE, NULL is replaced by the value the test is false for
+                        #
+                        expected = test.group(2).upper() == 'TRUE'
+                        expected = expected if test.group(1) is None else not expected
+                        default = 'false' if test.group(2).upper() == 'TRUE' else 'true'
+                        value = "(COALESCE(:value,:default) = :expected)".replace(":value",value).replace(":default",default).replace(":expected",str(expected).lower())
+                        j += len(test.group(0))
+                    r.append(value)
+                elif word.upper() == 'CAST' and k < len(sql) and sql[k] == '(' :
+                    #
+                    # The types are only rewritten in CAST(<expression> AS <type>), a column or an alias named like a type is left as is
+                    #
+                    args,j = Dialect.split(sql,k)
+                    m = re.match(r'^(.*)\s+AS\s+([A-Za-z_][A-Za-z0-9_]*)(\s*\(.*\))?\s*$',args[0],re.I|re.S)
+                    field_type = m.group(2).upper()
+                    field_type = Dialect.TYPES[field_type] if field_type in Dialect.TYPES else m.group(2)+(m.group(3) or '')
+                    r.append(word+"("+Dialect.translate(m.group(1))+" AS "+field_type+")")
+                else:
+                    r.append(word)
+                i = j
+            else:
+                r.append(c)
+                i += 1
+        return "".join(r)
+
+
+class DatasetReference :
+    def __init__(self,project,dataset_id):
+        self.project    = project
+        self.dataset_id = dataset_id
+    def table(self,table_id):
+        return TableReference(self.project,self.dataset_id,table_id)
+    def to_api_repr(self):
+        return {"projectId":self.project,"datasetId":self.dataset_id}
+
+class TableReference :
+    def __init__(self,project,dataset_id,table_id):
+        self.project    = project
+        self.dataset_id = dataset_id
+        self.table_id   = table_id
+    def to_api_repr(self):
+        return {"projectId":self.project,"datasetId":self.dataset_id,"tableId":self.table_id}
+
+class SchemaField :
+    def __init__(self,name,field_type,mode='NULLABLE'):
+        self.name       = name
+        self.field_type = field_type
+        self.mode       = mode
+
+class Table :
+    """
+        Metadata of a local table (file) as exposed by the bigquery client
+    """
+    TYPES = {"BIGINT":"INTEGER","INTEGER":"INTEGER","SMALLINT":"INTEGER","TINYINT":"INTEGER","HUGEINT":"INTEGER","UBIGINT":"INTEGER",
+        "DOUBLE":"FLOAT","FLOAT":"FLOAT","REAL":"FLOAT","DECIMAL":"NUMERIC","VARCHAR":"STRING","DATE":"DATE","TIMESTAMP":"TIMESTAMP",
+        "TIMESTAMP WITH TIME ZONE":"TIMESTAMP","BOOLEAN":"BOOLEAN","BLOB":"BYTES","TIME":"TIME"}
+    def __init__(self,**args):
+        self.project    = args['project']
+        self.dataset_id = args['dataset_id']
+        self.table_id   = args['table_id']
+        self.path       = args['path']
+        self.schema     = args['schema'] if 'schema' in args else []
+        self.num_rows   = args['num_rows'] if 'num_rows' in args else None
+        stat            = os.stat(self.path)
+        self.modified   = datetime.fromtimestamp(stat.st_mtime)
+        self.etag       = "-".join([str(int(stat.st_mtime*1000)),str(stat.st_size)])
+        self.num_bytes  = stat.st_size
+        self.reference  = TableReference(self.project,self.dataset_id,self.table_id)
+
+class LocalJob :
+    """
+        This class mimics a bigquery query job, the query is run synchronously when the job is created
+    """
+    IDS = itertools.count()
+    def __init__(self,**args):
+        self.job_id     = "local_:id".replace(":id",str(next(LocalJob.IDS)))
+        self.query      = args['query']
+        self.state      = 'DONE'
+        self.errors     = None
+        self.error_result = None
+        self.started    = datetime.now()
+        self.ended      = None
+        self.referenced_tables = args['referenced_tables'] if 'referenced_tables' in args else []
+        self.total_bytes_processed = args['bytes_processed'] if 'bytes_processed' in args else 0
+        self.df         = None
+        self._properties= {"statistics":{"query":{"totalBytesProcessed":str(self.total_bytes_processed)}}}
+    def fail(self,e):
+        self.error_result = {"reason":"invalidQuery","message":str(e)}
+        self.errors = [self.error_result]
+        self.ended = datetime.now()
+    def finish(self,df=None):
+        self.df = df
+        self.ended = datetime.now()
+        self._properties['statistics']['query']['totalSlotMs'] = str(int((self.ended - self.started).total_seconds()*1000))
+    def reload(self,**args):
+        pass
+    def done(self,**args):
+        return True
+    def running(self):
+        return False
+    def result(self,**args):
+        if self.error_result is not None :
+            raise Exception(self.error_result['message'])
+        return self
+    def to_dataframe(self):
+        self.result()
+        return self.df
+
+class LocalClient :
+    """
+        This class exposes the subset of the bigquery client used by deid.py over local parquet/csv files, the queries are run with duckdb
+        e.g :
+            client = LocalClient(path='data')
+            client.query("SELECT COUNT(*) FROM raw.observation").to_dataframe()
+    """
+    EXTENSIONS = {".parquet":"read_parquet(':path')",".csv":"read_csv_auto(':path')"}
+    WRITES = itertools.count()
+    def __init__(self,**args):
+        """
+            @param path     data folder, one sub-folder per dataset and one file per table
+            @param project  name of the project (default local)
+        """
+        import duckdb
+        self.path       = args['path']
+        self.project    = args['project'] if 'project' in args else 'local'
+        self.connection = duckdb.connect()
+        self.lock       = Lock()
+        self.jobs       = {}
+        for folder in sorted(glob.glob(os.sep.join([self.path,'*']))) :
+            if os.path.isdir(folder) :
+                self.mount(os.path.basename(folder))
+    def execute(self,sql,fetch=None):
+        """
+            This function runs a statement on the engine (one at a time, the connection is shared by threads)
+            @param fetch    all|one|df to return the rows, a row or a data-frame
+        """
+        self.lock.acquire()
+        try:
+            r = self.connection.execute(sql)
+            if fetch == 'all' :
+                return r.fetchall()
+            elif fetch == 'one' :
+                return r.fetchone()
+            elif fetch == 'df' :
+                return r.fetchdf()
+            return None
+        finally:
+            self.lock.release()
+    @staticmethod
+    def get_schema_file(path):
+        return os.path.splitext(path)[0]+".schema.json"
+    def get_fields(self,name):
+        """
+            This function returns the columns of a table or view [{name,type}]
+        """
+        return [{"name":row[1],"type":row[2].upper()} for row in self.execute("PRAGMA table_info(':name')".replace(":name",name),'all')]
+    def get_file(self,dataset,table):
+        for extension in LocalClient.EXTENSIONS :
+            path = os.sep.join([self.path,dataset,table+extension])
+            if os.path.exists(path) :
+                return path
+        return None
+    def mount(self,dataset):
+        """
+            This function exposes the files of a dataset (folder) to the engine as views
+        """
+        self.execute("CREATE SCHEMA IF NOT EXISTS :dataset".replace(":dataset",dataset))
+        for path in sorted(glob.glob(os.sep.join([self.path,dataset,'*']))) :
+            self.register(dataset,path)
+    def register(self,dataset,path):
+        """
+            This function exposes a file of a dataset to the engine as a view (the schema of the dataset must exist)
+        """
+        name,extension = os.path.splitext(os.path.basename(path))
+        if extension in LocalClient.EXTENSIONS :
+            reader = LocalClient.EXTENSIONS[extension].replace(":path",path.replace("'","''"))
+            schema = LocalClient.get_schema_file(path)
+            if os.path.exists(schema) :
+                #
+                # A table written by the engine is read with the types it was written with
+                #
+                f = open(schema)
+                fields = json.loads(f.read())
+                f.close()
+                columns = ", ".join([":name := ':type'".replace(":name",field['name']).replace(":type",field['type']) for field in fields])
+                reader = "read_csv(':path',',',STRUCT_PACK(:columns))".replace(":path",path.replace("'","''")).replace(":columns",columns)
+            self.execute("CREATE OR REPLACE VIEW :dataset.:table AS SELECT * FROM :reader".replace(":dataset",dataset).replace(":table",name).replace(":reader",reader))
+    def dataset(self,dataset_id):
+        return DatasetReference(self.project,dataset_id)
+    def list_tables(self,dataset):
+        dataset_id = dataset.dataset_id if hasattr(dataset,'dataset_id') else dataset
+        r = []
+        for path in sorted(glob.glob(os.sep.join([self.path,dataset_id,'*']))) :
+            name,extension = os.path.splitext(os.path.basename(path))
+            if extension in LocalClient.EXTENSIONS :
+                r.append(Table(project=self.project,dataset_id=dataset_id,table_id=name,path=path))
+        return r
+    def get_table(self,ref):
+        path = self.get_file(ref.dataset_id,ref.table_id)
+        if path is None :
+            raise Exception("Not found: Table :dataset.:table".replace(":dataset",ref.dataset_id).replace(":table",ref.table_id))
+        name = ".".join([ref.dataset_id,ref.table_id])
+        schema = []
+        for field in self.get_fields(name) :
+            field_type = field['type'].split('(')[0]
+            schema.append(SchemaField(field['name'],Table.TYPES[field_type] if field_type in Table.TYPES else 'STRING'))
+        num_rows = self.execute("SELECT COUNT(*) FROM :name".replace(":name",name),'one')[0]
+        return Table(project=self.project,dataset_id=ref.dataset_id,table_id=ref.table_id,path=path,schema=schema,num_rows=num_rows)
+    def delete_table(self,ref):
+        path = self.get_file(ref.dataset_id,ref.table_id)
+        self.execute("DROP VIEW IF EXISTS :dataset.:table".replace(":dataset",ref.dataset_id).replace(":table",ref.table_id))
+        if path is not None :
+            os.remove(path)
+            if os.path.exists(LocalClient.get_schema_file(path)) :
+                os.remove(LocalClient.get_schema_file(path))
+    def get_job(self,job_id,**args):
+        return self.jobs[job_id]
+    def get_referenced_tables(self,sql):
+        """
+            This function returns the (local) tables referenced in a query and the number of bytes of their files
+        """
+        r,size = [],0
+        for dataset,table in set(re.findall(r'\b([A-Za-z_][A-Za-z0-9_]*)\.([A-Za-z_][A-Za-z0-9_]*)\b',sql)) :
+            path = self.get_file(dataset,table)
+            if path is not None :
+                r.append(TableReference(self.project,dataset,table))
+                size += os.stat(path).st_size
+        return r,size
+    def query(self,sql,job_config=None,**args):
+        """
+            This function runs a (bigquery) query against the local files
+            @param sql          sql query in bigquery's dialect
+            @param job_config   QueryJobConfig (destination, write_disposition and dry_run are supported)
+            A dry-run raises on an invalid query as bigquery does, the errors of the other queries are those of the job
+        """
+        referenced,size = self.get_referenced_tables(sql)
+        job = LocalJob(query=sql,referenced_tables=referenced,bytes_processed=size)
+        self.jobs[job.job_id] = job
+        destination = job_config.destination if job_config is not None else None
+        try:
+            _sql = Dialect.translate(sql)
+            if job_config is not None and job_config.dry_run :
+                self.execute("EXPLAIN "+_sql)
+                job.finish()
+            else:
+                _sql,tables = self.materialize(_sql)
+                try:
+                    if destination is None :
+                        job.finish(self.execute(_sql,'df'))
+                    else:
+                        self.write(_sql,destination,job_config.write_disposition)
+                        job.finish()
+                finally:
+                    self.drop(tables)
+        except Exception as e:
+            job.fail(e)
+            if job_config is not None and job_config.dry_run :
+                raise
+        return job
+    def materialize(self,sql):
+        """
+            This function runs the common table expressions of a (translated) query as temporary tables and returns the query that reads them and the temporary tables
+            duckdb 0.2.0 crashes on some queries whose common table expressions read files, the temporary tables are dropped by the caller
+        """
+        ctes,sql = Dialect.ctes(sql)
+        tables = []
+        try:
+            for name,_sql in ctes :
+                table = "cte_:id".replace(":id",str(next(LocalClient.WRITES)))
+                for _name,_table in zip([cte[0] for cte in ctes],tables) :
+                    _sql = re.sub(r'(?<![.\w])'+_name+r'\b',_table,_sql)
+                self.execute("CREATE TEMPORARY TABLE :table AS :sql".replace(":table",table).replace(":sql",_sql))
+                tables.append(table)
+        except Exception :
+            self.drop(tables)
+            raise
+        for name,table in zip([cte[0] for cte in ctes],tables) :
+            sql = re.sub(r'(?<![.\w])'+name+r'\b',table,sql)
+        return sql,tables
+    def drop(self,tables):
+        for table in tables :
+            self.execute("DROP TABLE IF EXISTS :table".replace(":table",table))
+    def write(self,sql,destination,disposition=None):
+        """
+            This function writes the result of a query in the folder of the destination dataset (csv and the types of its columns)
+            The result is held in a temporary table first, the types of its columns are those written beside the file
+        """
+        folder = os.sep.join([self.path,destination.dataset_id])
+        if not os.path.exists(folder) :
+            os.makedirs(folder)
+        name = ".".join([destination.dataset_id,destination.table_id])
+        path = self.get_file(destination.dataset_id,destination.table_id)
+        if path is not None and disposition not in ('WRITE_TRUNCATE','WRITE_APPEND') :
+            raise Exception("Already Exists: Table :name".replace(":name",name))
+        result = "write_:id".replace(":id",str(next(LocalClient.WRITES)))
+        filename = os.sep.join([folder,destination.table_id+".csv"])
+        self.execute("CREATE TEMPORARY TABLE :result AS :sql".replace(":result",result).replace(":sql",sql))
+        try:
+            fields = self.get_fields(result)
+            sql = "SELECT * FROM :result".replace(":result",result)
+            if path is not None and disposition == 'WRITE_APPEND' :
+                #
+                # The rows are appended by name, the columns of the existing table are kept (in their order)
+                #
+                fields = self.get_fields(name)
+                columns = ",".join([field['name'] for field in fields])
+                sql = "SELECT :columns FROM :name UNION ALL SELECT :columns FROM :result".replace(":columns",columns).replace(":name",name).replace(":result",result)
+            self.execute("COPY (:sql) TO ':path'".replace(":sql",sql).replace(":path",(filename+".tmp").replace("'","''")))
+        finally:
+            self.execute("DROP TABLE :result".replace(":result",result))
+        f = open(LocalClient.get_schema_file(filename)+".tmp",'w')
+        f.write(json.dumps(fields))
+        f.close()
+        if path is not None and path != filename :
+            os.remove(path)
+        shutil.move(filename+".tmp",filename)
+        shutil.move(LocalClient.get_schema_file(filename)+".tmp",LocalClient.get_schema_file(filename))
+        #
+        # Only the table written is (re)registered, the other tables of the dataset may be written or deleted concurrently
+        #
+        self.execute("CREATE SCHEMA IF NOT EXISTS :dataset".replace(":dataset",destination.dataset_id))
+        self.register(destination.dataset_id,filename)
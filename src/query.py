@@ -0,0 +1,240 @@
+"""
+    AoUS - DEID, 2018
+
+    This file implements a small intermediate representation (IR) of the de-identification queries and its compiler.
+    The policies (Shift, DropFields, Group) and the composer emit a tree of nodes rather than templated strings :
+        - Table     a table of a dataset
+        - Select    projection of a source (table or sub-query) with joins and filters
+        - Union     UNION ALL of queries
+        - Except    rows of a query that aren't in another (EXCEPT DISTINCT)
+        - Join      (LEFT) join of a sub-query or table
+        - In        membership of a field in a sub-query (semi/anti-join)
+    Fields, conditions and join conditions are sql expressions (strings), sub-queries are nodes.
+
+    Design:
+        The compiler renders the tree in a single pass after a hoisting pass :
+        identical sub-queries (same rendered sql) used more than once, or flagged by the policy that emits them, are rendered once in a WITH clause
+        and referenced by name wherever they are used. e.g the seed lookup is used by every branch of the observation query.
+        Because the plan is a data structure, it can be inspected (and compared) before anything is rendered or submitted.
+
+    Usage :
+        seeds = Select(fields=['person_id AS seed_person_id','seed'],source=Table('raw','people_seed'),name='seeds')
+        q = Select(fields=['*'],source=Table('raw','observation'),joins=[Join(source=seeds,alias='xii',on='xii.seed_person_id = observation.person_id')])
+        Compiler().render(q)
+"""
+
+class Node :
+    def key(self):
+        """
+            This function returns the canonical form of the node, two nodes with the same key are the same query
+        """
+        return Compiler().inline(self)
+    def __eq__(self,other):
+        return isinstance(other,Node) and self.key() == other.key()
+    def __ne__(self,other):
+        return not self.__eq__(other)
+    def __hash__(self):
+        return hash(self.key())
+    def __repr__(self):
+        return self.key()
+
+class Table(Node):
+    def __init__(self,dataset,name):
+        self.dataset    = dataset
+        self.name       = name
+
+class Select(Node):
+    def __init__(self,**args):
+        """
+            @param fields   list of expressions of the projection
+            @param source   Table or sub-query (Select, Union)
+            @param alias    alias of the source (optional)
+            @param joins    list of Join
+            @param where    list of conditions (expressions or In), they are AND-ed
+            @param group    list of expressions of the GROUP BY clause (optional)
+            @param having   list of conditions of the HAVING clause (optional)
+            @param name     name of the sub-query if it is hoisted in a WITH clause (optional)
+            @param hoist    always hoist the sub-query in a WITH clause (default False)
+        """
+        self.fields     = list(args['fields']) if 'fields' in args else ['*']
+        self.source     = args['source']
+        self.alias      = args['alias'] if 'alias' in args else None
+        self.joins      = list(args['joins']) if 'joins' in args else []
+        self.where      = list(args['where']) if 'where' in args else []
+        self.group      = list(args['group']) if 'group' in args else []
+        self.having     = list(args['having']) if 'having' in args else []
+        self.name       = args['name'] if 'name' in args else None
+        self.hoist      = args['hoist'] if 'hoist' in args else False
+
+class Union(Node):
+    def __init__(self,**args):
+        """
+            @param items    list of queries (Select, Union) whose results are appended (UNION ALL)
+        """
+        self.items      = list(args['items'])
+        self.name       = args['name'] if 'name' in args else None
+        self.hoist      = args['hoist'] if 'hoist' in args else False
+
+class Except(Node):
+    def __init__(self,**args):
+        """
+            @param left     query whose rows are returned
+            @param right    query whose rows are removed
+        """
+        self.left       = args['left']
+        self.right      = args['right']
+        self.name       = args['name'] if 'name' in args else None
+        self.hoist      = args['hoist'] if 'hoist' in args else False
+
+class Join(Node):
+    def __init__(self,**args):
+        """
+            @param source   Table or sub-query
+            @param alias    alias of the joined source
+            @param on       join condition
+            @param kind     LEFT|INNER (default LEFT)
+        """
+        self.source     = args['source']
+        self.alias      = args['alias']
+        self.on         = args['on']
+        self.kind       = args['kind'] if 'kind' in args else 'LEFT'
+
+class In(Node):
+    def __init__(self,**args):
+        """
+            @param field    expression tested
+            @param query    sub-query returning a single column
+            @param negate   NOT IN (default False)
+        """
+        self.field      = args['field']
+        self.query      = args['query']
+        self.negate     = args['negate'] if 'negate' in args else False
+
+class Compiler :
+    """
+        This class renders a query (tree of nodes) in sql, identical sub-queries are hoisted in a WITH clause
+        e.g :
+            compiler = Compiler()
+            sql = compiler.render(node)
+            compiler.ctes       #-- [(name,sql)] of the hoisted sub-queries
+    """
+    def __init__(self,**args):
+        """
+            @param hoist    hoist the sub-queries used more than once (default True)
+        """
+        self.hoist  = args['hoist'] if 'hoist' in args else True
+        self.names  = {}
+        self.ctes   = []
+    def inline(self,node):
+        """
+            This function renders a node without any hoisting (canonical form)
+        """
+        return Compiler(hoist=False).sql(node)
+    def get_subqueries(self,node,r=None):
+        """
+            This function returns the sub-queries of a tree (inner most first) i.e the sources of joins, the sources of selects and the queries of In
+        """
+        r = [] if r is None else r
+        if isinstance(node,Select) :
+            children = [node.source] + [join.source for join in node.joins] + [item.query for item in node.where if isinstance(item,In)]
+        elif isinstance(node,Union) :
+            children = node.items
+        elif isinstance(node,Except) :
+            children = [node.left,node.right]
+        else:
+            children = []
+        for child in children :
+            self.get_subqueries(child,r)
+            if isinstance(child,(Select,Union,Except)) and not (isinstance(node,Union)) :
+                r.append(child)
+        return r
+    def prepare(self,node):
+        """
+            This function determines the sub-queries to be hoisted and names them (hoisting pass)
+        """
+        counts = {}
+        nodes  = {}
+        for item in self.get_subqueries(node) :
+            key = self.inline(item)
+            counts[key] = counts[key] + 1 if key in counts else 1
+            if key not in nodes :
+                nodes[key] = item
+        keys = [key for key in nodes if counts[key] > 1 or nodes[key].hoist]
+        #
+        # The sub-queries are defined inner most first so that a hoisted sub-query can use another
+        #
+        order = []
+        for item in self.get_subqueries(node) :
+            key = self.inline(item)
+            if key in keys and key not in order :
+                order.append(key)
+        used = set()
+        for key in order :
+            name = nodes[key].name if nodes[key].name is not None else "q"
+            _name, i = name, 1
+            while _name in used :
+                i += 1
+                _name = name+"_"+str(i)
+            used.add(_name)
+            self.names[key] = _name
+        for key in order :
+            #
+            # The definition of a hoisted sub-query is rendered without it being replaced by its own name
+            #
+            name = self.names.pop(key)
+            self.ctes.append((name,self.sql(nodes[key])))
+            self.names[key] = name
+    def render(self,node):
+        """
+            This function renders a query, the hoisted sub-queries are placed in a WITH clause
+        """
+        self.names  = {}
+        self.ctes   = []
+        if self.hoist :
+            self.prepare(node)
+        sql = self.sql(node)
+        if self.ctes :
+            sql = "WITH " + ", ".join([name+" AS ("+_sql+")" for name,_sql in self.ctes]) + " " + sql
+        return sql
+    def source(self,node):
+        """
+            This function renders a node used as a source (FROM, JOIN), a sub-query is either parenthesized or replaced by its name
+        """
+        if isinstance(node,Table) :
+            return self.sql(node)
+        if self.hoist and self.names :
+            key = self.inline(node)
+            if key in self.names :
+                return self.names[key]
+        return "(" + self.sql(node) + ")"
+    def sql(self,node):
+        if isinstance(node,Table) :
+            return ".".join([node.dataset,node.name])
+        elif isinstance(node,Select) :
+            sql = ["SELECT",",".join([field.strip() for field in node.fields]),"FROM",self.source(node.source)]
+            if node.alias is not None :
+                sql.append(node.alias)
+            sql += [self.sql(join) for join in node.joins]
+            if node.where :
+                sql += ["WHERE"," AND ".join([self.condition(item) for item in node.where])]
+            if node.group :
+                sql += ["GROUP BY",",".join(node.group)]
+            if node.having :
+                sql += ["HAVING"," AND ".join(node.having)]
+            return " ".join(sql)
+        elif isinstance(node,Union) :
+            return " UNION ALL ".join([self.sql(item) if isinstance(item,Select) else "SELECT * FROM "+self.source(item) for item in node.items])
+        elif isinstance(node,Except) :
+            return " EXCEPT DISTINCT ".join(["SELECT * FROM "+self.source(item) for item in [node.left,node.right]])
+        elif isinstance(node,Join) :
+            return " ".join([node.kind,"JOIN",self.source(node.source),node.alias,"ON",node.on])
+        elif isinstance(node,In) :
+            return self.condition(node)
+        return str(node)
+    def condition(self,item):
+        if isinstance(item,In) :
+            query = self.source(item.query)
+            if not query.startswith("(") :
+                query = "(SELECT * FROM "+query+")"
+            return " ".join([item.field,"NOT IN" if item.negate else "IN",query])
+        return item
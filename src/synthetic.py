@@ -0,0 +1,228 @@
+"""
+    AoUS - DEID, 2018
+
+    This file generates a synthetic OMOP dataset (person, observation, concept, people_seed) to benchmark the de-identification.
+    The dataset has the features the de-identification rules depend on :
+        - PPI questions and answers of every category subject to generalization (OBSERVATION_FILTERS), some people are multi-racial
+        - questions whose answer is a date (consent, birth date, ...), some people are older than the exclusion age
+        - free-text questions that are suppressed (one per row suppression pattern of the configuration)
+    The tables are written as the local engine writes them, one folder per dataset, and can be de-identified with it (see engine.py) :
+    csv files without header and the types of their columns beside them (<table>.schema.json)
+
+    Design:
+        The people are generated by blocks (vectorized with numpy) and every block is appended to the files before the next one is generated,
+        the memory used is bounded by the size of a block no matter the scale (10K to 100M rows of observation).
+        The generation is seeded, the same parameters always give the same dataset.
+
+    Usage :
+        python synthetic.py --config path-of-config.json --data <folder> [--i_dataset raw] [--rows 100000] [--block 100000] [--seed 0]
+
+    Requirements:
+        pip install duckdb==0.2.0 pandas==0.24.2 (see requirements.txt)
+"""
+from __future__ import division
+from datetime import datetime
+import pandas as pd
+import numpy as np
+import json
+import os
+import re
+import deid
+
+class Generator :
+    """
+        This class writes a synthetic dataset given the number of rows of the observation table
+        e.g :
+            handler = Generator(path='data',dataset='raw',rows=1000000,config=config)
+            handler.run()       #-- {"person":..,"observation":..,"concept":..,"people_seed":..}
+    """
+    TYPES = {"i":"BIGINT","u":"BIGINT","f":"DOUBLE","b":"BOOLEAN","O":"VARCHAR"}
+    #
+    # question : answers, the codes match the filters of the configuration (OBSERVATION_FILTERS) and the concepts Group looks for
+    #
+    QUESTIONS = {
+        "Race_WhatRaceEthnicity":["WhatRaceEthnicity_White","WhatRaceEthnicity_Black","WhatRaceEthnicity_Asian","WhatRaceEthnicity_AIAN"],
+        "Gender_GenderIdentity":["GenderIdentity_Man","GenderIdentity_Woman","GenderIdentity_Trans"],
+        "TheBasics_SexualOrientation":["SexualOrientation_Straight","SexualOrientation_Gay","SexualOrientation_None"],
+        "EducationLevel_HighestGrade":["HighestGrade_AdvancedDegree","HighestGrade_TwelveOrGED","HighestGrade_FiveThroughEight"],
+        "BiologicalSexAtBirth_SexAtBirth":["SexAtBirth_Female","SexAtBirth_Male","SexAtBirth_Intersex"],
+        "Language_SpokenWrittenLanguage":["SpokenWrittenLanguage_English","SpokenWrittenLanguage_Spanish"],
+        "Employment_EmploymentStatus":["EmploymentStatus_EmployedForWages","EmploymentStatus_Retired"],
+        "Insurance_HealthInsurance":["HealthInsurance_Yes","HealthInsurance_No"]
+    }
+    DATES = ["ExtraConsent_TodaysDate","PIIBirthInformation_BirthDate","Surgery_SurgeryDate"]
+    #
+    # concepts that aren't PPI answers (person table, generalized values)
+    #
+    OTHERS = [("White","Race","Race"),("Black","Race","Race"),("Asian","Race","Race"),("Native","Race","Race"),("Other Race","Race","Race"),("OTHER","Gender","Gender"),("Man","Gender","Gender"),("Woman","Gender","Gender")]
+    def __init__(self,**args):
+        """
+            @param path     folder of the datasets
+            @param dataset  name of the dataset (sub-folder) the tables are written in (default raw)
+            @param rows     approximate number of rows of the observation table (default 100000)
+            @param block    number of people generated at once (default 100000)
+            @param seed     seed of the random generator (default 0)
+            @param config   configuration (as found in config.json), the suppressed free-text questions are derived from it
+        """
+        self.path   = args['path']
+        self.dataset= args['dataset'] if 'dataset' in args else 'raw'
+        self.rows   = int(args['rows']) if 'rows' in args else 100000
+        self.block  = int(args['block']) if 'block' in args else 100000
+        self.random = np.random.RandomState(int(args['seed']) if 'seed' in args else 0)
+        config      = args['config'] if 'config' in args else {}
+        remove      = config['suppression']['observation'] if 'suppression' in config and 'observation' in config['suppression'] else {}
+        patterns    = remove['rows']['observation_source_value'] if 'rows' in remove and 'observation_source_value' in remove['rows'] else []
+        self.free_text = Generator.get_free_text(patterns)
+        self.concepts = self.get_concepts()
+        self.ids    = dict(zip(self.concepts['concept_code'].tolist(),self.concepts['concept_id'].tolist()))
+        others      = self.concepts[self.concepts['vocabulary_id'] != 'PPI']
+        self.names  = dict(zip(others['concept_name'].tolist(),others['concept_id'].tolist()))
+    @staticmethod
+    def get_free_text(patterns):
+        """
+            This function returns a question code matching every (literal) suppression pattern e.g _City -> Question_City, PIIName_ -> PIIName_Text
+        """
+        r = []
+        for pattern in patterns :
+            if re.search(r'[\^\$\*\+\?\{\}\[\]\\\|\(\)\.]',pattern) :
+                continue
+            code = pattern if not pattern.startswith('_') else 'Question'+pattern
+            code = code if not code.endswith('_') else code+'Text'
+            r.append(code)
+        return r
+    def get_per_person(self):
+        """
+            This function returns the average number of rows of observation per person
+        """
+        return len(Generator.QUESTIONS) + len(Generator.DATES) + 1 + (1/7)
+    def get_concepts(self):
+        rows = [(name,vocabulary_id,concept_class_id,name.replace(' ','')) for name,vocabulary_id,concept_class_id in Generator.OTHERS]
+        for question in Generator.QUESTIONS :
+            rows += [(question,'PPI','Question',question)]+[(answer.split('_')[-1],'PPI','Answer',answer) for answer in Generator.QUESTIONS[question]]
+        rows += [(code,'PPI','Question',code) for code in Generator.DATES + self.free_text]
+        df = pd.DataFrame(rows,columns=['concept_name','vocabulary_id','concept_class_id','concept_code'])
+        df['concept_id'] = np.arange(1,df.shape[0]+1)
+        return df[['concept_id','concept_name','vocabulary_id','concept_class_id','concept_code']]
+    def get_people(self,ids):
+        """
+            This function generates the person table and the date of consent of a block of people
+        """
+        n = ids.size
+        birth = np.datetime64('1920-01-01') + self.random.randint(0,30000,n).astype('timedelta64[D]')
+        consent = np.datetime64('2018-01-01') + self.random.randint(0,300,n).astype('timedelta64[D]')
+        races = [self.names[name] for name in ['White','Black','Asian','Native']]
+        genders = [self.names[name] for name in ['OTHER','Man','Woman']]
+        df = pd.DataFrame({"person_id":ids,"gender_concept_id":self.random.choice(genders,n),"year_of_birth":birth.astype('datetime64[Y]').astype(int) + 1970,
+            "birth_datetime":birth.astype('datetime64[ns]'),"race_concept_id":self.random.choice(races,n),"race_source_value":"x","gender_source_value":"y"})
+        return df,birth,consent
+    def get_observations(self,ids,birth,consent,offset):
+        """
+            This function generates the rows of observation of a block of people (every question is answered once, multi-racial people answer race twice)
+            @param offset   first observation_id of the block
+        """
+        n = ids.size
+        frames = []
+        for question in Generator.QUESTIONS :
+            answers = Generator.QUESTIONS[question]
+            picks = self.random.randint(0,len(answers),n)
+            people = ids
+            if question.startswith('Race') :
+                #
+                # 1 in 7 people is multi-racial i.e has a second (distinct) race
+                #
+                mr = ids % 7 == 0
+                people = np.concatenate([ids,ids[mr]])
+                picks = np.concatenate([picks,(picks[mr] + 1) % len(answers)])
+            codes = np.array(answers)[picks]
+            frames.append(pd.DataFrame({"person_id":people,"observation_source_value":question,"value_as_string":codes,"value_source_value":codes}))
+        values = {"ExtraConsent_TodaysDate":consent,"PIIBirthInformation_BirthDate":birth,"Surgery_SurgeryDate":consent - self.random.randint(0,3650,n).astype('timedelta64[D]')}
+        for question in Generator.DATES :
+            frames.append(pd.DataFrame({"person_id":ids,"observation_source_value":question,"value_as_string":values[question].astype(str),"value_source_value":""}))
+        if self.free_text :
+            #
+            # every person has a free-text answer (to be suppressed)
+            #
+            codes = np.array(self.free_text)[self.random.randint(0,len(self.free_text),n)]
+            frames.append(pd.DataFrame({"person_id":ids,"observation_source_value":codes,"value_as_string":"free text","value_source_value":""}))
+        df = pd.concat(frames,ignore_index=True)
+        df = df.sort_values('person_id',kind='mergesort').reset_index(drop=True)
+        dates = pd.Series(consent.astype('datetime64[ns]'),index=ids)
+        df['observation_id'] = np.arange(offset,offset+df.shape[0])
+        df['observation_concept_id'] = 0
+        df['observation_date'] = dates.loc[df['person_id'].values].values
+        df['observation_datetime'] = df['observation_date']
+        df['value_as_number'] = np.nan
+        df['observation_source_concept_id'] = [self.ids[code] for code in df['observation_source_value']]
+        df['value_source_concept_id'] = [self.ids[code] if code in self.ids else 0 for code in df['value_source_value']]
+        return df[['observation_id','person_id','observation_concept_id','observation_date','observation_datetime','value_as_number','value_as_string',
+            'observation_source_value','observation_source_concept_id','value_source_concept_id','value_source_value']]
+    def get_seeds(self,ids,consent):
+        """
+            This function generates the seeds of a block of people as initialization does (days since consent + 700*rand())
+        """
+        today = np.datetime64(datetime.now().strftime('%Y-%m-%d'))
+        return pd.DataFrame({"person_id":ids,"seed":(today - consent).astype(int) + self.random.randint(0,700,ids.size)})
+    @staticmethod
+    def get_fields(df):
+        """
+            This function returns the columns of a block and their types as the local engine writes them [{name,type}]
+            The dates are written as DATE (<name>_date) or TIMESTAMP as they are in the OMOP tables
+        """
+        r = []
+        for name in df.columns :
+            if df[name].dtype.kind == 'M' :
+                r.append({"name":name,"type":"DATE" if name.endswith('_date') else "TIMESTAMP"})
+            else:
+                r.append({"name":name,"type":Generator.TYPES[df[name].dtype.kind] if df[name].dtype.kind in Generator.TYPES else "VARCHAR"})
+        return r
+    def run(self):
+        from engine import LocalClient
+        folder = os.sep.join([self.path,self.dataset])
+        if not os.path.exists(folder) :
+            os.makedirs(folder)
+        written = []
+        r = dict([(name,0) for name in ['person','observation','people_seed']])
+        def write(name,df):
+            path = os.sep.join([folder,name+".csv"])
+            fields = Generator.get_fields(df)
+            df = df.copy()
+            for field in fields :
+                if field['type'] in ['DATE','TIMESTAMP'] :
+                    df[field['name']] = df[field['name']].dt.strftime('%Y-%m-%d' if field['type'] == 'DATE' else '%Y-%m-%d %H:%M:%S')
+            if name not in written :
+                f = open(LocalClient.get_schema_file(path),'w')
+                f.write(json.dumps(fields))
+                f.close()
+                written.append(name)
+                df.to_csv(path,mode='w',header=False,index=False)
+            else:
+                df.to_csv(path,mode='a',header=False,index=False)
+            r[name] = r[name] + df.shape[0] if name in r else df.shape[0]
+        people = max(1,int(self.rows / self.get_per_person()))
+        offset = 1
+        for start in range(1,people+1,self.block) :
+            ids = np.arange(start,min(people,start+self.block-1)+1,dtype=np.int64)
+            person,birth,consent = self.get_people(ids)
+            observation = self.get_observations(ids,birth,consent,offset)
+            offset += observation.shape[0]
+            write('person',person)
+            write('observation',observation)
+            write('people_seed',self.get_seeds(ids,consent))
+            deid.Logging.log(subject='synthetic',object=self.dataset,action='block',value={"people":int(ids[-1]),"observation":r['observation']})
+        write('concept',self.concepts)
+        deid.Logging.log(subject='synthetic',object=self.dataset,action='done',value=r)
+        deid.Logging.flush()
+        return r
+
+if __name__ == '__main__' :
+    SYS_ARGS = deid.SYS_ARGS
+    f = open(SYS_ARGS['config'])
+    config = json.loads(f.read())
+    f.close()
+    args = {"path":SYS_ARGS['data'],"config":config}
+    for key in ['rows','block','seed'] :
+        if key in SYS_ARGS :
+            args[key] = SYS_ARGS[key]
+    if 'i_dataset' in SYS_ARGS :
+        args['dataset'] = SYS_ARGS['i_dataset']
+    print (Generator(**args).run())
@@ -0,0 +1,34 @@
+"""
+    AoUS - DEID, 2018
+
+    Fixtures shared by the tests : the modules of src/ are importable and a small synthetic dataset (see synthetic.py) is written once per session.
+    The tests run on python 2.7 with the requirements of the project (duckdb 0.2.0 for the local engine) :
+        python -m pytest tests
+"""
+import os
+import sys
+import pytest
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0,os.sep.join([ROOT,'src']))
+
+import deid
+
+@pytest.fixture(scope='session')
+def config():
+    return deid.configure(os.sep.join([ROOT,'config.json']))
+
+@pytest.fixture(scope='session')
+def data(tmpdir_factory,config):
+    """
+        This fixture writes a synthetic dataset (raw) in a temporary folder and returns the folder
+    """
+    from synthetic import Generator
+    path = str(tmpdir_factory.mktemp('data'))
+    Generator(path=path,dataset='raw',rows=3000,block=100,config=config).run()
+    return path
+
+@pytest.fixture()
+def client(data):
+    from engine import LocalClient
+    return LocalClient(path=data)
@@ -0,0 +1,55 @@
+"""
+    Tests of the translation of the bigquery dialect to duckdb's and of the local engine (see engine.py)
+"""
+from engine import Dialect
+
+def test_functions():
+    sql = Dialect.translate("SELECT DATE_SUB(CAST(x AS DATE), INTERVAL seed DAY) FROM t")
+    assert sql == "SELECT (CAST(CAST(x AS DATE) AS DATE) - CAST(seed AS INTEGER)) FROM t"
+    sql = Dialect.translate("SELECT REGEXP_CONTAINS(LOWER(name),'^zip') FROM t")
+    assert sql == "SELECT regexp_matches(LOWER(name),'^zip') FROM t"
+
+def test_nested_functions():
+    sql = Dialect.translate("SELECT DATE_ADD(DATE_SUB(d, INTERVAL 1 DAY), INTERVAL 2 DAY) FROM t")
+    assert sql == "SELECT (CAST((CAST(d AS DATE) - CAST(1 AS INTEGER)) AS DATE) + CAST(2 AS INTEGER)) FROM t"
+
+def test_like():
+    sql = Dialect.translate("SELECT x FROM t WHERE name LIKE 'a_b%.c'")
+    assert sql == "SELECT x FROM t WHERE name SIMILAR TO 'a.b.*\\.c'"
+
+def test_literals_and_identifiers():
+    sql = Dialect.translate("SELECT 'it\\'s DATE_SUB(x)' AS v FROM `project.raw.person`")
+    assert sql == "SELECT 'it''s DATE_SUB(x)' AS v FROM project.raw.person"
+
+def test_subquery_alias():
+    sql = Dialect.translate("SELECT * FROM (SELECT x FROM t) WHERE x > 1")
+    assert sql.startswith("SELECT * FROM (SELECT x FROM t) _q") and sql.endswith(" WHERE x > 1")
+    sql = Dialect.translate("SELECT * FROM (SELECT x FROM t) a WHERE x > 1")
+    assert sql == "SELECT * FROM (SELECT x FROM t) a WHERE x > 1"
+
+def test_boolean_tests():
+    sql = Dialect.translate("SELECT x FROM t WHERE REGEXP_CONTAINS(x,'a') IS NOT TRUE")
+    assert sql == "SELECT x FROM t WHERE (COALESCE(regexp_matches(x,'a'),false) = false)"
+    sql = Dialect.translate("SELECT x FROM t WHERE REGEXP_CONTAINS(x,'a') IS FALSE")
+    assert sql == "SELECT x FROM t WHERE (COALESCE(regexp_matches(x,'a'),true) = false)"
+
+def test_ctes():
+    ctes,sql = Dialect.ctes("WITH a AS (SELECT 1 AS x), b AS (SELECT x FROM a WHERE x IN (1,2)) SELECT * FROM b")
+    assert ctes == [('a','SELECT 1 AS x'),('b','SELECT x FROM a WHERE x IN (1,2)')]
+    assert sql == "SELECT * FROM b"
+    assert Dialect.ctes("SELECT 1") == ([],"SELECT 1")
+
+def test_query(client):
+    job = client.query("SELECT person_id, DATE_SUB(CAST('2018-01-10' AS DATE), INTERVAL 9 DAY) AS d FROM raw.person WHERE REGEXP_CONTAINS(CAST(person_id AS STRING),'^1$')")
+    df = job.to_dataframe()
+    assert df.shape[0] == 1 and df.person_id[0] == 1
+    assert str(df.d[0])[:10] == '2018-01-01'
+
+def test_types():
+    sql = Dialect.translate("SELECT CAST (700*rand() AS INT64) AS seed, CAST(CAST(x AS FLOAT64) as numeric) FROM t")
+    assert sql == "SELECT CAST(700*random() AS BIGINT) AS seed, CAST(CAST(x AS DOUBLE) AS DECIMAL(38,9)) FROM t"
+    #
+    # Columns and aliases named like a type are left as is
+    #
+    sql = Dialect.translate("SELECT numeric, t.int64, CAST(numeric AS STRING) AS float64 FROM t WHERE int64 > 0")
+    assert sql == "SELECT numeric, t.int64, CAST(numeric AS STRING) AS float64 FROM t WHERE int64 > 0"
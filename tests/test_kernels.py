@@ -0,0 +1,69 @@
+"""
+    Tests of the date shifting kernels of deid2.py : they must give the seeds and the dates the queries of deid.py give
+"""
+import re
+import hashlib
+import numpy as np
+import pandas as pd
+import deid
+from engine import Dialect
+from deid2 import ShiftKernel, HashKernel
+
+def evaluate(sql,values):
+    """
+        This function evaluates the bigquery expression of a keyed hash (see deid.Shift.get_hash) in python
+        @param values   values of the parameters and the columns e.g {"@salt":..,"x.person_id":..}
+    """
+    sql = sql.strip()
+    m = re.match(r'^([A-Z0-9_]+)\s*\(',sql)
+    if m is None :
+        if sql.startswith("'") :
+            return sql[1:-1]
+        return values[sql] if sql in values else int(sql)
+    args,end = Dialect.split(sql,m.end()-1)
+    assert end == len(sql),sql
+    name = m.group(1)
+    if name == 'CAST' :
+        value,_type = re.match(r'^(.+)\s+AS\s+(\w+)$',args[0].strip(),re.S).groups()
+        value = evaluate(value,values)
+        return str(value) if _type == 'STRING' else int(value,16) if str(value).startswith('0x') else int(value)
+    args = [evaluate(arg,values) for arg in args]
+    if name == 'CONCAT' :
+        return "".join(args)
+    if name == 'SHA256' :
+        return hashlib.sha256(args[0].encode('utf-8')).digest()
+    if name == 'TO_HEX' :
+        return args[0].encode('hex')
+    if name == 'SUBSTR' :
+        return args[0][args[1]-1:args[1]-1+args[2]]
+    if name == 'MOD' :
+        return args[0] % args[1]
+    raise NotImplementedError(name)
+
+def test_hash_seed_is_the_seed_of_the_query():
+    shift = deid.Shift(client=None,registry=None,salt='secret',hoist=True)
+    sql = shift.get_hash('x')
+    assert "secret" not in sql
+    for person_id in [1,2,42,123456789,2**40+7] :
+        seed = evaluate(sql,{"@salt":"secret","x.person_id":person_id})
+        assert seed == deid.Shift.hash_seed('secret',person_id)
+        assert 0 <= seed < deid.Shift.SEED_RANGE
+
+def test_hash_kernel_seeds():
+    kernel = HashKernel(salt='secret',ids=[2],seeds=[5000])
+    seeds = kernel.get_seeds(np.array([1,2,3,1]))
+    assert seeds[1] == np.timedelta64(5000,'D')
+    for i,person_id in [(0,1),(2,3),(3,1)] :
+        assert seeds[i] == np.timedelta64(deid.Shift.hash_seed('secret',person_id),'D')
+
+def test_shift_kernel_is_date_sub():
+    kernel = ShiftKernel(ids=[3,1,2],seeds=[30,10,20])
+    df = pd.DataFrame({"person_id":[1,2,3,4],"visit_start_date":['2018-01-31','2018-03-01 13:45:00','2018-01-01',None],"value_as_string":['2018-02-01','x','2018-01-01','y']})
+    r = kernel.shift(df,['visit_start_date'],np.array([True,False,False,False]))
+    assert [str(value)[:10] for value in r['visit_start_date'].tolist()] == ['2018-01-21','2018-02-09','2017-12-02','NaT']
+    assert r['value_as_string'].tolist() == ['2018-01-22','x','2018-01-01','y']
+
+def test_people_without_seed():
+    kernel = ShiftKernel(ids=[],seeds=[])
+    df = pd.DataFrame({"person_id":[1],"visit_start_date":['2018-01-31']})
+    assert pd.isnull(kernel.shift(df,['visit_start_date'])['visit_start_date'].values[0])
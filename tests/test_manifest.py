@@ -0,0 +1,68 @@
+"""
+    Tests of the tracking of the jobs and of the resumption of a run (see deid.JobTracker and deid.RunManifest)
+"""
+import os
+import deid
+from deid import bq, JobTracker, RunManifest
+
+class FlakyClient :
+    """
+        This class fails the first query it is given with a transient error (as bigquery does when it is overloaded)
+    """
+    def __init__(self,client):
+        self.client = client
+        self.queries= 0
+    def __getattr__(self,name):
+        return getattr(self.client,name)
+    def query(self,sql,**args):
+        job = self.client.query(sql,**args)
+        self.queries += 1
+        if self.queries == 1 :
+            job.error_result = {"reason":"backendError","message":"Backend error"}
+        return job
+
+def get_config(client,table):
+    job = bq.QueryJobConfig()
+    job.destination = client.dataset('manifest').table(table)
+    job.write_disposition = 'WRITE_TRUNCATE'
+    return job
+
+def test_retried_job_is_resumed(tmpdir,client):
+    path = os.sep.join([str(tmpdir),'manifest.json'])
+    flaky = FlakyClient(client)
+    tracker = JobTracker(client=flaky,path=str(tmpdir),delay=0.001,manifest=RunManifest(path=path,i_dataset='raw',o_dataset='manifest'))
+    tracker.submit('person',"SELECT person_id FROM raw.person",get_config(client,'person'),'plan-of-person')
+    r = tracker.wait()
+    assert r['person']['state'] == 'DONE' and r['person']['attempts'] == 2
+    assert flaky.queries == 2
+    #
+    # The retry is recorded with the plan of the job it replaced
+    #
+    manifest = RunManifest(path=path,i_dataset='raw',o_dataset='manifest',resume=True)
+    assert manifest.get('person')['plan'] == 'plan-of-person'
+    assert manifest.get('person')['state'] == 'DONE'
+    #
+    # The resumed run doesn't resubmit the job
+    #
+    tracker = JobTracker(client=flaky,path=str(tmpdir),delay=0.001,manifest=manifest)
+    job = tracker.submit('person',"SELECT person_id FROM raw.person",get_config(client,'person'),'plan-of-person')
+    assert job.job_id == r['person']['job_id'] and flaky.queries == 2
+    assert tracker.wait()['person'] == r['person']
+
+def test_changed_plan_is_resubmitted(tmpdir,client):
+    path = os.sep.join([str(tmpdir),'manifest.json'])
+    tracker = JobTracker(client=client,path=str(tmpdir),delay=0.001,manifest=RunManifest(path=path,i_dataset='raw',o_dataset='manifest'))
+    tracker.submit('person',"SELECT person_id FROM raw.person",get_config(client,'person'))
+    first = tracker.wait()['person']
+    tracker = JobTracker(client=client,path=str(tmpdir),delay=0.001,manifest=RunManifest(path=path,i_dataset='raw',o_dataset='manifest',resume=True))
+    tracker.submit('person',"SELECT person_id,year_of_birth FROM raw.person",get_config(client,'person'))
+    assert tracker.wait()['person']['job_id'] != first['job_id']
+
+def test_manifest_of_other_datasets(tmpdir):
+    path = os.sep.join([str(tmpdir),'manifest.json'])
+    RunManifest(path=path,i_dataset='raw',o_dataset='deid').set('person',state='DONE')
+    try:
+        RunManifest(path=path,i_dataset='raw',o_dataset='other',resume=True)
+        assert False
+    except ValueError :
+        pass
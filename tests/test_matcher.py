@@ -0,0 +1,34 @@
+"""
+    Tests of the multi-pattern matcher of the suppressed values (see deid2.Matcher)
+"""
+import random
+from deid2 import Matcher
+
+def test_literals_match_as_substring_search():
+    #
+    # A small alphabet yields patterns that overlap (prefixes, suffixes) i.e every failure transition of the automaton is exercised
+    #
+    generator = random.Random(0)
+    word = lambda n: "".join([generator.choice('ab_') for i in range(n)])
+    for i in range(200) :
+        patterns = [word(generator.randint(1,4)) for j in range(generator.randint(1,6))]
+        matcher = Matcher(patterns=patterns)
+        for j in range(20) :
+            value = word(generator.randint(0,12))
+            assert matcher.search(value) == any([pattern in value for pattern in patterns]),(patterns,value)
+
+def test_configuration_patterns():
+    patterns = ['Text','_City','WordAddress','PIIName_']
+    matcher = Matcher(patterns=patterns)
+    for value in ['PIIAddress_City','PIIName_First','Question_Text','Race_WhatRaceEthnicity','','City_','PIIAddress_WordAddress'] :
+        assert matcher.search(value) == any([pattern in value for pattern in patterns]),value
+
+def test_regular_expressions_are_searched():
+    matcher = Matcher(patterns=['Text','^Zip.*Code$'])
+    assert matcher.search('ZipCode')
+    assert matcher.search('Zip_Code')
+    assert not matcher.search('MyZipCode')
+    assert matcher.search('FreeText')
+
+def test_no_pattern_matches_nothing():
+    assert not Matcher(patterns=[]).search('anything')
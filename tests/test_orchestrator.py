@@ -0,0 +1,51 @@
+"""
+    Tests of the de-identification queries of the orchestrator, they are run by the local engine on the synthetic dataset (see conftest.py)
+"""
+import pandas as pd
+import pytest
+from deid import bq, Orchestrator
+from query import Compiler
+
+@pytest.fixture()
+def orchestrator(tmpdir,client,config):
+    return Orchestrator(client=client,i_dataset='raw',o_dataset='out',config=config,cache=str(tmpdir),jobs=str(tmpdir))
+
+def get_rows(orchestrator,node):
+    """
+        This function runs a plan and returns its columns and its rows sorted (NULL are None so rows can be compared)
+    """
+    job = bq.QueryJobConfig()
+    job.query_parameters = orchestrator.get_parameters()
+    sql = node if isinstance(node,basestring) else Compiler().render(node)
+    df = orchestrator.client.query(sql,job_config=job).to_dataframe()
+    df = df.astype(object).where(pd.notnull(df),None)
+    columns = sorted(df.columns)
+    return columns,sorted([tuple(row) for row in df[columns].values.tolist()])
+
+def test_single_pass(orchestrator,config):
+    columns,union = get_rows(orchestrator,orchestrator.build('observation',single_pass=False))
+    single = get_rows(orchestrator,orchestrator.build('observation',single_pass=True))[1]
+    assert len(union) > 0 and union == single
+    #
+    # The rows of the shifted questions (Shift) and the generalized rows are part of both results
+    #
+    values = set([row[columns.index('observation_source_value')] for row in union])
+    assert set(['ExtraConsent_TodaysDate','PIIBirthInformation_BirthDate']) & values
+    assert set(['OTHER','Unknown',config['constants']['sexual-orientation']['not-straight']]) <= values
+    assert orchestrator.verify('observation')['equivalent']
+
+def test_shards(orchestrator):
+    columns,rows = get_rows(orchestrator,orchestrator.compose('observation'))
+    shards = []
+    for index in range(3) :
+        sql = orchestrator.compose('observation',shard=(index,3))
+        assert sql.count(Orchestrator.get_shard_filter(index,3)) > 1
+        shards += get_rows(orchestrator,sql)[1]
+    assert len(rows) > 0 and sorted(shards) == rows
+
+def test_layout(orchestrator):
+    job = orchestrator.get_config('observation')
+    assert job._properties['query']['timePartitioning'] == {"type":"MONTH","field":"observation_date"}
+    assert job._properties['query']['clustering']['fields'][:2] == ["person_id","observation_source_concept_id"]
+    job = orchestrator.get_config('observation','WRITE_APPEND')
+    assert 'timePartitioning' not in job._properties['query'] and 'clustering' not in job._properties['query']
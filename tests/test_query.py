@@ -0,0 +1,61 @@
+"""
+    Tests of the intermediate representation of the queries and its compiler (see query.py)
+"""
+from query import Table, Select, Union, Except, Join, In, Compiler
+
+def get_seeds():
+    return Select(fields=['person_id AS seed_person_id','seed'],source=Table('raw','people_seed'),name='seeds')
+
+def test_where_conditions_are_anded():
+    q = Select(fields=['person_id'],source=Table('raw','person'),where=['person_id > 1',In(field='person_id',query=Select(fields=['person_id'],source=Table('raw','excluded')),negate=True)])
+    assert Compiler().render(q) == "SELECT person_id FROM raw.person WHERE person_id > 1 AND person_id NOT IN (SELECT person_id FROM raw.excluded)"
+
+def test_group_and_having():
+    q = Select(fields=['person_id','COUNT(*) AS n'],source=Table('raw','observation'),group=['person_id'],having=['COUNT(*) > 1'])
+    assert Compiler().render(q) == "SELECT person_id,COUNT(*) AS n FROM raw.observation GROUP BY person_id HAVING COUNT(*) > 1"
+
+def test_subquery_used_once_is_inlined():
+    q = Select(fields=['*'],source=Table('raw','observation'),joins=[Join(source=get_seeds(),alias='xii',on='xii.seed_person_id = observation.person_id')])
+    sql = Compiler().render(q)
+    assert not sql.startswith('WITH')
+    assert "LEFT JOIN (SELECT person_id AS seed_person_id,seed FROM raw.people_seed) xii ON" in sql
+
+def test_identical_subqueries_are_hoisted_once():
+    branches = [Select(fields=['*'],source=Table('raw',name),joins=[Join(source=get_seeds(),alias='xii',on='xii.seed_person_id = :name.person_id'.replace(':name',name))]) for name in ['observation','measurement']]
+    compiler = Compiler()
+    sql = compiler.render(Union(items=branches))
+    assert sql.startswith("WITH seeds AS (SELECT person_id AS seed_person_id,seed FROM raw.people_seed) ")
+    assert sql.count("raw.people_seed") == 1
+    assert sql.count("LEFT JOIN seeds xii") == 2
+    assert [name for name,_sql in compiler.ctes] == ['seeds']
+
+def test_flagged_subquery_is_hoisted():
+    seeds = Select(fields=['person_id'],source=Table('raw','people_seed'),name='seeds',hoist=True)
+    sql = Compiler().render(Select(fields=['*'],source=Table('raw','person'),where=[In(field='person_id',query=seeds)]))
+    assert sql == "WITH seeds AS (SELECT person_id FROM raw.people_seed) SELECT * FROM raw.person WHERE person_id IN (SELECT * FROM seeds)"
+
+def test_hoisted_subqueries_are_defined_inner_most_first():
+    inner = Select(fields=['person_id'],source=Table('raw','people_seed'),name='inner',hoist=True)
+    outer = Select(fields=['person_id'],source=inner,where=['person_id > 0'],name='outer',hoist=True)
+    compiler = Compiler()
+    sql = compiler.render(Union(items=[Select(fields=['*'],source=outer),Select(fields=['*'],source=outer)]))
+    assert [name for name,_sql in compiler.ctes] == ['inner','outer']
+    assert dict(compiler.ctes)['outer'] == "SELECT person_id FROM inner WHERE person_id > 0"
+    assert sql.endswith("SELECT * FROM outer UNION ALL SELECT * FROM outer")
+
+def test_names_of_distinct_subqueries_are_unique():
+    a = Select(fields=['person_id'],source=Table('raw','a'),hoist=True)
+    b = Select(fields=['person_id'],source=Table('raw','b'),hoist=True)
+    compiler = Compiler()
+    compiler.render(Except(left=a,right=b))
+    assert [name for name,_sql in compiler.ctes] == ['q','q_2']
+
+def test_no_hoisting():
+    branches = [Select(fields=['*'],source=get_seeds()) for i in range(2)]
+    sql = Compiler(hoist=False).render(Union(items=branches))
+    assert not sql.startswith('WITH') and sql.count("raw.people_seed") == 2
+
+def test_nodes_are_compared_by_their_sql():
+    assert get_seeds() == get_seeds()
+    assert len(set([get_seeds(),get_seeds()])) == 1
+    assert get_seeds() != Select(fields=['person_id'],source=Table('raw','people_seed'))
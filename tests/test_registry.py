@@ -0,0 +1,45 @@
+"""
+    Tests of the schema registry (see deid.SchemaRegistry)
+"""
+import pytest
+from deid import SchemaRegistry
+
+@pytest.fixture()
+def registry(tmpdir,client):
+    SchemaRegistry.CACHE.clear()
+    SchemaRegistry.VALIDATED.clear()
+    yield SchemaRegistry(client=client,path=str(tmpdir))
+    SchemaRegistry.CACHE.clear()
+    SchemaRegistry.VALIDATED.clear()
+
+def test_persisted_entries_are_revalidated(registry,client):
+    registry.get('raw','person')
+    #
+    # The persisted entry is out of date (the table changed since), a new process revalidates it once
+    #
+    tables = registry.load('raw')
+    tables['person'] = dict(tables['person'],etag='stale',schema=tables['person']['schema'][:1])
+    registry.save('raw')
+    SchemaRegistry.CACHE.clear()
+    SchemaRegistry.VALIDATED.clear()
+    offline = SchemaRegistry(client=None,path=registry.path)
+    assert offline.get('raw','person')['etag'] == 'stale'
+    entry = registry.get('raw','person')
+    assert entry['etag'] != 'stale' and [field.name for field in entry['schema']] == [field.name for field in client.get_table(client.dataset('raw').table('person')).schema]
+    SchemaRegistry.CACHE.clear()
+    assert SchemaRegistry(client=None,path=registry.path).get('raw','person')['etag'] == entry['etag']
+
+def test_entries_are_fetched_once(registry,client):
+    calls = []
+    get_table = client.get_table
+    client.get_table = lambda ref: calls.append(ref.table_id) or get_table(ref)
+    for i in range(3) :
+        registry.get_schema('raw','person')
+    assert calls == ['person']
+    registry.prefetch('raw')
+    registry.get_schema('raw','observation')
+    assert calls.count('observation') == 1
+
+def test_offline(registry):
+    with pytest.raises(KeyError) :
+        SchemaRegistry(client=None,path=registry.path).get('raw','person')
@@ -0,0 +1,40 @@
+"""
+    Tests of the row suppression rules (see deid.Rules), the suppressed values are materialized in a copy of the synthetic dataset
+"""
+import os
+import shutil
+from deid import JobTracker, Rules
+from engine import LocalClient
+
+class CountingClient(LocalClient):
+    def __init__(self,**args):
+        LocalClient.__init__(self,**args)
+        self.queries = []
+    def query(self,sql,**args):
+        self.queries.append(sql)
+        return LocalClient.query(self,sql,**args)
+
+def test_materialized_values_are_reused(tmpdir,data,config):
+    path = str(tmpdir.join('data'))
+    shutil.copytree(data,path)
+    client = CountingClient(path=path)
+    get_rules = lambda suppression: Rules(client=client,dataset='raw',suppression=suppression,path=str(tmpdir))
+    tracker = JobTracker(client=client,path=str(tmpdir),delay=0.001)
+    rules = get_rules(config['suppression'])
+    rules.build(['observation'],tracker)
+    assert rules.built == set(['suppressed_observation_observation_source_value']) and len(client.queries) == 1
+    values = client.query("SELECT value FROM raw.suppressed_observation_observation_source_value").to_dataframe()['value'].tolist()
+    assert 'SocialSecurity' in values and 'Race_WhatRaceEthnicity' not in values
+    #
+    # The next run reuses the table, it is rebuilt if the patterns or the table change
+    #
+    client.queries = []
+    rules = get_rules(config['suppression'])
+    rules.build(['observation'],tracker)
+    assert rules.built == set(['suppressed_observation_observation_source_value']) and client.queries == []
+    rules = get_rules({"observation":{"rows":{"observation_source_value":["SocialSecurity"]}}})
+    rules.build(['observation'],tracker)
+    assert len(client.queries) == 1
+    os.utime(client.get_file('raw','observation'),None)
+    rules.build(['observation'],tracker)
+    assert len(client.queries) == 2
@@ -0,0 +1,89 @@
+"""
+    Tests of the scheduling of the units of work of a run (see deid.Scheduler)
+"""
+import pytest
+from threading import Lock
+from deid import Scheduler, JobTracker
+
+def get_scheduler(tmpdir):
+    return Scheduler(tracker=JobTracker(client=None,path=str(tmpdir),delay=0.001),pool=4)
+
+def get_handler(name,started,error=None):
+    lock = Lock()
+    def handler():
+        with lock :
+            started.append(name)
+        if error is not None :
+            raise Exception(error)
+        return []
+    return handler
+
+def test_units_start_after_their_inputs_are_written(tmpdir):
+    scheduler = get_scheduler(tmpdir)
+    started = []
+    scheduler.add('observation',get_handler('observation',started),inputs=['raw.people_seed','raw.people_multi_racial'],outputs=['deid.observation'])
+    scheduler.add('people_multi_racial',get_handler('people_multi_racial',started),inputs=['raw.people_seed'],outputs=['raw.people_multi_racial'])
+    scheduler.add('people_seed',get_handler('people_seed',started),outputs=['raw.people_seed'])
+    scheduler.add('person',get_handler('person',started),inputs=['raw.person'],outputs=['deid.person'])
+    assert scheduler.get_dependencies() == {"observation":['people_multi_racial','people_seed'],"people_multi_racial":['people_seed'],"people_seed":[],"person":[]}
+    r = scheduler.run()
+    assert set([r[name]['state'] for name in r]) == set(['DONE'])
+    assert started.index('people_seed') < started.index('people_multi_racial') < started.index('observation')
+
+def test_failure_cancels_the_dependent_units_only(tmpdir):
+    scheduler = get_scheduler(tmpdir)
+    started = []
+    scheduler.add('people_seed',get_handler('people_seed',started,'quota exceeded'),outputs=['raw.people_seed'])
+    scheduler.add('people_multi_racial',get_handler('people_multi_racial',started),inputs=['raw.people_seed'],outputs=['raw.people_multi_racial'])
+    scheduler.add('observation',get_handler('observation',started),inputs=['raw.people_multi_racial'],outputs=['deid.observation'])
+    scheduler.add('person',get_handler('person',started),outputs=['deid.person'])
+    r = scheduler.run()
+    assert r['people_seed'] == {"state":"FAILED","errors":"quota exceeded","jobs":[]}
+    assert r['people_multi_racial']['state'] == 'CANCELLED' and r['people_multi_racial']['errors'] == {"cancelled":"people_seed"}
+    #
+    # The unit that failed is reported rather than the cancelled unit in between
+    #
+    assert r['observation']['state'] == 'CANCELLED' and r['observation']['errors'] == {"cancelled":"people_seed"}
+    assert r['person']['state'] == 'DONE'
+    assert sorted(started) == ['people_seed','person']
+
+def test_failure_of_the_done_callback(tmpdir):
+    scheduler = get_scheduler(tmpdir)
+    def done():
+        raise Exception('not found')
+    scheduler.add('people_seed',get_handler('people_seed',[]),outputs=['raw.people_seed'],done=done)
+    assert scheduler.run()['people_seed']['state'] == 'FAILED'
+
+def test_cycle(tmpdir):
+    scheduler = get_scheduler(tmpdir)
+    scheduler.add('a',get_handler('a',[]),inputs=['b'],outputs=['a'])
+    scheduler.add('b',get_handler('b',[]),inputs=['a'],outputs=['b'])
+    with pytest.raises(ValueError) :
+        scheduler.get_dependencies()
+
+def test_table_written_twice(tmpdir):
+    scheduler = get_scheduler(tmpdir)
+    scheduler.add('a',get_handler('a',[]),outputs=['deid.person'])
+    scheduler.add('b',get_handler('b',[]),outputs=['deid.person'])
+    with pytest.raises(ValueError) :
+        scheduler.get_dependencies()
+
+def test_jobs_submitted_concurrently(tmpdir,client):
+    #
+    # The handlers submit their jobs from the threads of the scheduler while it polls the jobs already submitted
+    #
+    tracker = JobTracker(client=client,path=str(tmpdir),delay=0.001)
+    scheduler = Scheduler(tracker=tracker,pool=8,jobs=4)
+    def get_handler(index):
+        def handler():
+            names = ["job_%d_%d" % (index,i) for i in range(3)]
+            for name in names :
+                tracker.submit(name,"SELECT COUNT(*) FROM raw.person WHERE person_id > %d" % index,None)
+            return names
+        return handler
+    for index in range(12) :
+        scheduler.add('unit_%d' % index,get_handler(index),inputs=['raw.person'],outputs=['deid.unit_%d' % index])
+    r = scheduler.run()
+    assert set([r[name]['state'] for name in r]) == set(['DONE'])
+    records = tracker.get_records()
+    assert len(records) == 36 and set([record['state'] for record in records.values()]) == set(['DONE'])